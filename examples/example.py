@@ -11,10 +11,11 @@ freq = 1.0, 2.0, 1.0
 params = zip(pwm,amp,phase,offset,freq)
 
 dev = Pwm_sine_device()
-dev.set_max_cycle(5)
 
-for i,a,p,o,f in params:
-    dev.set_sine_param(i,a,p,o,f)
+# Set max_cycle and all channel parameters in one pipelined exchange. This is
+# equivalent to calling set_max_cycle followed by set_sine_param for each 
+# channel.
+dev.configure(max_cycle=5, sine_params=params)
 
 dev.start()
 dev.wait()
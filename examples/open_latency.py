@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+#
+# Measures the time taken to open the device with the normal (cold) open 
+# path and with the fast open path once the device information is cached
+# (warm). Pass --sim to run against the simulated device.
+import os
+import sys
+import tempfile
+from sine_stimulus import Pwm_sine_device
+from sine_stimulus.simulator import Sim_usb
+
+num_open = 10
+
+if '--sim' in sys.argv:
+    backend = Sim_usb(latency=0.0005, drop_first=True, enum_latency=0.005)
+else:
+    backend = None
+
+cache_path = os.path.join(tempfile.mkdtemp(), 'open_cache')
+
+def open_time(fast_open):
+    dev = Pwm_sine_device(backend=backend, fast_open=fast_open, cache_path=cache_path)
+    dev.close()
+    return dev.open_time, dev.warm_open
+
+cold_times = [open_time(False)[0] for i in range(num_open)]
+
+# First fast open populates the cache
+open_time(True)
+warm_list = [open_time(True) for i in range(num_open)]
+warm_times = [t for t, warm in warm_list]
+
+print 'cold open: mean %1.4f s, min %1.4f s, max %1.4f s'%(
+        sum(cold_times)/num_open, min(cold_times), max(cold_times))
+print 'warm open: mean %1.4f s, min %1.4f s, max %1.4f s (%d/%d warm)'%(
+        sum(warm_times)/num_open, min(warm_times), max(warm_times),
+        len([w for t, w in warm_list if w]), num_open)
+
+os.unlink(cache_path)
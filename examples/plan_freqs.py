@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+#
+# Plans a frequency sweep offline with the frequency quantization model.
+# Prints the realized frequency and relative error of each commanded
+# frequency and the nearest achievable frequency - the quantities 
+# test_freqs.py measures on the device one point at a time.
+import numpy
+from sine_stimulus.freq_model import Freq_model
+
+top = 800
+f_array = numpy.linspace(0.01,200.0,400)
+
+model = Freq_model(top)
+f_true_array = model.realized(f_array)
+rel_err_array = model.rel_error(f_array)
+freq_chz_array, f_snap_array = model.nearest(f_array)
+
+for f, f_true, rel_err, f_snap in zip(f_array, f_true_array, rel_err_array, f_snap_array):
+    print 'f: %f, f_true: %f, rel_err: %f, f_snap: %f'%(f, f_true, rel_err, f_snap)
+
+freqs, freq_chz = model.index()
+print
+print '%d achievable frequencies, max rel_err: %f'%(len(freqs), rel_err_array.max())
@@ -1,2 +1 @@
-import pkg_resources
 from sine_stimulus import *
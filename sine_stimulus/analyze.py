@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+#
+# analyze.py
+#
+# Sinusoid fits of recorded stimulus output for checking it against the
+# commanded sine parameters. Recordings are (n, channels) arrays sampled at
+# a fixed rate, or .npy files which are memory mapped, in any units - duty
+# cycle as a fraction of TOP (as rendered by render.py) compares directly
+# with the amp and offset of get_sine_param. Each channel is fitted with
+#
+#   x(t) = offset + amp*sin(2*pi*freq*t + phase*pi/180)
+#
+# t in seconds from the first sample. The frequency starts from the
+# commanded value, or an interpolated FFT peak of the first FFT_MAX samples,
+# is refined from the phase drift of lock-in estimates over successive
+# blocks and amp, phase and offset are then found by linear least squares.
+# Every pass works through the recording in chunks, so hours of data are
+# analyzed without loading them into memory, e.g.
+#
+#   data = load('trial.npy')
+#   fit_list = fit_sine(data, 1.0e4, freq=[p[4] for p in sine_params])
+#   for result in compare(fit_list, sine_params):
+#       print result
+#
+# Requires numpy.
+#
+# William Dickson
+# ---------------------------------------------------------------------------
+import numpy
+
+# Number of samples per chunk processed
+ANALYZE_CHUNK = 262144
+
+# Max number of samples used for the FFT frequency estimate
+FFT_MAX = 1048576
+
+# Length in cycles of the first blocks, and max number of blocks per pass,
+# used by refine_freq
+REFINE_CYCLES = 4
+REFINE_BLOCKS = 64
+
+# Number of golden section steps of the frequency search used for short
+# recordings
+SEARCH_STEPS = 40
+
+# Default tolerances used by compare: relative frequency error, absolute
+# amplitude and offset error and phase error in degrees
+ANALYZE_FREQ_TOL = 1.0e-3
+ANALYZE_LEVEL_TOL = 0.01
+ANALYZE_PHASE_TOL = 2.0
+
+
+def load(path):
+    """
+    Memory maps a recording stored as a .npy file.
+    """
+    return numpy.load(path, mmap_mode='r')
+
+def fit_sine(data, sample_rate, freq=None, chunk=ANALYZE_CHUNK):
+    """
+    Fits a sinusoid to each channel (column) of data. freq, if given, is the
+    starting frequency estimate in Hz of each channel, 0 fitting only the
+    offset. Returns a list of dictionaries of the fitted amp, phase
+    (degrees), offset, freq and the rms residual, one per channel.
+    """
+    data = _as_2d(data)
+    n, n_chan = data.shape
+    if n == 0:
+        raise ValueError('no samples to fit')
+    if freq is None:
+        freq = fft_freq(data, sample_rate)
+    freq = numpy.asarray(freq, dtype=float).reshape(n_chan)
+    freq = refine_freq(data, sample_rate, freq, chunk)
+    coef, rms = _least_squares(data, sample_rate, freq, chunk)
+    fit_list = []
+    for i in range(n_chan):
+        a, b, offset = coef[i]
+        fit_list.append({
+            'amp': float(numpy.hypot(a, b)),
+            'phase': float(numpy.degrees(numpy.arctan2(b, a)) % 360.0),
+            'offset': float(offset),
+            'freq': float(freq[i]),
+            'rms': float(rms[i]),
+            })
+    return fit_list
+
+def fft_freq(data, sample_rate):
+    """
+    Returns the frequency in Hz of the largest spectral peak of each channel
+    over the first FFT_MAX samples, interpolated between FFT bins.
+    """
+    data = _as_2d(data)
+    x = numpy.asarray(data[:FFT_MAX], dtype=float)
+    m = len(x)
+    x = (x - x.mean(axis=0))*numpy.hanning(m)[:,None]
+    mag = numpy.abs(numpy.fft.rfft(x, axis=0))
+    mag[0] = 0.0
+    k = numpy.argmax(mag, axis=0)
+    freq = numpy.zeros(x.shape[1])
+    for i in range(x.shape[1]):
+        delta = 0.0
+        if 0 < k[i] < len(mag) - 1:
+            # Parabolic interpolation of the log magnitude
+            y0, y1, y2 = numpy.log(mag[k[i]-1:k[i]+2, i] + 1.0e-300)
+            denom = y0 - 2*y1 + y2
+            if denom != 0:
+                delta = 0.5*(y0 - y2)/denom
+        freq[i] = (k[i] + delta)*sample_rate/float(m)
+    return freq
+
+def refine_freq(data, sample_rate, freq, chunk=ANALYZE_CHUNK):
+    """
+    Refines the frequency estimates freq (Hz) of the channels of data from
+    the drift of the lock-in phase across successive blocks. The blocks
+    start at REFINE_CYCLES cycles and grow, with the span used, until the
+    last pass covers the whole recording in blocks of up to chunk samples.
+    Recordings too short for this, fewer than 4*REFINE_CYCLES cycles, are
+    refined by a least squares search between freq and the FFT peak instead.
+    Returns the refined frequencies.
+    """
+    data = _as_2d(data)
+    n = len(data)
+    freq = numpy.asarray(freq, dtype=float).copy()
+    for c in numpy.flatnonzero(freq > 0):
+        block = max(2, int(REFINE_CYCLES*sample_rate/freq[c]))
+        if n//block < 4:
+            freq[c] = _search_freq(data[:,c], sample_rate, freq[c], chunk)
+            continue
+        while True:
+            if block >= chunk:
+                block = chunk
+                span = n
+            else:
+                span = min(n, block*REFINE_BLOCKS)
+            if span//block < 4:
+                break
+            t_list = []
+            phase_list = []
+            for start in xrange(0, span - block + 1, block):
+                x = numpy.asarray(data[start:start+block, c], dtype=float)
+                z = _demodulate((x - x.mean())[:,None], start, sample_rate, freq[c:c+1])
+                t_list.append((start + 0.5*block)/sample_rate)
+                phase_list.append(numpy.angle(z[0]))
+            slope = numpy.polyfit(t_list, numpy.unwrap(phase_list), 1)[0]
+            freq[c] += slope/(2*numpy.pi)
+            if span == n:
+                break
+            block *= 8
+    return freq
+
+def compare(fit_list, sine_params, model=None, freq_tol=ANALYZE_FREQ_TOL,
+            level_tol=ANALYZE_LEVEL_TOL, phase_tol=ANALYZE_PHASE_TOL):
+    """
+    Compares the fits of channels 0, 1, ... with the commanded (pwm_chan,
+    amp, phase, offset, freq) sine parameters, as passed to set_sine_param
+    or returned by get_sine_param. The commanded frequency is replaced by
+    the realized frequency when a freq_model.Freq_model is given. Channels
+    with a zero frequency are expected to have zero amplitude. Returns a
+    list of dictionaries of the channel, the errors of each fitted value and
+    whether all are within the tolerances.
+    """
+    result_list = []
+    for pwm_chan, amp, phase, offset, freq in sine_params:
+        fit = fit_list[int(pwm_chan)]
+        if model is not None:
+            freq = float(model.realized_chz(int(round(100*freq))))
+        if freq <= 0:
+            # The output is held at the offset, see render.py
+            amp = 0.0
+        freq_err = fit['freq'] - freq
+        if freq > 0:
+            rel_freq_err = freq_err/freq
+        else:
+            rel_freq_err = 0.0
+        phase_err = (fit['phase'] - phase + 180.0) % 360.0 - 180.0
+        amp_err = fit['amp'] - amp
+        offset_err = fit['offset'] - offset
+        ok = abs(amp_err) <= level_tol and abs(offset_err) <= level_tol
+        if amp > 0 and freq > 0:
+            ok = ok and abs(rel_freq_err) <= freq_tol and abs(phase_err) <= phase_tol
+        result_list.append({
+            'pwm_chan': int(pwm_chan),
+            'freq_err': freq_err,
+            'rel_freq_err': rel_freq_err,
+            'amp_err': amp_err,
+            'phase_err': phase_err,
+            'offset_err': offset_err,
+            'ok': ok,
+            })
+    return result_list
+
+def check_trials(data, sample_rate, trial_list, model=None, chunk=ANALYZE_CHUNK, **tol):
+    """
+    Fits and compares each trial of a recording. trial_list holds (start_t,
+    end_t, sine_params) entries, times in seconds from the first sample;
+    the phase of each trial is taken relative to its start. Returns a list
+    of (fit_list, result_list) pairs.
+    """
+    data = _as_2d(data)
+    qc_list = []
+    for start_t, end_t, sine_params in trial_list:
+        start = int(round(start_t*sample_rate))
+        end = int(round(end_t*sample_rate))
+        freq = numpy.zeros(data.shape[1])
+        for pwm_chan, amp, phase, offset, f in sine_params:
+            if model is not None:
+                f = float(model.realized(f))
+            freq[int(pwm_chan)] = f
+        fit_list = fit_sine(data[start:end], sample_rate, freq=freq, chunk=chunk)
+        qc_list.append((fit_list, compare(fit_list, sine_params, model=model, **tol)))
+    return qc_list
+
+def _as_2d(data):
+    if data.ndim == 1:
+        return data.reshape(-1, 1)
+    return data
+
+def _search_freq(x, sample_rate, freq, chunk):
+    # Frequency minimizing the least squares residual of channel x, searched
+    # by golden section over an interval holding freq and the FFT peak, one
+    # FFT bin either side
+    x = _as_2d(x)
+    n = len(x)
+    width = sample_rate/float(min(n, FFT_MAX))
+    peak = fft_freq(x, sample_rate)[0]
+    lo = max(0.5*width, min(freq, peak) - width)
+    hi = max(freq, peak) + width
+    def rms(f):
+        return _least_squares(x, sample_rate, numpy.array([f]), chunk)[1][0]
+    g = 0.5*(numpy.sqrt(5.0) - 1)
+    a, b = hi - g*(hi - lo), lo + g*(hi - lo)
+    rms_a, rms_b = rms(a), rms(b)
+    for i in range(SEARCH_STEPS):
+        if rms_a < rms_b:
+            hi, b, rms_b = b, a, rms_a
+            a = hi - g*(hi - lo)
+            rms_a = rms(a)
+        else:
+            lo, a, rms_a = a, b, rms_b
+            b = lo + g*(hi - lo)
+            rms_b = rms(b)
+    return 0.5*(lo + hi)
+
+def _angle(start, m, sample_rate, freq):
+    # (m, channels) array of 2*pi*freq*t for samples start ... start+m-1,
+    # with the whole cycles removed before scaling to keep precision for
+    # long recordings.
+    i = numpy.arange(start, start + m, dtype=float)
+    cycles = numpy.outer(i, freq/sample_rate)
+    return 2*numpy.pi*(cycles - numpy.floor(cycles))
+
+def _demodulate(x, start, sample_rate, freq):
+    # Lock-in estimate sum x*exp(-j*angle) of each channel
+    angle = _angle(start, len(x), sample_rate, freq)
+    return (x*numpy.cos(angle)).sum(axis=0) - 1j*(x*numpy.sin(angle)).sum(axis=0)
+
+def _least_squares(data, sample_rate, freq, chunk):
+    # Fits x = a*sin + b*cos + offset per channel by accumulating the normal
+    # equations over chunks. Returns the (channels, 3) coefficients and the
+    # rms residuals.
+    n, n_chan = data.shape
+    normal = numpy.zeros((n_chan, 3, 3))
+    rhs = numpy.zeros((n_chan, 3))
+    sum_sq = numpy.zeros(n_chan)
+    for start in xrange(0, n, chunk):
+        x = numpy.asarray(data[start:start+chunk], dtype=float)
+        angle = _angle(start, len(x), sample_rate, freq)
+        basis = numpy.dstack((numpy.sin(angle), numpy.cos(angle), numpy.ones(angle.shape)))
+        normal += numpy.einsum('mci,mcj->cij', basis, basis)
+        rhs += numpy.einsum('mci,mc->ci', basis, x)
+        sum_sq += (x*x).sum(axis=0)
+    coef = numpy.zeros((n_chan, 3))
+    for i in range(n_chan):
+        if freq[i] > 0:
+            coef[i] = numpy.linalg.lstsq(normal[i], rhs[i], rcond=None)[0]
+        else:
+            coef[i,2] = rhs[i,2]/n
+    rss = sum_sq - (coef*rhs).sum(axis=1)
+    return coef, numpy.sqrt(numpy.maximum(rss, 0.0)/n)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# async_device.py
+#
+# asyncio interface to the at90usb sinewave stimulus generator. All usb I/O
+# is run on a single worker thread, off the event loop, so that the device
+# calls never block other coroutines and access to the device's shared
+# output/input buffers is serialized. Every method returns a future which
+# a coroutine can wait for, with trollius on python 2, e.g.
+#
+#   from trollius import From
+#
+#   @asyncio.coroutine
+#   def run_trial(dev, params):
+#       yield From(dev.open())
+#       yield From(dev.configure(max_cycle=5, sine_params=params))
+#       yield From(dev.start())
+#       yield From(dev.wait())
+#       yield From(dev.close())
+#
+#   loop = asyncio.get_event_loop()
+#   loop.run_until_complete(run_trial(AsyncPwmSineDevice(loop), params))
+#
+# On python 3 the futures may be awaited instead.
+#
+# Requires asyncio (trollius on python 2) and concurrent.futures (the
+# futures backport on python 2).
+#
+# William Dickson
+# ---------------------------------------------------------------------------
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+from concurrent.futures import ThreadPoolExecutor
+from sine_stimulus import (Pwm_sine_device, forward_methods, WRAPPED_METHODS,
+                           RUNNING, WAIT_SLEEP_T)
+
+
+class AsyncPwmSineDevice:
+
+    def __init__(self, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.dev = None
+        # One worker thread - commands are executed in the order issued
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def open(self, backend=None, shadow=False, fast_open=False):
+        """
+        Opens the device. See Pwm_sine_device for the arguments.
+        """
+        def open_dev():
+            self.dev = Pwm_sine_device(backend=backend, shadow=shadow, 
+                                       fast_open=fast_open)
+        return self._run(open_dev)
+
+    def close(self):
+        future = self._call('close')
+        self.executor.shutdown(wait=False)
+        return future
+
+    def wait(self, poll_t=WAIT_SLEEP_T):
+        """
+        Returns a future which completes when the device stops running. The
+        status is polled every poll_t seconds using loop timers, so the event
+        loop is never blocked between polls.
+        """
+        result = _create_future(self.loop)
+
+        def poll():
+            self.get_status().add_done_callback(check)
+
+        def check(status):
+            if result.cancelled():
+                return
+            if status.exception() is not None:
+                result.set_exception(status.exception())
+            elif status.result() == RUNNING:
+                self.loop.call_later(poll_t, poll)
+            else:
+                result.set_result(None)
+
+        poll()
+        return result
+
+    def _call(self, name, *args, **kwargs):
+        # Run the named Pwm_sine_device method on the worker thread
+        def call():
+            if self.dev is None:
+                raise RuntimeError('device not open')
+            return getattr(self.dev, name)(*args, **kwargs)
+        return self._run(call)
+
+    def _run(self, func):
+        return self.loop.run_in_executor(self.executor, func)
+
+
+# The remaining methods run the Pwm_sine_device method of the same name
+forward_methods(AsyncPwmSineDevice, WRAPPED_METHODS + (
+    'set_max_cycle', 'set_sine_param', 'set_sine_params', 'set_dc_val'))
+
+
+def _create_future(loop):
+    if hasattr(loop, 'create_future'):
+        return loop.create_future()
+    return asyncio.Future(loop=loop)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+#
+# atomic.py
+#
+# Atomic saves of the files and directories kept on disk by the package -
+# the open cache, calibrations and compiled plans. The content is written
+# to a temporary path next to the target and renamed into place, so that a
+# concurrent reader sees either the old content or the new, never a partial
+# write, e.g.
+#
+#   atomic_save(path, lambda tmp_path: numpy.save(tmp_path, array))
+#
+# William Dickson
+# ---------------------------------------------------------------------------
+import os
+import shutil
+
+
+def atomic_save(path, write):
+    """
+    Calls write(tmp_path) to write the content of path, a file or a
+    directory, to a temporary path with the same extension and renames it
+    to path. The parent directory is created if needed. If writing or
+    renaming fails the temporary path is removed and the error re-raised;
+    an existing directory at path is not replaced and raises OSError.
+    """
+    parent = os.path.dirname(path)
+    if parent and not os.path.isdir(parent):
+        os.makedirs(parent)
+    root, ext = os.path.splitext(path)
+    tmp_path = '%s.%d%s'%(root, os.getpid(), ext)
+    try:
+        write(tmp_path)
+        os.rename(tmp_path, path)
+    except:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
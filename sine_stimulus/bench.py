@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+#
+# bench.py
+#
+# Benchmarks of the host side of the sinewave stimulus generator interface:
+# package import time, packet encode/decode cost, round trip latency per
+# USB_CMD_* opcode, command throughput, device open time and trial setup
+# time (max_cycle, three sets of sine parameters and start). Runs against the device or the
+# simulator and returns its results as a dictionary which is written out as
+# json by 'sine-stim bench' so that runs can be compared across versions.
+#
+# The round trip and trial benchmarks restore the device's max_cycle, sine
+# parameters and dc values afterwards and leave the device stopped.
+#
+# William Dickson
+# ---------------------------------------------------------------------------
+import os
+import sys
+import time
+import subprocess
+import codec
+from sine_stimulus import Pwm_sine_device
+from instrument import cmd_name
+from constants import *
+
+BENCH_NUM = 200
+BENCH_CODEC_NUM = 20000
+BENCH_OPEN_NUM = 5
+BENCH_TRIAL_NUM = 20
+BENCH_THROUGHPUT_T = 1.0
+BENCH_IMPORT_NUM = 5
+
+# Run in a fresh interpreter to time the package import and report whether
+# the usb library and pkg_resources were loaded by it
+IMPORT_SCRIPT = """
+import sys, time
+t0 = time.time()
+import sine_stimulus
+t1 = time.time()
+sys.stdout.write('%f %d %d' % (t1 - t0, 'pylibusb' in sys.modules,
+                               'pkg_resources' in sys.modules))
+"""
+
+# Runs 'sine-stim help' in a fresh interpreter
+HELP_SCRIPT = """
+import sys
+sys.argv = ['sine-stim', 'help']
+from sine_stimulus import sine_stim_main
+sine_stim_main()
+"""
+
+# Parameters used for the trial setup benchmark
+BENCH_MAX_CYCLE = 5
+BENCH_SINE_PARAMS = [
+    (0, 0.25, 0, 1.0, 1.0),
+    (1, 0.30, 90, 0.5, 2.0),
+    (2, 0.50, 180, 0.25, 1.0),
+    ]
+
+
+def run_benchmarks(backend=None, target='device', n=BENCH_NUM, verbose=False):
+    """
+    Runs all benchmarks and returns a dictionary of the results. Times are
+    in seconds.
+    """
+    results = {
+        'time': time.time(),
+        'python': sys.version.split()[0],
+        'target': target,
+        'n': n,
+        }
+    _progress('import', verbose)
+    results['import'] = bench_import()
+    _progress('codec', verbose)
+    results['codec'] = bench_codec()
+    _progress('open', verbose)
+    results['open'] = bench_open(backend)
+    dev = Pwm_sine_device(backend=backend, instrument=True)
+    try:
+        _progress('round trip', verbose)
+        results['round_trip'] = bench_round_trip(dev, n)
+        _progress('throughput', verbose)
+        results['throughput'] = bench_throughput(dev)
+        _progress('trial setup', verbose)
+        results['trial_setup'] = bench_trial_setup(dev)
+    finally:
+        dev.close()
+    return results
+
+def bench_import(n=BENCH_IMPORT_NUM):
+    """
+    Returns statistics of the time taken to import the package ('import') 
+    and of the total run time of 'sine-stim help' ('help') and of an empty
+    interpreter ('python') in fresh interpreters, and whether importing the 
+    package loaded pylibusb or pkg_resources.
+    """
+    env = dict(os.environ)
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([package_dir] + 
+            [p for p in [env.get('PYTHONPATH')] if p])
+    import_t, help_t, python_t = [], [], []
+    for i in range(n):
+        out = subprocess.Popen([sys.executable, '-c', IMPORT_SCRIPT], env=env,
+                               stdout=subprocess.PIPE).communicate()[0]
+        t, usb_loaded, pkg_resources_loaded = out.split()
+        import_t.append(float(t))
+        help_t.append(_run_time([sys.executable, '-c', HELP_SCRIPT], env))
+        python_t.append(_run_time([sys.executable, '-c', 'pass'], env))
+    return {
+        'import': _summary(import_t),
+        'help': _summary(help_t),
+        'python': _summary(python_t),
+        'loads_pylibusb': bool(int(usb_loaded)),
+        'loads_pkg_resources': bool(int(pkg_resources_loaded)),
+        }
+
+def bench_codec(n=BENCH_CODEC_NUM):
+    """
+    Returns the mean time to encode each command packet and decode each
+    reply packet, keyed by command name.
+    """
+    buf = bytearray(USB_BUFFER_SIZE)
+    zero_packet = chr(0)*USB_BUFFER_SIZE
+    results = {}
+    for cmd_id, layout in codec.COMMAND_TABLE.items():
+        args = layout.unpack_from(zero_packet)[1:]
+        t0 = time.time()
+        for i in xrange(n):
+            codec.encode_into(buf, cmd_id, *args)
+        t1 = time.time()
+        entry = {'encode': (t1 - t0)/n}
+        if cmd_id in codec.REPLY_TABLE:
+            t0 = time.time()
+            for i in xrange(n):
+                codec.decode(cmd_id, zero_packet)
+            t1 = time.time()
+            entry['decode'] = (t1 - t0)/n
+        results[cmd_name(cmd_id)] = entry
+    return results
+
+def bench_open(backend=None, n=BENCH_OPEN_NUM):
+    """
+    Returns statistics of the time taken to open the device.
+    """
+    open_t = []
+    for i in range(n):
+        dev = Pwm_sine_device(backend=backend)
+        open_t.append(dev.open_time)
+        dev.close()
+    return _summary(open_t)
+
+def bench_round_trip(dev, n=BENCH_NUM):
+    """
+    Returns the write, read and total exchange time statistics of each
+    opcode which does not change the device's behaviour. Set commands
+    rewrite the device's current values.
+    """
+    dev.stop()
+    max_cycle = dev._exchange(USB_CMD_GET_MAX_CYCLE)[1]
+    sine_param = dev._exchange(USB_CMD_GET_SINE_PARAM, 0)[1:]
+    dc_val = dev._exchange(USB_CMD_GET_DC_VAL, 0)[1:]
+    cmd_list = [
+        (USB_CMD_GET_STATUS,),
+        (USB_CMD_GET_SINE_PARAM, 0),
+        (USB_CMD_GET_MAX_CYCLE,),
+        (USB_CMD_GET_TOP,),
+        (USB_CMD_GET_DC_MODE,),
+        (USB_CMD_GET_DC_VAL, 0),
+        (USB_CMD_DEBUG,),
+        (USB_CMD_DUMMY,),
+        (USB_CMD_STOP,),
+        (USB_CMD_SET_MAX_CYCLE, max_cycle),
+        (USB_CMD_SET_SINE_PARAM,) + sine_param,
+        (USB_CMD_SET_DC_VAL,) + dc_val,
+        ]
+    dev.instrument.reset()
+    for cmd in cmd_list:
+        for i in xrange(n):
+            dev._exchange(*cmd)
+    results = {}
+    for name, stats in dev.instrument.as_dict().items():
+        for phase in ('write', 'read', 'total'):
+            del stats[phase]['bins']
+        results[name] = stats
+    return results
+
+def bench_throughput(dev, duration=BENCH_THROUGHPUT_T):
+    """
+    Returns the number of get_status commands completed per second.
+    """
+    count = 0
+    t0 = time.time()
+    end_t = t0 + duration
+    while time.time() < end_t:
+        dev.get_status()
+        count += 1
+    return {'cmd_per_s': count/(time.time() - t0), 'count': count}
+
+def bench_trial_setup(dev, n=BENCH_TRIAL_NUM):
+    """
+    Returns statistics of the time taken to set max_cycle, set the sine
+    parameters of all three channels and start, done one command at a time
+    ('serial') and with configure ('pipelined').
+    """
+    # Saved and restored in device units, a round trip through the float
+    # values of get_sine_param can be off by one count
+    restore_list = [(USB_CMD_SET_MAX_CYCLE, dev._exchange(USB_CMD_GET_MAX_CYCLE)[1])]
+    for i in range(0,3):
+        restore_list.append((USB_CMD_SET_SINE_PARAM,) + dev._exchange(USB_CMD_GET_SINE_PARAM, i)[1:])
+    serial_t, pipelined_t = [], []
+    try:
+        for i in range(n):
+            t0 = time.time()
+            dev.set_max_cycle(BENCH_MAX_CYCLE)
+            for param in BENCH_SINE_PARAMS:
+                dev.set_sine_param(*param)
+            dev.start()
+            serial_t.append(time.time() - t0)
+            dev.stop()
+
+            t0 = time.time()
+            dev.configure(max_cycle=BENCH_MAX_CYCLE, sine_params=BENCH_SINE_PARAMS)
+            dev.start()
+            pipelined_t.append(time.time() - t0)
+            dev.stop()
+    finally:
+        dev.invalidate_shadow()
+        dev._set_commands(restore_list)
+    return {'serial': _summary(serial_t), 'pipelined': _summary(pipelined_t)}
+
+def _run_time(cmd, env):
+    devnull = open(os.devnull, 'w')
+    try:
+        t0 = time.time()
+        subprocess.call(cmd, env=env, stdout=devnull)
+        return time.time() - t0
+    finally:
+        devnull.close()
+
+def _summary(t_list):
+    t_sorted = sorted(t_list)
+    n = len(t_sorted)
+    return {
+        'n': n,
+        'mean': sum(t_sorted)/n,
+        'min': t_sorted[0],
+        'median': t_sorted[n//2],
+        'max': t_sorted[-1],
+        }
+
+def _progress(name, verbose):
+    if verbose:
+        print >> sys.stderr, 'running %s benchmark'%(name,)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+#
+# calibration.py
+#
+# Persistent per-device calibration used by Pwm_sine_device to convert sine
+# parameters to device units. A calibration is stored per device and TOP
+# value as a directory of .npy arrays which are memory mapped when first
+# used:
+#
+#   freq_realized.npy - realized frequency in Hz for each commanded
+#                       frequency 0 ... MAX_FREQ_CHZ cHz
+#   freq_order.npy    - commanded frequencies sorted by realized frequency
+#   amp_counts.npy    - amplitude count sent for each nominal count 0 ... TOP
+#   offset_counts.npy - offset count sent for each nominal count 0 ... TOP
+#
+# Missing arrays leave the corresponding conversion uncorrected. The
+# frequency map is usually created by calibrate() from debug readbacks,
+# the count maps from externally measured output levels with fit_counts().
+#
+# Calibrations are stored in the directory given by the SINE_STIM_CAL_DIR
+# environment variable or ~/.sine_stim_cal, e.g.
+#
+#   dev = Pwm_sine_device()
+#   calibration.calibrate(dev)     # once per device
+#   ...
+#   dev.load_calibration()         # later sessions
+#   dev.set_sine_param(0, 0.5, 0, 0.5, 37.3)
+#
+# Requires numpy.
+#
+# William Dickson
+# ---------------------------------------------------------------------------
+import os
+import numpy
+import freq_model
+from atomic import atomic_save
+from constants import MAX_FREQ_CHZ
+
+CAL_DIR_ENV = 'SINE_STIM_CAL_DIR'
+CAL_DIR = '~/.sine_stim_cal'
+
+# Array names
+FREQ_REALIZED = 'freq_realized'
+FREQ_ORDER = 'freq_order'
+AMP_COUNTS = 'amp_counts'
+OFFSET_COUNTS = 'offset_counts'
+
+def calibration_dir():
+    """
+    Returns the directory holding the stored calibrations.
+    """
+    try:
+        return os.environ[CAL_DIR_ENV]
+    except KeyError:
+        return os.path.expanduser(CAL_DIR)
+
+def calibration_id(dev):
+    """
+    Returns the identity under which the calibration of dev is stored: its
+    serial number, or its bus and vendor, product and release numbers, and
+    its TOP value.
+    """
+    if dev.serial:
+        ident = dev.serial
+    elif dev.key is not None:
+        bus = dev.location.split('/')[0]
+        ident = '%s:%s'%(bus, dev.key.split(':',1)[1])
+    else:
+        ident = 'default'
+    ident = '%s_top%d'%(ident, dev.top)
+    return ident.replace('/','_').replace(':','_')
+
+def calibration_path(dev, cal_dir=None):
+    if cal_dir is None:
+        cal_dir = calibration_dir()
+    return os.path.join(cal_dir, calibration_id(dev))
+
+def load_calibration(dev, cal_dir=None):
+    """
+    Returns the stored calibration of dev or None if there is none.
+    """
+    path = calibration_path(dev, cal_dir)
+    if not os.path.isdir(path):
+        return None
+    return Calibration(path, dev.top)
+
+def calibrate(dev, cal_dir=None):
+    """
+    Fits the frequency model of dev to debug readbacks (see
+    freq_model.calibrate), stores the resulting frequency map and returns
+    the calibration. Existing count maps are kept.
+    """
+    model = freq_model.calibrate(dev)
+    cal = Calibration(calibration_path(dev, cal_dir), dev.top)
+    cal.save_freq_map(model.realized_chz(numpy.arange(MAX_FREQ_CHZ + 1)))
+    return cal
+
+def fit_counts(top, counts, levels):
+    """
+    Returns a count map, for use with Calibration.save_count_map, from the
+    output levels (fraction of full scale, increasing) measured with the
+    given counts. Nominal count k is mapped to the count interpolated to
+    produce the level k/top.
+    """
+    counts = numpy.asarray(counts, dtype=float)
+    levels = numpy.asarray(levels, dtype=float)
+    target = numpy.arange(top + 1)/float(top)
+    count_map = numpy.interp(target, levels, counts)
+    return numpy.clip(numpy.floor(count_map + 0.5), 0, top).astype(numpy.uint16)
+
+
+class Calibration:
+
+    def __init__(self, path, top):
+        self.path = path
+        self.top = top
+        self._arrays = {}
+        self._freq_sorted = None
+
+    def freq_chz(self, freq):
+        """
+        Returns the commanded frequency in cHz whose realized frequency is
+        nearest to freq in Hz. Of the commanded frequencies realizing it, the
+        one nearest to freq is returned.
+        """
+        realized = self._array(FREQ_REALIZED)
+        if realized is None:
+            return int(100*freq)
+        order = self._array(FREQ_ORDER)
+        if self._freq_sorted is None:
+            self._freq_sorted = realized[order]
+        freq_sorted = self._freq_sorted
+        i = int(numpy.searchsorted(freq_sorted, freq))
+        i = min(max(i, 1), len(order) - 1)
+        if freq - freq_sorted[i-1] <= freq_sorted[i] - freq:
+            i -= 1
+        # Commanded frequencies, increasing, which realize the same frequency
+        lo = int(numpy.searchsorted(freq_sorted, freq_sorted[i], side='left'))
+        hi = int(numpy.searchsorted(freq_sorted, freq_sorted[i], side='right'))
+        tied = order[lo:hi]
+        j = int(numpy.searchsorted(tied, 100*freq))
+        if j == len(tied) or (j > 0 and 100*freq - tied[j-1] <= tied[j] - 100*freq):
+            j -= 1
+        return int(tied[j])
+
+    def realized_freq(self, freq_chz):
+        """
+        Returns the realized frequency in Hz for a commanded frequency in cHz.
+        """
+        realized = self._array(FREQ_REALIZED)
+        if realized is None:
+            return freq_chz/100.0
+        return float(realized[freq_chz])
+
+    def amp_count(self, count):
+        return self._map_count(AMP_COUNTS, count)
+
+    def offset_count(self, count):
+        return self._map_count(OFFSET_COUNTS, count)
+
+    def save_freq_map(self, realized):
+        """
+        Stores the realized frequency in Hz for each commanded frequency
+        0 ... MAX_FREQ_CHZ cHz.
+        """
+        realized = numpy.asarray(realized, dtype=numpy.float64)
+        if realized.shape != (MAX_FREQ_CHZ + 1,):
+            raise ValueError('freq map must have %d entries'%(MAX_FREQ_CHZ + 1,))
+        self._save(FREQ_REALIZED, realized)
+        self._save(FREQ_ORDER, numpy.argsort(realized, kind='mergesort').astype(numpy.uint16))
+
+    def save_count_map(self, name, counts):
+        """
+        Stores the amplitude (name = 'amp_counts') or offset ('offset_counts')
+        count sent for each nominal count 0 ... TOP.
+        """
+        if not name in (AMP_COUNTS, OFFSET_COUNTS):
+            raise ValueError('unknown count map %s'%(name,))
+        counts = numpy.asarray(counts, dtype=numpy.uint16)
+        if counts.shape != (self.top + 1,):
+            raise ValueError('count map must have %d entries'%(self.top + 1,))
+        self._save(name, counts)
+
+    def _map_count(self, name, count):
+        count_map = self._array(name)
+        if count_map is None or count >= len(count_map):
+            return count
+        return int(count_map[count])
+
+    def _array(self, name):
+        # Memory map array name on first use, None if it is not stored
+        try:
+            return self._arrays[name]
+        except KeyError:
+            pass
+        path = os.path.join(self.path, name + '.npy')
+        if os.path.exists(path):
+            array = numpy.load(path, mmap_mode='r')
+        else:
+            array = None
+        self._arrays[name] = array
+        return array
+
+    def _save(self, name, array):
+        # Save array name, see atomic.atomic_save
+        path = os.path.join(self.path, name + '.npy')
+        atomic_save(path, lambda tmp_path: numpy.save(tmp_path, array))
+        self._arrays.pop(name, None)
+        self._freq_sorted = None
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+#
+# clock.py
+#
+# Correlation of the device's actions with the host clock. The host only
+# knows that a command took effect some time between the start of its bulk
+# write and the arrival of its acknowledgement. Clock_model keeps a running
+# window of the round trip times of exchanges and estimates the host time
+# at which a command acted as
+#
+#   t = write_t + frac*rtt
+#
+# rtt being the median round trip time of the window, clipped to the
+# command's own [write_t, ack_t] bracket. The model is calibrated with
+# repeated USB_CMD_DUMMY exchanges, which the firmware answers without doing
+# anything, and updated with every start and stop. frac may be
+# fitted to action times observed externally with fit_frac, e.g.
+#
+#   model = dev.get_clock_model()
+#   stamp = dev.start(timestamp=True)    # write_t, ack_t and estimated t
+#   stamp = dev.start_at(time.time() + 1.0)
+#
+# William Dickson
+# ---------------------------------------------------------------------------
+import collections
+import time
+from constants import USB_CMD_DUMMY
+
+# Number of round trip times kept by the model
+CLOCK_WINDOW = 64
+
+# Number of exchanges used to calibrate the model
+CLOCK_CAL_COUNT = 32
+
+# Fraction of the round trip time after the start of the write at which the
+# device is taken to act on a command
+CLOCK_FRAC = 0.5
+
+# Time before a deadline spent polling the clock rather than sleeping
+CLOCK_SPIN_T = 0.002
+
+
+class Clock_model:
+    """
+    Keyword arguments:
+
+      window = number of round trip times kept
+      frac   = fraction of the round trip time at which commands act
+    """
+
+    def __init__(self, window=CLOCK_WINDOW, frac=CLOCK_FRAC):
+        self.frac = frac
+        self.rtt_list = collections.deque(maxlen=window)
+        self._rtt = None
+
+    def observe(self, write_t, ack_t):
+        """
+        Adds the round trip time of an exchange written at host time write_t
+        and acknowledged at ack_t.
+        """
+        self.rtt_list.append(ack_t - write_t)
+        self._rtt = None
+
+    def rtt(self):
+        """
+        Returns the median round trip time in seconds, None before any
+        exchange has been observed.
+        """
+        if self._rtt is None and self.rtt_list:
+            rtt_list = sorted(self.rtt_list)
+            self._rtt = rtt_list[len(rtt_list)//2]
+        return self._rtt
+
+    def latency(self):
+        """
+        Returns the estimated time in seconds from the start of a write to the
+        device acting on the command.
+        """
+        rtt = self.rtt()
+        if rtt is None:
+            return 0.0
+        return self.frac*rtt
+
+    def estimate(self, write_t, ack_t):
+        """
+        Returns the estimated host time at which a command written at
+        write_t and acknowledged at ack_t acted.
+        """
+        if self.rtt() is None:
+            return 0.5*(write_t + ack_t)
+        return min(ack_t, write_t + self.latency())
+
+    def timestamp(self, write_t, ack_t):
+        """
+        Returns the timestamp dictionary of a command: the host times before
+        the write ('write_t') and after the acknowledgement ('ack_t') and the
+        estimated time at which the command acted ('t'). The exchange is then
+        added to the model.
+        """
+        stamp = {'write_t': write_t, 'ack_t': ack_t, 't': self.estimate(write_t, ack_t)}
+        self.observe(write_t, ack_t)
+        return stamp
+
+    def fit_frac(self, stamp_list, t_list):
+        """
+        Sets frac from timestamp dictionaries of commands and the host times
+        t_list at which they were observed to act by an external reference
+        (e.g. a camera frame or a scope trace). Returns the new frac.
+        """
+        frac_list = sorted([min(1.0, max(0.0, (t - stamp['write_t'])/(stamp['ack_t'] - stamp['write_t'])))
+                            for stamp, t in zip(stamp_list, t_list)
+                            if stamp['ack_t'] > stamp['write_t']])
+        if frac_list:
+            self.frac = frac_list[len(frac_list)//2]
+        return self.frac
+
+
+def calibrate(dev, model, count=CLOCK_CAL_COUNT):
+    """
+    Adds the round trip times of count USB_CMD_DUMMY exchanges with dev to
+    model.
+    """
+    for i in range(count):
+        write_t = time.time()
+        dev._exchange(USB_CMD_DUMMY)
+        model.observe(write_t, time.time())
+    return model
+
+def sleep_until(t, spin_t=CLOCK_SPIN_T):
+    """
+    Sleeps until host time t, polling the clock for the last spin_t seconds.
+    """
+    while True:
+        dt = t - time.time()
+        if dt <= 0:
+            return
+        if dt > spin_t:
+            time.sleep(dt - spin_t)
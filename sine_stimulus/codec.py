@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#
+# codec.py
+#
+# Packet codec for the at90usb sinewave stimulus generator. Every command
+# and reply is a USB_BUFFER_SIZE byte packet with the command id in the
+# first byte followed by big-endian 8/16 bit fields. The layouts are held in
+# tables of precompiled struct.Struct objects, one per USB_CMD_* opcode, so
+# that a packet is packed or unpacked in a single call.
+#
+# William Dickson
+# ---------------------------------------------------------------------------
+import struct
+from constants import (USB_BUFFER_SIZE, USB_CMD_START, USB_CMD_STOP,
+                       USB_CMD_SET_SINE_PARAM, USB_CMD_SET_MAX_CYCLE,
+                       USB_CMD_GET_STATUS, USB_CMD_GET_SINE_PARAM,
+                       USB_CMD_GET_MAX_CYCLE, USB_CMD_GET_TOP,
+                       USB_CMD_DFU_MODE, USB_CMD_DC_MODE_ON,
+                       USB_CMD_DC_MODE_OFF, USB_CMD_SET_DC_VAL,
+                       USB_CMD_GET_DC_MODE, USB_CMD_GET_DC_VAL,
+                       USB_CMD_DEBUG, USB_CMD_DUMMY)
+
+def _layout(fields):
+    """
+    Returns a precompiled struct for a packet with a command id byte followed
+    by the given fields, zero padded to USB_BUFFER_SIZE bytes.
+    """
+    fmt = '>B' + fields
+    pad = USB_BUFFER_SIZE - struct.calcsize(fmt)
+    if pad > 0:
+        fmt += '%dx'%(pad,)
+    return struct.Struct(fmt)
+
+# Command id byte at the start of every packet
+CMD_ID = struct.Struct('>B')
+
+# Packet layouts
+CMD_ONLY = _layout('')
+CMD_CHAN = _layout('B')
+CMD_U8 = _layout('B')
+CMD_U16 = _layout('H')
+CMD_CHAN_U16 = _layout('BH')
+CMD_SINE_PARAM = _layout('BHHHH')
+CMD_DEBUG_VALS = _layout('6H')
+
+# Command packet layouts by command id. Fields following the command id:
+#
+#   set_sine_param  - chan, amp, phase, offset, freq
+#   set_max_cycle   - max_cycle
+#   get_sine_param  - chan
+#   set_dc_val      - chan, val
+#   get_dc_val      - chan
+#
+COMMAND_TABLE = {
+    USB_CMD_START: CMD_ONLY,
+    USB_CMD_STOP: CMD_ONLY,
+    USB_CMD_SET_SINE_PARAM: CMD_SINE_PARAM,
+    USB_CMD_SET_MAX_CYCLE: CMD_U16,
+    USB_CMD_GET_STATUS: CMD_ONLY,
+    USB_CMD_GET_SINE_PARAM: CMD_CHAN,
+    USB_CMD_GET_MAX_CYCLE: CMD_ONLY,
+    USB_CMD_GET_TOP: CMD_ONLY,
+    USB_CMD_DFU_MODE: CMD_ONLY,
+    USB_CMD_DC_MODE_ON: CMD_ONLY,
+    USB_CMD_DC_MODE_OFF: CMD_ONLY,
+    USB_CMD_SET_DC_VAL: CMD_CHAN_U16,
+    USB_CMD_GET_DC_MODE: CMD_ONLY,
+    USB_CMD_GET_DC_VAL: CMD_CHAN,
+    USB_CMD_DEBUG: CMD_ONLY,
+    USB_CMD_DUMMY: CMD_ONLY,
+}
+
+# Reply packet layouts by command id. Fields following the command id:
+#
+#   get_status      - status
+#   get_sine_param  - chan, amp, phase, offset, freq
+#   get_max_cycle   - max_cycle
+#   get_top         - top
+#   get_dc_mode     - dc mode
+#   get_dc_val      - chan, val
+#   debug           - 6 debug values
+#
+REPLY_TABLE = {
+    USB_CMD_START: CMD_ONLY,
+    USB_CMD_STOP: CMD_ONLY,
+    USB_CMD_SET_SINE_PARAM: CMD_ONLY,
+    USB_CMD_SET_MAX_CYCLE: CMD_ONLY,
+    USB_CMD_GET_STATUS: CMD_U8,
+    USB_CMD_GET_SINE_PARAM: CMD_SINE_PARAM,
+    USB_CMD_GET_MAX_CYCLE: CMD_U16,
+    USB_CMD_GET_TOP: CMD_U16,
+    USB_CMD_DC_MODE_ON: CMD_ONLY,
+    USB_CMD_DC_MODE_OFF: CMD_ONLY,
+    USB_CMD_SET_DC_VAL: CMD_ONLY,
+    USB_CMD_GET_DC_MODE: CMD_U8,
+    USB_CMD_GET_DC_VAL: CMD_CHAN_U16,
+    USB_CMD_DEBUG: CMD_DEBUG_VALS,
+    USB_CMD_DUMMY: CMD_ONLY,
+}
+
+def encode(cmd_id, *args):
+    """
+    Returns the command packet for cmd_id with the given fields as a string.
+    """
+    return COMMAND_TABLE[cmd_id].pack(cmd_id, *args)
+
+def encode_into(buf, cmd_id, *args):
+    """
+    Packs the command packet for cmd_id with the given fields into the
+    writable buffer buf.
+    """
+    COMMAND_TABLE[cmd_id].pack_into(buf, 0, cmd_id, *args)
+
+def decode(cmd_id, data):
+    """
+    Unpacks the reply packet data to command cmd_id. Returns a tuple of the
+    received command id followed by the reply fields.
+    """
+    return REPLY_TABLE[cmd_id].unpack_from(data)
+
+def decode_command(data):
+    """
+    Unpacks a command packet. Returns a tuple of the command id followed by
+    the command fields.
+    """
+    return COMMAND_TABLE[CMD_ID.unpack_from(data)[0]].unpack_from(data)
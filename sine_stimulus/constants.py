@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+#
+# constants.py
+#
+# USB parameters, command ids and device constants for the at90usb sinewave
+# stimulus generator. These are shared by the device interface, the packet
+# codec and the simulator.
+#
+# William Dickson
+# ---------------------------------------------------------------------------
+
+# USB params
+USB_VENDOR_ID = 0x1781 
+USB_PRODUCT_ID = 0x0BB0
+USB_BULKOUT_EP_ADDRESS = 0x06
+USB_BULKIN_EP_ADDRESS = 0x82
+USB_BUFFER_SIZE = 16
+
+# USB Command ids
+USB_CMD_START = 0
+USB_CMD_STOP = 1
+USB_CMD_SET_SINE_PARAM = 2
+USB_CMD_SET_MAX_CYCLE = 3
+USB_CMD_GET_STATUS = 4
+USB_CMD_GET_SINE_PARAM = 5
+USB_CMD_GET_MAX_CYCLE = 6
+USB_CMD_GET_TOP = 7
+USB_CMD_DFU_MODE = 8
+
+USB_CMD_DC_MODE_ON = 9
+USB_CMD_DC_MODE_OFF = 10
+USB_CMD_SET_DC_VAL = 11
+USB_CMD_GET_DC_MODE = 12
+USB_CMD_GET_DC_VAL = 13
+USB_CMD_DEBUG = 254
+USB_CMD_DUMMY = 255
+
+# Constants
+RUNNING = 1
+STOPPED = 0
+WAIT_SLEEP_T = 0.1
+WAIT_POLL_T = 0.002
+WAIT_GUARD_T = 0.01
+WAIT_GUARD_FRAC = 0.02
+PIPELINE_DEPTH = 2
+
+# Frequency generation. Frequencies are sent in cHz. The firmware steps
+# through a sine table of SINE_TABLE_SIZE entries at the pwm frequency
+# divided by an integer divisor.
+MAX_FREQ_CHZ = 20000
+PWM_FREQ = 1.0e4
+SINE_TABLE_SIZE = 256
+
+# Largest value of a 16 bit command field
+MAX_U16 = 0xffff
+
+# Retry policy defaults, timeouts in ms
+RETRY_MAX_ATTEMPTS = 5
+RETRY_DEADLINE = 5.0
+RETRY_MIN_TIMEOUT = 20
+RETRY_MAX_TIMEOUT = 1000
+RETRY_INITIAL_TIMEOUT = 1000
+DC_MODE_OFF = 0
+DC_MODE_ON = 1
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+#
+# device_group.py
+#
+# Control of several sinewave stimulus generators attached to the same
+# host. PwmSineDeviceGroup opens every matching device, addresses them by
+# serial number or bus/device location, runs commands on all of them
+# concurrently from a thread pool and starts them together with minimal
+# skew, e.g.
+#
+#   group = PwmSineDeviceGroup()
+#   group.configure({
+#       'SN0001': {'max_cycle': 5, 'sine_params': [(0,0.5,0,0.5,1.0)]},
+#       '002/007': {'max_cycle': 5, 'sine_params': [(0,0.5,90,0.5,1.0)]},
+#       })
+#   report = group.start()
+#   group.wait()
+#   group.close()
+#
+# Requires concurrent.futures (the futures backport on python 2).
+#
+# William Dickson
+# ---------------------------------------------------------------------------
+import math
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sine_stimulus import Pwm_sine_device, find_device_locations
+
+# Time allowed for the start threads to reach the start gate
+START_GATE_T = 0.05
+
+
+class PwmSineDeviceGroup:
+    """
+    Group of all attached stimulus generators. Devices are keyed by serial
+    number when the device reports one and otherwise by bus/device location.
+
+    Keyword arguments:
+
+      backend   = usb backend, see Pwm_sine_device
+      keys      = serial numbers or locations of the devices to open, all
+                  attached devices are opened if None
+      shadow    = enable shadow registers on each device
+      fast_open = use the fast open path on each device
+    """
+
+    def __init__(self, backend=None, keys=None, shadow=False, fast_open=False):
+        self.devices = {}
+        self.location_to_key = {}
+        try:
+            for location in find_device_locations(backend):
+                dev = Pwm_sine_device(backend=backend, shadow=shadow,
+                                      fast_open=fast_open, location=location)
+                if dev.serial:
+                    key = dev.serial
+                else:
+                    key = location
+                if keys is not None and not (key in keys or location in keys):
+                    dev.close()
+                    continue
+                self.devices[key] = dev
+                self.location_to_key[location] = key
+        except:
+            # Close the devices already opened before re-raising
+            exc_info = sys.exc_info()
+            for dev in self.devices.values():
+                try:
+                    dev.close()
+                except Exception:
+                    pass
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if not self.devices:
+            raise RuntimeError("Cannot find device.")
+        self.executor = ThreadPoolExecutor(max_workers=len(self.devices))
+        # Start skew (seconds) of every group start
+        self.skew_list = []
+
+    def keys(self):
+        return sorted(self.devices.keys())
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __getitem__(self, key):
+        """
+        Returns the device with serial number or bus/device location key.
+        """
+        try:
+            return self.devices[key]
+        except KeyError:
+            return self.devices[self.location_to_key[key]]
+
+    def map(self, func, keys=None):
+        """
+        Calls func(dev) for each device concurrently. Returns a dictionary of
+        the results by device key. The first exception raised by a call is
+        re-raised after all calls have finished.
+        """
+        if keys is None:
+            keys = self.keys()
+        future_dict = {}
+        for key in keys:
+            future_dict[key] = self.executor.submit(func, self[key])
+        results = {}
+        error = None
+        for key in keys:
+            try:
+                results[key] = future_dict[key].result()
+            except Exception, e:
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+        return results
+
+    def configure(self, config_dict):
+        """
+        Configures several devices concurrently. config_dict maps device keys
+        to dictionaries of Pwm_sine_device.configure keyword arguments
+        (max_cycle and sine_params).
+        """
+        kwargs_dict = {}
+        for key, kwargs in config_dict.items():
+            kwargs_dict[self._key_of(self[key])] = kwargs
+        def configure_dev(dev):
+            dev.configure(**kwargs_dict[self._key_of(dev)])
+        self.map(configure_dev, kwargs_dict.keys())
+
+    def set_sine_param(self, pwm_chan, amp, phase, offset, freq):
+        """
+        Sets the same sinewave parameters on every device.
+        """
+        self.map(lambda dev: dev.set_sine_param(pwm_chan, amp, phase, offset, freq))
+
+    def set_max_cycle(self, num):
+        self.map(lambda dev: dev.set_max_cycle(num))
+
+    def get_status(self):
+        return self.map(lambda dev: dev.get_status())
+
+    def stop(self):
+        self.map(lambda dev: dev.stop())
+
+    def start(self):
+        """
+        Starts all devices together, one thread per device, released by a
+        shared event, calling Pwm_sine_device.start. Returns a dictionary
+        with the host times, by device key, before each device's start
+        write ('write_t'), after its acknowledgement ('ack_t') and at which
+        it is estimated to have started ('t'), see
+        Pwm_sine_device.get_clock_model, and the start skew ('skew'), the
+        spread of the estimated start times in seconds.
+        """
+        gate = threading.Event()
+        keys = self.keys()
+
+        def start_dev(dev):
+            gate.wait()
+            return dev.start(timestamp=True)
+
+        future_dict = {}
+        for key in keys:
+            future_dict[key] = self.executor.submit(start_dev, self.devices[key])
+        time.sleep(START_GATE_T)
+        gate.set()
+        report = {'write_t': {}, 'ack_t': {}, 't': {}}
+        for key in keys:
+            stamp = future_dict[key].result()
+            for name in ('write_t', 'ack_t', 't'):
+                report[name][key] = stamp[name]
+        skew = max(report['t'].values()) - min(report['t'].values())
+        self.skew_list.append(skew)
+        report['skew'] = skew
+        return report
+
+    def skew_stats(self):
+        """
+        Returns the number, mean, standard deviation and maximum of the start
+        skews measured so far, in seconds.
+        """
+        n = len(self.skew_list)
+        if n == 0:
+            return {'n': 0, 'mean': 0.0, 'std': 0.0, 'max': 0.0}
+        mean = sum(self.skew_list)/n
+        var = sum([(x - mean)**2 for x in self.skew_list])/n
+        return {'n': n, 'mean': mean, 'std': math.sqrt(var), 'max': max(self.skew_list)}
+
+    def wait(self, predict=False, timeout=None):
+        """
+        Waits until every device has stopped running. See Pwm_sine_device.wait
+        for the arguments. Returns a dictionary of the devices' wait results.
+        """
+        return self.map(lambda dev: dev.wait(predict=predict, timeout=timeout))
+
+    def close(self):
+        self.map(lambda dev: dev.close())
+        self.executor.shutdown()
+
+    def _key_of(self, dev):
+        return self.location_to_key[dev.location]
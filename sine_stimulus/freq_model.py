@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+#
+# freq_model.py
+#
+# Model of the frequency quantization of the sinewave stimulus generator.
+# A commanded frequency, sent in integer cHz, is realized by stepping
+# through the firmware's sine table of table_size entries, advancing one
+# step every div pwm periods, so that the output frequency is
+#
+#   f_true = pwm_freq/(div*steps)
+#
+# which is what examples/test_freqs.py measures from the debug values. The
+# model evaluates this for whole arrays of frequencies with numpy and keeps
+# a sorted index of every achievable frequency so that sweeps can be
+# planned, and frequencies snapped to realizable values, without talking to
+# the device, e.g.
+#
+#   model = Freq_model(dev.top)
+#   f_true = model.realized(numpy.linspace(0.01, 200.0, 400))
+#   freq_chz, f_true = model.nearest(37.3)
+#
+# calibrate fits the pwm frequency and table size to a few debug readbacks
+# from the device.
+#
+# Requires numpy.
+#
+# William Dickson
+# ---------------------------------------------------------------------------
+import numpy
+from constants import (USB_CMD_GET_SINE_PARAM, USB_CMD_SET_SINE_PARAM,
+                       MAX_FREQ_CHZ, PWM_FREQ, SINE_TABLE_SIZE)
+
+# Commanded frequencies (cHz) read back by calibrate. The lowest frequency
+# uses the whole sine table, the others constrain the pwm frequency.
+CAL_FREQ_CHZ = [1, 5000, 7700, 12300, 19900]
+
+
+class Freq_model:
+    """
+    Keyword arguments:
+
+      top        = device TOP value
+      pwm_freq   = pwm frequency in Hz
+      table_size = number of entries in the firmware's sine table
+    """
+
+    def __init__(self, top, pwm_freq=PWM_FREQ, table_size=SINE_TABLE_SIZE):
+        self.top = top
+        self.pwm_freq = float(pwm_freq)
+        self.table_size = int(table_size)
+        # (freq_chz, div, steps) debug readings the model was fitted to
+        self.readings = []
+        self._index = None
+
+    def freq_chz(self, freq):
+        """
+        Returns the commanded frequency in cHz for freq in Hz, converted as
+        Pwm_sine_device.set_sine_param does.
+        """
+        return (100*numpy.asarray(freq, dtype=float)).astype(int)
+
+    def divisors(self, freq_chz):
+        """
+        Returns arrays of the pwm periods per table step (div) and the table
+        steps per cycle (steps) for commanded frequencies in cHz. Both are 0
+        for a frequency of 0.
+        """
+        f = numpy.asarray(freq_chz, dtype=float)/100.0
+        on = f > 0
+        f = numpy.where(on, f, 1.0)
+        steps = numpy.clip(numpy.floor(self.pwm_freq/f), 1, self.table_size)
+        div = numpy.maximum(1, numpy.floor(self.pwm_freq/(f*steps) + 0.5))
+        steps = numpy.where(on, steps, 0).astype(int)
+        div = numpy.where(on, div, 0).astype(int)
+        return div, steps
+
+    def realized_chz(self, freq_chz):
+        """
+        Returns the realized frequency in Hz for commanded frequencies in cHz.
+        """
+        div, steps = self.divisors(freq_chz)
+        period = div*steps
+        return numpy.where(period > 0, self.pwm_freq/numpy.maximum(period, 1), 0.0)
+
+    def realized(self, freq):
+        """
+        Returns the realized frequency in Hz for commanded frequencies in Hz.
+        """
+        return self.realized_chz(self.freq_chz(freq))
+
+    def rel_error(self, freq):
+        """
+        Returns the relative error of the realized frequency for commanded
+        frequencies in Hz, 0 where freq is 0.
+        """
+        freq = numpy.asarray(freq, dtype=float)
+        err = numpy.abs(self.realized(freq) - freq)
+        return numpy.where(freq > 0, err/numpy.where(freq > 0, freq, 1.0), 0.0)
+
+    def index(self):
+        """
+        Returns the sorted array of achievable frequencies in Hz and the array
+        of the lowest commanded frequency in cHz which realizes each.
+        """
+        if self._index is None:
+            freq_chz = numpy.arange(MAX_FREQ_CHZ + 1)
+            freqs, first = numpy.unique(self.realized_chz(freq_chz), return_index=True)
+            self._index = freqs, freq_chz[first]
+        return self._index
+
+    def nearest(self, freq):
+        """
+        Returns the commanded frequency in cHz realizing the achievable
+        frequency nearest to each freq in Hz, and that frequency in Hz.
+        """
+        freqs, freq_chz = self.index()
+        freq = numpy.asarray(freq, dtype=float)
+        i = numpy.clip(numpy.searchsorted(freqs, freq), 1, len(freqs) - 1)
+        i = numpy.where(freq - freqs[i-1] <= freqs[i] - freq, i - 1, i)
+        return freq_chz[i], freqs[i]
+
+    def check(self, readings):
+        """
+        Returns the number of (freq_chz, div, steps) debug readings which the
+        model does not reproduce.
+        """
+        freq_chz, div, steps = numpy.asarray(readings, dtype=int).T
+        model_div, model_steps = self.divisors(freq_chz)
+        return int(numpy.sum((model_div != div) | (model_steps != steps)))
+
+
+def fit(top, readings, pwm_freq=PWM_FREQ):
+    """
+    Returns a Freq_model fitted to a list of (freq_chz, div, steps) debug
+    readings. The table size is the largest step count read, so readings
+    should include a low frequency. The pwm frequency is kept at pwm_freq
+    if it is consistent with the readings.
+    """
+    freq_chz, div, steps = numpy.asarray(readings, dtype=float).T
+    f = freq_chz/100.0
+    table_size = int(steps.max())
+    # Below the table size steps = floor(pwm_freq/f), which bounds pwm_freq
+    free = (steps > 0) & (steps < table_size)
+    if free.any():
+        lo = (steps[free]*f[free]).max()
+        hi = ((steps[free] + 1)*f[free]).min()
+        if lo < hi:
+            pwm_freq = min(max(pwm_freq, lo), hi)
+        else:
+            pwm_freq = numpy.median(f[free]*div[free]*steps[free])
+    model = Freq_model(top, pwm_freq, table_size)
+    model.readings = [tuple(r) for r in readings]
+    return model
+
+def calibrate(dev, freq_list=CAL_FREQ_CHZ):
+    """
+    Returns a Freq_model fitted to the debug values read from the device
+    for each commanded frequency in freq_list (cHz). Uses channel 0, whose
+    parameters are restored afterwards. The device should not be running.
+    Raises IOError if the fitted model does not reproduce every reading,
+    i.e. the firmware does not divide frequencies as the model assumes.
+    """
+    saved = dev._command(USB_CMD_GET_SINE_PARAM, 0)[1:]
+    readings = []
+    try:
+        for freq_chz in freq_list:
+            dev._command(USB_CMD_SET_SINE_PARAM, 0, saved[1], saved[2], saved[3], freq_chz)
+            vals = dev.get_debug_vals()
+            readings.append((freq_chz, vals[0], vals[3]))
+    finally:
+        dev._command(USB_CMD_SET_SINE_PARAM, *saved)
+    model = fit(dev.top, readings)
+    n_bad = model.check(readings)
+    if n_bad:
+        raise IOError('frequency model disagrees with %d of %d debug readings'%(n_bad, len(readings)))
+    return model
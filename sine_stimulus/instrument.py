@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+#
+# instrument.py
+#
+# Per-command instrumentation of the usb exchanges with the sinewave
+# stimulus generator. Records, for each USB_CMD_* opcode, the number of
+# exchanges, attempts, timeouts and stale replies and histograms of the
+# time spent in the bulk-out write, the bulk-in read, the whole exchange
+# and, for exchanges which needed them, the retries after the first attempt
+# failed. Trace callbacks may be registered to receive every exchange as it
+# completes.
+#
+# Instrumentation is off unless enabled with Pwm_sine_device(instrument=True)
+# in which case the device's instrument attribute holds an Instrumentation
+# object. When it is off the exchange path only tests that attribute.
+#
+# William Dickson
+# ---------------------------------------------------------------------------
+import math
+import constants
+
+# Histogram bin upper edges in seconds, 1us to ~4s in powers of 2
+HIST_EDGES = [1.0e-6*2**k for k in range(23)]
+
+# Command names by id, e.g. USB_CMD_GET_STATUS -> 'get_status'
+CMD_NAMES = dict([(val, name[len('USB_CMD_'):].lower())
+                  for name, val in vars(constants).items()
+                  if name.startswith('USB_CMD_')])
+
+# Exchange phases
+PHASES = ('write', 'read', 'total', 'retry')
+
+
+def cmd_name(cmd_id):
+    return CMD_NAMES.get(cmd_id, 'cmd_%d'%(cmd_id,))
+
+
+class Histogram:
+    """
+    Log binned histogram of durations in seconds.
+    """
+
+    def __init__(self):
+        self.bins = [0]*(len(HIST_EDGES) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, t):
+        # Bin index from the base 2 exponent of t in us
+        if t <= HIST_EDGES[0]:
+            i = 0
+        else:
+            i = min(len(HIST_EDGES), int(math.ceil(math.log(t/HIST_EDGES[0], 2))))
+        self.bins[i] += 1
+        self.count += 1
+        self.sum += t
+        if self.min is None or t < self.min:
+            self.min = t
+        if self.max is None or t > self.max:
+            self.max = t
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.sum/self.count
+
+    def percentile(self, p):
+        """
+        Returns the upper edge of the bin holding the p-th percentile,
+        limited to the largest value seen.
+        """
+        if self.count == 0:
+            return 0.0
+        n = 0
+        for i, c in enumerate(self.bins):
+            n += c
+            if n >= 0.01*p*self.count:
+                break
+        if i < len(HIST_EDGES):
+            return min(HIST_EDGES[i], self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.mean(),
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'bins': list(self.bins),
+            }
+
+
+class Cmd_stats:
+    """
+    Counters and phase histograms for one opcode.
+    """
+
+    def __init__(self):
+        self.exchanges = 0
+        self.attempts = 0
+        self.timeouts = 0
+        self.stale = 0
+        self.failures = 0
+        self.hist = dict([(phase, Histogram()) for phase in PHASES])
+
+    def as_dict(self):
+        return {
+            'exchanges': self.exchanges,
+            'attempts': self.attempts,
+            'retries': self.attempts - self.exchanges,
+            'timeouts': self.timeouts,
+            'stale': self.stale,
+            'failures': self.failures,
+            'write': self.hist['write'].as_dict(),
+            'read': self.hist['read'].as_dict(),
+            'total': self.hist['total'].as_dict(),
+            'retry': self.hist['retry'].as_dict(),
+            }
+
+
+class Instrumentation:
+
+    def __init__(self):
+        self.cmd_stats = {}
+        self.callbacks = []
+
+    def add_callback(self, func):
+        """
+        Registers func to be called with a dictionary describing each
+        exchange: cmd_id, name, attempts, timeouts, stale, ok and the write,
+        read, total and retry times in seconds.
+        """
+        self.callbacks.append(func)
+
+    def remove_callback(self, func):
+        self.callbacks.remove(func)
+
+    def record(self, cmd_id, write_t, read_t, total_t, attempts=1, timeouts=0,
+               stale=0, ok=True, retry_t=0.0):
+        """
+        Records one exchange of command cmd_id. write_t and read_t are the
+        times spent writing and reading summed over all attempts and retry_t
+        the time from the failure of the first attempt to the end of the
+        exchange, added to the retry histogram when attempts > 1.
+        """
+        try:
+            stats = self.cmd_stats[cmd_id]
+        except KeyError:
+            stats = self.cmd_stats[cmd_id] = Cmd_stats()
+        stats.exchanges += 1
+        stats.attempts += attempts
+        stats.timeouts += timeouts
+        stats.stale += stale
+        if not ok:
+            stats.failures += 1
+        stats.hist['write'].add(write_t)
+        stats.hist['read'].add(read_t)
+        stats.hist['total'].add(total_t)
+        if attempts > 1:
+            stats.hist['retry'].add(retry_t)
+        if self.callbacks:
+            event = {
+                'cmd_id': cmd_id,
+                'name': cmd_name(cmd_id),
+                'attempts': attempts,
+                'timeouts': timeouts,
+                'stale': stale,
+                'ok': ok,
+                'write_t': write_t,
+                'read_t': read_t,
+                'total_t': total_t,
+                'retry_t': retry_t,
+                }
+            for func in self.callbacks:
+                func(event)
+
+    def reset(self):
+        self.cmd_stats = {}
+
+    def as_dict(self):
+        """
+        Returns the statistics of all opcodes keyed by command name.
+        """
+        return dict([(cmd_name(cmd_id), stats.as_dict())
+                     for cmd_id, stats in self.cmd_stats.items()])
+
+    def report(self):
+        """
+        Returns a text table of the statistics, times in ms.
+        """
+        lines = []
+        lines.append('%-16s %6s %6s %6s %6s %8s %8s %8s %8s %8s %8s'%(
+            'command', 'n', 'retry', 'tmout', 'stale', 'write', 'read',
+            'mean', 'p50', 'p99', 'rtry_t'))
+        lines.append('-'*101)
+        for cmd_id in sorted(self.cmd_stats.keys()):
+            stats = self.cmd_stats[cmd_id]
+            total = stats.hist['total']
+            lines.append('%-16s %6d %6d %6d %6d %8.3f %8.3f %8.3f %8.3f %8.3f %8.3f'%(
+                cmd_name(cmd_id), stats.exchanges, stats.attempts - stats.exchanges,
+                stats.timeouts, stats.stale, 1.0e3*stats.hist['write'].mean(),
+                1.0e3*stats.hist['read'].mean(), 1.0e3*total.mean(),
+                1.0e3*total.percentile(50), 1.0e3*total.percentile(99),
+                1.0e3*stats.hist['retry'].mean()))
+        return '\n'.join(lines)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#
+# monitor.py
+#
+# Connection health monitoring for the sinewave stimulus generator. A
+# Monitored_pwm_sine_device wraps a Pwm_sine_device so that a replugged or
+# reset device does not take the rig down. A background thread sends a
+# keep-alive (USB_CMD_DUMMY) whenever the device has been idle for
+# interval seconds and, when the usb link fails during an exchange or a
+# keep-alive (a Link_error: no reply within the retry budget or a failed
+# transfer on a stale handle), the device is re-enumerated and reopened
+# (Pwm_sine_device.reopen) and its last known configuration - sine
+# parameters, max_cycle, dc mode and dc values - is restored. A call which
+# failed is then repeated once, so that callers do not see the failure.
+# Other errors, such as a wait timeout, are raised as usual, e.g.
+#
+#   dev = Monitored_pwm_sine_device(callback=report)
+#   dev.set_sine_param(0, 0.5, 0, 0.5, 2.0)   # as with Pwm_sine_device
+#   ...
+#   print dev.events                        # reconnects and recovery times
+#
+# The configuration is tracked in device units with the shadow registers,
+# which are enabled on the monitored device. A run in progress when the
+# device was lost is not restarted. All device access goes through a lock,
+# so the wrapper may be used from several threads.
+#
+# William Dickson
+# ---------------------------------------------------------------------------
+import threading
+import time
+import codec
+from shadow import Shadow_registers
+from sine_stimulus import (Pwm_sine_device, Link_error, USB_CMD_DUMMY,
+                           _check_cmd_id)
+
+# Idle time in seconds after which a keep-alive is sent
+MONITOR_INTERVAL = 0.5
+
+# Read timeout in ms of a keep-alive exchange
+MONITOR_KEEPALIVE_TIMEOUT = 50
+
+# Time in seconds between reopen attempts and max time spent reconnecting
+MONITOR_RETRY_T = 0.05
+MONITOR_RECONNECT_T = 10.0
+
+# Number of channels
+MONITOR_NUM_CHAN = 3
+
+
+class Monitored_pwm_sine_device:
+    """
+    Keyword arguments:
+
+      dev       = an open Pwm_sine_device to monitor, otherwise the device is
+                  opened with the remaining keyword arguments (see
+                  Pwm_sine_device)
+      interval  = idle time in seconds before a keep-alive is sent, None
+                  disables the keep-alive thread
+      callback  = called, from the thread which detected the failure, with
+                  each reconnect event
+    """
+
+    def __init__(self, dev=None, interval=MONITOR_INTERVAL, callback=None, **kwargs):
+        if dev is None:
+            dev = Pwm_sine_device(**kwargs)
+        if dev.shadow is None:
+            dev.shadow = Shadow_registers()
+        self.dev = dev
+        self.interval = interval
+        self.callback = callback
+        self.lock = threading.RLock()
+        # Reconnect events, dictionaries of the time of the failure, the
+        # error, the number of reopen attempts and the recovery time
+        self.events = []
+        self.keepalive_count = 0
+        self.last_io_t = time.time()
+        # Read every register into the shadow and keep a copy of the last
+        # known configuration
+        for i in range(MONITOR_NUM_CHAN):
+            dev.get_sine_param(i)
+            dev.get_dc_val(i)
+        dev.get_max_cycle()
+        dev.get_dc_mode()
+        self.config = dict(dev.shadow.regs)
+        self.stop_event = threading.Event()
+        self.thread = None
+        if interval is not None:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def __getattr__(self, name):
+        attr = getattr(self.dev, name)
+        if not callable(attr) or name.startswith('_'):
+            return attr
+        def call(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+        return call
+
+    def call(self, name, *args, **kwargs):
+        """
+        Calls the Pwm_sine_device method name. If the link fails the device
+        is reconnected and the call repeated once. Other errors are raised
+        to the caller.
+        """
+        self.lock.acquire()
+        try:
+            try:
+                result = getattr(self.dev, name)(*args, **kwargs)
+            except Link_error, e:
+                self.reconnect(e)
+                result = getattr(self.dev, name)(*args, **kwargs)
+            self.last_io_t = time.time()
+            self.config = dict(self.dev.shadow.regs)
+            return result
+        finally:
+            self.lock.release()
+
+    def keepalive(self):
+        """
+        Sends a keep-alive, reconnecting if it fails. Returns True if the
+        device answered.
+        """
+        self.lock.acquire()
+        try:
+            try:
+                self._keepalive()
+                return True
+            except Link_error, e:
+                self.reconnect(e)
+                return False
+        finally:
+            self.lock.release()
+
+    def reconnect(self, error=None):
+        """
+        Reopens the device, retrying every MONITOR_RETRY_T seconds for up to
+        MONITOR_RECONNECT_T seconds, and restores its configuration. Returns
+        the reconnect event. Raises IOError if the device does not come back.
+        """
+        self.lock.acquire()
+        try:
+            dev = self.dev
+            fail_t = time.time()
+            attempts = 0
+            while True:
+                attempts += 1
+                try:
+                    dev.reopen()
+                    dev._set_commands(dev.shadow.write_commands(self.config))
+                    break
+                except (IOError, RuntimeError), e:
+                    if time.time() - fail_t > MONITOR_RECONNECT_T:
+                        raise IOError('device lost: %s'%(e,))
+                    time.sleep(MONITOR_RETRY_T)
+            self.last_io_t = time.time()
+            event = {
+                't': fail_t,
+                'error': str(error),
+                'attempts': attempts,
+                'recovery_t': self.last_io_t - fail_t,
+                }
+            self.events.append(event)
+        finally:
+            self.lock.release()
+        if self.callback is not None:
+            self.callback(event)
+        return event
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.lock.acquire()
+        try:
+            self.dev.close()
+        finally:
+            self.lock.release()
+
+    def _keepalive(self):
+        dev = self.dev
+        codec.encode_into(dev.output_data, USB_CMD_DUMMY)
+        data = dev._send_and_receive(in_timeout=MONITOR_KEEPALIVE_TIMEOUT)
+        _check_cmd_id(USB_CMD_DUMMY, codec.decode(USB_CMD_DUMMY, data)[0])
+        self.keepalive_count += 1
+        self.last_io_t = time.time()
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            idle_t = time.time() - self.last_io_t
+            if idle_t < self.interval:
+                self.stop_event.wait(self.interval - idle_t)
+                continue
+            try:
+                self.keepalive()
+            except IOError:
+                # Reconnecting failed, keep trying on the next keep-alive
+                pass
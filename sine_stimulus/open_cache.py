@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+#
+# open_cache.py
+#
+# Cache of per-device open information used by the fast open path of
+# Pwm_sine_device. Entries are keyed by the device's bus directory and
+# device file name together with its vendor, product and release numbers.
+# The device file name changes whenever the device is replugged, reset or
+# re-enumerated (e.g. after dfu mode) so such an event invalidates the
+# entry. An entry holds the device's TOP value and its existence means the
+# usb link has already been warmed up by the dummy exchange.
+#
+# The cache is stored as json in the file given by the SINE_STIM_OPEN_CACHE
+# environment variable or ~/.sine_stim_open_cache.
+#
+# William Dickson
+# ---------------------------------------------------------------------------
+import os
+import json
+from atomic import atomic_save
+
+OPEN_CACHE_ENV = 'SINE_STIM_OPEN_CACHE'
+OPEN_CACHE_FILE = '~/.sine_stim_open_cache'
+
+def open_cache_path():
+    """
+    Returns the path of the open cache file.
+    """
+    try:
+        return os.environ[OPEN_CACHE_ENV]
+    except KeyError:
+        return os.path.expanduser(OPEN_CACHE_FILE)
+
+def device_location(bus, dev):
+    """
+    Returns the bus/device location string of usb device dev on bus or None
+    if the backend does not provide it.
+    """
+    dirname = getattr(bus, 'dirname', None)
+    filename = getattr(dev, 'filename', None)
+    if dirname is None or filename is None:
+        return None
+    return '%s/%s'%(dirname, filename)
+
+def device_key(bus, dev):
+    """
+    Returns the cache key of usb device dev on bus or None if the device
+    cannot be identified.
+    """
+    location = device_location(bus, dev)
+    if location is None:
+        return None
+    desc = dev.descriptor
+    release = getattr(desc, 'bcdDevice', 0)
+    return '%s:%04x:%04x:%04x'%(location, desc.idVendor, desc.idProduct, release)
+
+
+class Open_cache:
+
+    def __init__(self, path=None):
+        if path is None:
+            path = open_cache_path()
+        self.path = path
+        self.entries = self._load()
+
+    def lookup(self, key):
+        """
+        Returns the entry for key or None.
+        """
+        if key is None:
+            return None
+        return self.entries.get(key)
+
+    def locations(self):
+        """
+        Returns the locations of all cached devices.
+        """
+        return [key.split(':')[0] for key in self.entries]
+
+    def store(self, key, entry):
+        """
+        Stores entry under key, replacing any entries for other devices seen
+        at the same location, and saves the cache.
+        """
+        if key is None:
+            return
+        location = key.split(':')[0]
+        for k in self.entries.keys():
+            if k.split(':')[0] == location:
+                del self.entries[k]
+        self.entries[key] = entry
+        self._save()
+
+    def remove(self, key):
+        if key in self.entries:
+            del self.entries[key]
+            self._save()
+
+    def _load(self):
+        try:
+            f = open(self.path, 'r')
+        except IOError:
+            return {}
+        try:
+            try:
+                entries = json.load(f)
+            except ValueError:
+                entries = {}
+        finally:
+            f.close()
+        if not isinstance(entries, dict):
+            entries = {}
+        return entries
+
+    def _save(self):
+        # Save the entries as json, see atomic.atomic_save
+        def write(tmp_path):
+            f = open(tmp_path, 'w')
+            try:
+                json.dump(self.entries, f)
+            finally:
+                f.close()
+        try:
+            atomic_save(self.path, write)
+        except (IOError, OSError):
+            # The cache is an optimization only
+            pass
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+#
+# plan.py
+#
+# Precompiled experiment plans. A plan is a sequence of trials, each of
+# which sets max_cycle (optional) and the sine parameters of one or more
+# channels before the device is started. compile_plan takes the trial
+# parameters as arrays, validates all of them at once with numpy - raising
+# a ValueError listing the invalid rows before anything is sent - and
+# encodes them into a blob of ready to send packets for a given TOP, e.g.
+#
+#   params = [[0, 0.5, 0, 0.5, f] for f in numpy.linspace(1.0, 20.0, 200)]
+#   plan = compile_plan(dev.top, params, max_cycle=5)
+#   run_plan(dev, plan)
+#
+# Compiled plans are cached on disk under the sha1 of their parameters, in
+# the directory given by the SINE_STIM_PLAN_DIR environment variable or
+# ~/.sine_stim_plans, so that a plan is only compiled once. Cached plans are
+# memory mapped when loaded.
+#
+# Large designs can be expanded lazily with grid(), which yields the
+# cartesian product of the parameter axes in chunks, and compiled and run a
+# chunk at a time with iter_plans().
+#
+# Plans are compiled without the device calibration, so run_plan refuses a
+# device with a calibration loaded.
+#
+# Requires numpy.
+#
+# William Dickson
+# ---------------------------------------------------------------------------
+import os
+import hashlib
+import numpy
+import codec
+import protocol
+from atomic import atomic_save
+from constants import (USB_BUFFER_SIZE, USB_CMD_SET_SINE_PARAM,
+                       USB_CMD_SET_MAX_CYCLE, MAX_FREQ_CHZ, MAX_U16)
+
+PLAN_DIR_ENV = 'SINE_STIM_PLAN_DIR'
+PLAN_DIR = '~/.sine_stim_plans'
+PLAN_VERSION = 1
+
+# Number of rows per chunk yielded by grid
+PLAN_CHUNK = 65536
+
+# Max number of invalid rows listed in a validation error
+PLAN_MAX_ERRORS = 10
+
+# Order of the parameter columns and of the grid axes
+PARAM_NAMES = ('pwm_chan', 'amp', 'phase', 'offset', 'freq')
+
+
+class Plan:
+    """
+    A compiled plan.
+
+      packets     = (n, USB_BUFFER_SIZE) uint8 array of encoded set commands
+      trial_index = array of n_trials + 1 offsets, the packets of trial i are
+                    packets[trial_index[i]:trial_index[i+1]]
+      top         = TOP value the plan was compiled for
+      digest      = content hash of the plan parameters
+    """
+
+    def __init__(self, packets, trial_index, top, digest):
+        self.packets = packets
+        self.trial_index = trial_index
+        self.top = top
+        self.digest = digest
+
+    def __len__(self):
+        return len(self.trial_index) - 1
+
+    def trial_packets(self, i):
+        """
+        Returns the list of packets, as strings, of trial i.
+        """
+        start, end = self.trial_index[i], self.trial_index[i+1]
+        return [row.tostring() for row in self.packets[start:end]]
+
+    def trial_commands(self, i):
+        """
+        Returns the list of (cmd_id, field, ...) commands of trial i and the
+        list of their packets.
+        """
+        packets = self.trial_packets(i)
+        return [codec.decode_command(packet) for packet in packets], packets
+
+
+def plan_dir():
+    """
+    Returns the directory holding the cached plans.
+    """
+    try:
+        return os.environ[PLAN_DIR_ENV]
+    except KeyError:
+        return os.path.expanduser(PLAN_DIR)
+
+def sine_param_values(top, params):
+    """
+    Validates an (n, 5) array of (pwm_chan, amp, phase, offset, freq) rows
+    and converts them to device units as Pwm_sine_device.set_sine_param
+    does. Returns an (n, 5) integer array. Raises ValueError listing the
+    invalid rows.
+    """
+    params = numpy.asarray(params, dtype=float).reshape(-1, len(PARAM_NAMES))
+    finite = numpy.isfinite(params).all(axis=1)
+    params = numpy.where(finite[:,None], params, 0.0)
+    values = numpy.empty(params.shape, dtype=numpy.int64)
+    values[:,0] = numpy.trunc(params[:,0])
+    values[:,1] = numpy.trunc(params[:,1]*top)
+    values[:,2] = numpy.trunc(params[:,2])
+    values[:,3] = numpy.trunc(params[:,3]*top)
+    values[:,4] = numpy.trunc(100*params[:,4])
+    int_chan, int_amp, int_phase, int_offset, int_freq = values.T
+    checks = [
+        (~finite, 'parameters must be finite'),
+        ((int_chan < 0) | (int_chan > 2), 'pwm_num must be in [0,1,2]'),
+        (int_amp < 0, 'amp must be > 0'),
+        (int_amp > MAX_U16, 'amp must be <= %d counts'%(MAX_U16,)),
+        ((int_freq < 0) | (int_freq > MAX_FREQ_CHZ),
+         'freq must be in range [0,%d] cHz'%(MAX_FREQ_CHZ,)),
+        ((int_phase < 0) | (int_phase >= 360), 'phase must be in range [0,360]'),
+        (int_offset < 0, 'offset must be > 0'),
+        (int_offset > MAX_U16, 'offset must be <= %d counts'%(MAX_U16,)),
+        ]
+    _raise_invalid(checks, 'row')
+    return values
+
+def max_cycle_values(max_cycle, n_trials):
+    """
+    Validates max_cycle, a scalar or one value per trial, and returns it as
+    an array of n_trials values.
+    """
+    max_cycle = numpy.asarray(max_cycle, dtype=float)
+    if max_cycle.ndim == 0:
+        max_cycle = numpy.repeat(max_cycle, n_trials)
+    if max_cycle.shape != (n_trials,):
+        raise ValueError('max_cycle must be a scalar or have one value per trial')
+    finite = numpy.isfinite(max_cycle)
+    values = numpy.trunc(numpy.where(finite, max_cycle, 0.0)).astype(numpy.int64)
+    checks = [
+        (~finite, 'max_cycle must be finite'),
+        (values <= 0, 'max_cycle must be > 0'),
+        (values > MAX_U16, 'max_cycle must be <= %d'%(MAX_U16,)),
+        ]
+    _raise_invalid(checks, 'trial')
+    return values
+
+def compile_plan(top, params, max_cycle=None, trial=None, cache=True, cache_dir=None):
+    """
+    Compiles a plan for a device with the given TOP value.
+
+    arguments:
+      params    = (n, 5) array of (pwm_chan, amp, phase, offset, freq) rows
+      max_cycle = None, a scalar or one max_cycle per trial
+      trial     = trial number of each row, nondecreasing from 0, defaults
+                  to one trial per row
+      cache     = look up, and store, the compiled plan in cache_dir
+    """
+    top = int(top)
+    params = numpy.ascontiguousarray(params, dtype=float).reshape(-1, len(PARAM_NAMES))
+    n = len(params)
+    if trial is None:
+        trial = numpy.arange(n)
+    trial = numpy.ascontiguousarray(trial, dtype=numpy.int64)
+    if trial.shape != (n,):
+        raise ValueError('trial must have one entry per row')
+    if n and (trial[0] != 0 or numpy.any(numpy.diff(trial) < 0) or
+              numpy.any(numpy.diff(trial) > 1)):
+        raise ValueError('trial numbers must be consecutive from 0')
+    n_trials = int(trial[-1]) + 1 if n else 0
+    if max_cycle is not None:
+        max_cycle = numpy.ascontiguousarray(max_cycle_values(max_cycle, n_trials))
+
+    digest = _digest(top, params, trial, max_cycle)
+    if cache:
+        path = os.path.join(cache_dir or plan_dir(), digest)
+        plan = _load(path, top, digest)
+        if plan is not None:
+            return plan
+
+    values = sine_param_values(top, params)
+    # Rows of trial i are preceded by its max_cycle command, if any
+    rows_per_trial = numpy.bincount(trial, minlength=n_trials)
+    if max_cycle is not None:
+        rows_per_trial = rows_per_trial + 1
+    trial_index = numpy.zeros(n_trials + 1, dtype=numpy.int64)
+    numpy.cumsum(rows_per_trial, out=trial_index[1:])
+    packets = numpy.zeros((trial_index[-1], USB_BUFFER_SIZE), dtype=numpy.uint8)
+    if max_cycle is not None:
+        rows = trial_index[:-1]
+        packets[rows,0] = USB_CMD_SET_MAX_CYCLE
+        _put_u16(packets, rows, 1, max_cycle)
+        sine_rows = numpy.arange(n) + trial + 1
+    else:
+        sine_rows = numpy.arange(n)
+    # Field layout of codec.CMD_SINE_PARAM: B B H H H H, big-endian
+    packets[sine_rows,0] = USB_CMD_SET_SINE_PARAM
+    packets[sine_rows,1] = values[:,0]
+    for j in range(1, 5):
+        _put_u16(packets, sine_rows, 2*j, values[:,j])
+
+    plan = Plan(packets, trial_index, top, digest)
+    if cache:
+        _save(path, plan)
+    return plan
+
+def grid(chunk=PLAN_CHUNK, **axes):
+    """
+    Yields the cartesian product of the parameter axes, given as keyword
+    arguments named as in PARAM_NAMES (a scalar or a sequence each), as
+    (m, 5) arrays of at most chunk rows. The last axis in PARAM_NAMES varies
+    fastest. Only one chunk is held in memory at a time.
+    """
+    for name in axes:
+        if not name in PARAM_NAMES:
+            raise ValueError('unknown grid axis %s'%(name,))
+    axis_list = [numpy.atleast_1d(numpy.asarray(axes.get(name, 0), dtype=float))
+                 for name in PARAM_NAMES]
+    shape = tuple([len(axis) for axis in axis_list])
+    size = grid_size(**axes)
+    for start in xrange(0, size, chunk):
+        index = numpy.unravel_index(numpy.arange(start, min(size, start + chunk)), shape)
+        yield numpy.column_stack([axis[i] for axis, i in zip(axis_list, index)])
+
+def grid_size(**axes):
+    """
+    Returns the number of rows of the grid of the given axes.
+    """
+    size = 1
+    for name in PARAM_NAMES:
+        size *= len(numpy.atleast_1d(axes.get(name, 0)))
+    return size
+
+def iter_plans(top, chunks, max_cycle=None, cache=True, cache_dir=None):
+    """
+    Compiles, one trial per row, and yields a plan for each chunk of rows,
+    e.g. from grid().
+    """
+    for params in chunks:
+        yield compile_plan(top, params, max_cycle=max_cycle, cache=cache,
+                           cache_dir=cache_dir)
+
+def run_plan(dev, plan, callback=None):
+    """
+    Runs the trials of a compiled plan on dev: sends the packets of each
+    trial, starts the device and waits until the run is complete, see
+    protocol.run_trials. callback, if given, is called with each trial's
+    log entry. Returns the list of log entries.
+    """
+    if plan.top != dev.top:
+        raise ValueError('plan compiled for TOP %d, device TOP is %d'%(plan.top, dev.top))
+    if dev.calibration is not None:
+        raise ValueError('plans are compiled without calibration')
+    def setup_list():
+        for i in xrange(len(plan)):
+            cmd_list, packets = plan.trial_commands(i)
+            setup = lambda cmd_list=cmd_list, packets=packets: dev._set_commands(cmd_list, packets)
+            yield setup, 0.0
+    return protocol.run_trials(dev, setup_list(), callback)
+
+def _put_u16(packets, rows, col, vals):
+    # Writes big-endian 16 bit values at column col of the given rows
+    packets[rows,col] = vals >> 8
+    packets[rows,col+1] = vals & 0xff
+
+def _raise_invalid(checks, what):
+    # Raises ValueError listing the first rows failing the (mask, msg) checks
+    bad = numpy.zeros(len(checks[0][0]), dtype=bool)
+    for mask, msg in checks:
+        bad |= mask
+    n_bad = int(bad.sum())
+    if n_bad == 0:
+        return
+    error_list = []
+    for i in numpy.flatnonzero(bad)[:PLAN_MAX_ERRORS]:
+        msg_list = [msg for mask, msg in checks if mask[i]]
+        error_list.append('%s %d: %s'%(what, i, ', '.join(msg_list)))
+    if n_bad > PLAN_MAX_ERRORS:
+        error_list.append('... %d invalid %ss in total'%(n_bad, what))
+    raise ValueError('\n'.join(error_list))
+
+def _digest(top, params, trial, max_cycle):
+    h = hashlib.sha1()
+    h.update('plan %d top %d\n'%(PLAN_VERSION, top))
+    h.update(params.astype('<f8').tostring())
+    h.update(trial.astype('<i8').tostring())
+    if max_cycle is not None:
+        h.update('max_cycle\n')
+        h.update(max_cycle.astype('<i8').tostring())
+    return h.hexdigest()
+
+def _load(path, top, digest):
+    # Memory map a cached plan, None if it is not cached
+    try:
+        packets = numpy.load(os.path.join(path, 'packets.npy'), mmap_mode='r')
+        trial_index = numpy.load(os.path.join(path, 'trial_index.npy'))
+    except IOError:
+        return None
+    return Plan(packets, trial_index, top, digest)
+
+def _save(path, plan):
+    # Save the plan as a directory of .npy arrays, see atomic.atomic_save
+    def write(tmp_path):
+        if not os.path.isdir(tmp_path):
+            os.makedirs(tmp_path)
+        numpy.save(os.path.join(tmp_path, 'packets.npy'), plan.packets)
+        numpy.save(os.path.join(tmp_path, 'trial_index.npy'), plan.trial_index)
+    try:
+        atomic_save(path, write)
+    except OSError:
+        # Unless compiled by another process in the meantime
+        if not os.path.isdir(path):
+            raise
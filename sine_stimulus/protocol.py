@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#
+# protocol.py
+#
+# Runs a protocol of several trials over one open device. A protocol is a
+# json file of the form
+#
+#   {
+#     "pause": 0.0,
+#     "trials": [
+#       {"max_cycle": 5, "sine_params": [[0, 0.5, 0, 0.5, 1.0],
+#                                        [1, 0.5, 90, 0.5, 1.0]]},
+#       {"max_cycle": 10, "sine_params": [[0, 0.5, 0, 0.5, 3.0]], "pause": 2.0}
+#     ]
+#   }
+#
+# or just the list of trials. Each trial sets max_cycle (optional) and the
+# sine parameters of the listed channels, starts the device and waits until
+# the run is complete. The next trial starts pause seconds after the
+# previous one has stopped, pause being the trial's own or the protocol's
+# default. Every trial is validated before the first one is started.
+#
+# The dead time of a trial is the time between the earliest it could have
+# started - the end of the previous trial plus the pause - and the start
+# write, i.e. the overhead of detecting the end of a run, configuring and
+# starting.
+#
+# William Dickson
+# ---------------------------------------------------------------------------
+import json
+import time
+import struct
+
+# Default pause in seconds between the end of a trial and the next start
+PROTOCOL_DEFAULT_PAUSE = 0.0
+
+
+def load_protocol(path):
+    """
+    Reads a protocol file and returns its list of trials with the pause of
+    each trial filled in.
+    """
+    f = open(path)
+    try:
+        protocol = json.load(f)
+    finally:
+        f.close()
+    if isinstance(protocol, list):
+        protocol = {'trials': protocol}
+    pause = float(protocol.get('pause', PROTOCOL_DEFAULT_PAUSE))
+    trial_list = []
+    for trial in protocol['trials']:
+        trial = dict(trial)
+        trial.setdefault('pause', pause)
+        trial_list.append(trial)
+    return trial_list
+
+def validate_protocol(dev, trial_list):
+    """
+    Checks every trial of the protocol for dev. Raises ValueError, naming
+    the trial, for the first invalid trial.
+    """
+    for i, trial in enumerate(trial_list):
+        try:
+            for key in trial:
+                if not key in ('max_cycle', 'sine_params', 'pause'):
+                    raise ValueError('unknown trial key %s'%(key,))
+            if trial.get('max_cycle') is not None:
+                dev._max_cycle_value(trial['max_cycle'])
+            for param in trial.get('sine_params', []):
+                if len(param) != 5:
+                    raise ValueError('sine_params entries must be [pwm_chan, amp, phase, offset, freq]')
+                dev._sine_param_values(*param)
+            if float(trial['pause']) < 0:
+                raise ValueError('pause must be >= 0')
+        except (ValueError, TypeError, struct.error), e:
+            raise ValueError('trial %d: %s'%(i, e))
+
+def run_protocol(dev, trial_list, callback=None):
+    """
+    Runs the trials of a protocol on dev, see run_trials. All trials are
+    validated before the first one is started.
+    """
+    validate_protocol(dev, trial_list)
+    def setup_list():
+        for trial in trial_list:
+            setup = lambda trial=trial: dev.configure(
+                max_cycle=trial.get('max_cycle'), sine_params=trial.get('sine_params'))
+            yield setup, trial['pause']
+    return run_trials(dev, setup_list(), callback)
+
+def run_trials(dev, setup_list, callback=None):
+    """
+    Runs trials on dev. setup_list yields a (setup, pause) pair per trial,
+    setup being a function which sends the trial's settings. Each trial is
+    set up, started pause seconds after the end of the previous one and
+    waited for. callback, if given, is called with each trial's log entry as
+    the trial completes. Returns the list of log entries, dictionaries of 
+    the trial number, the start write and end times, the dead time and the 
+    error in the predicted end time of the run, all in seconds.
+    """
+    log = []
+    end_t = None
+    for i, (setup, pause) in enumerate(setup_list):
+        setup()
+        ready_t = None
+        if end_t is not None:
+            ready_t = end_t + pause
+            dt = ready_t - time.time()
+            if dt > 0:
+                time.sleep(dt)
+        start_t = dev.start(timestamp=True)['write_t']
+        wait_err = dev.wait(predict=True)
+        end_t = time.time()
+        if ready_t is None:
+            dead_t = None
+        else:
+            dead_t = max(0.0, start_t - ready_t)
+        entry = {
+            'trial': i,
+            'start_t': start_t,
+            'end_t': end_t,
+            'dead_t': dead_t,
+            'wait_err': wait_err,
+            }
+        log.append(entry)
+        if callback is not None:
+            callback(entry)
+    return log
+
+def dead_time_stats(log):
+    """
+    Returns the number, mean and maximum of the dead times in a protocol
+    log, in seconds.
+    """
+    dead_list = [entry['dead_t'] for entry in log if entry['dead_t'] is not None]
+    n = len(dead_list)
+    if n == 0:
+        return {'n': 0, 'mean': 0.0, 'max': 0.0}
+    return {'n': n, 'mean': sum(dead_list)/n, 'max': max(dead_list)}
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+#
+# record.py
+#
+# Binary record and replay of the usb transactions of a Pwm_sine_device.
+# When recording is enabled, with Pwm_sine_device(record=path), every bulk
+# write and bulk read is appended to a memory mapped file as a fixed size
+# record
+#
+#   t        - host time in seconds at the start of the transfer (double)
+#   dir      - OUT (bulk write) or IN (bulk read)
+#   opcode   - command id, the first byte of the packet
+#   attempt  - attempt number of the exchange, 0 for the first
+#   flags    - TIMEOUT if a bulk read returned no data
+#   payload  - the 16 byte packet, zero for a read which timed out
+#   duration - time in seconds taken by the transfer (float)
+#
+# following a file header. The file is grown, and remapped, in blocks of
+# RECORD_BLOCK records and truncated to the records written on close. A file
+# left by a process which did not close it ends at the first zero record.
+#
+# replay() sends the recorded bulk writes of a session again, at their
+# recorded times, through a simulated device (or another backend), reads
+# the replies in the same places and compares replies and timing, e.g.
+#
+#   report = record.replay('session.rec')
+#
+# William Dickson
+# ---------------------------------------------------------------------------
+import os
+import mmap
+import math
+import struct
+import time
+from constants import (USB_BULKOUT_EP_ADDRESS, USB_BULKIN_EP_ADDRESS,
+                       USB_BUFFER_SIZE, RETRY_MAX_TIMEOUT)
+from clock import sleep_until
+from instrument import cmd_name
+
+RECORD_MAGIC = 'SINESTIM'
+RECORD_VERSION = 1
+RECORD_HEADER = struct.Struct('<8sHH4xd8x')
+RECORD = struct.Struct('<dBBBB16sf')
+RECORD_BLOCK = 4096
+
+# Time allowed by replay beyond the recorded duration of a read which
+# returned data
+REPLAY_MARGIN_T = 0.01
+
+# Transfer directions
+OUT = 0
+IN = 1
+
+# Record flags
+TIMEOUT = 1
+
+
+class Recorder:
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.f = open(path, 'w+b')
+        self.f.write(RECORD_HEADER.pack(RECORD_MAGIC, RECORD_VERSION, RECORD.size, time.time()))
+        self.f.truncate(self._file_size(RECORD_BLOCK))
+        self.capacity = RECORD_BLOCK
+        self.mm = mmap.mmap(self.f.fileno(), self._file_size(self.capacity))
+
+    def write(self, t, attempt, payload, duration):
+        """
+        Records a bulk write of packet payload (string or bytearray).
+        """
+        self.record(t, OUT, ord(str(payload[:1])), attempt, 0, payload, duration)
+
+    def read(self, t, opcode, attempt, payload, duration):
+        """
+        Records a bulk read made for command opcode. payload is None if the
+        read timed out.
+        """
+        if payload is None:
+            self.record(t, IN, opcode, attempt, TIMEOUT, chr(0)*USB_BUFFER_SIZE, duration)
+        else:
+            self.record(t, IN, ord(str(payload[:1])), attempt, 0, payload, duration)
+
+    def record(self, t, direction, opcode, attempt, flags, payload, duration):
+        """
+        Appends one transfer.
+        """
+        if self.count == self.capacity:
+            self.capacity += RECORD_BLOCK
+            self.mm.resize(self._file_size(self.capacity))
+        RECORD.pack_into(self.mm, self._file_size(self.count), t, direction,
+                         opcode, min(attempt, 255), flags, str(payload), duration)
+        self.count += 1
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        if self.mm is None:
+            return
+        self.mm.flush()
+        self.mm.close()
+        self.mm = None
+        self.f.truncate(self._file_size(self.count))
+        self.f.close()
+
+    def _file_size(self, count):
+        return RECORD_HEADER.size + count*RECORD.size
+
+
+def read_records(path):
+    """
+    Returns the start time of a recording and its list of (t, dir, opcode,
+    attempt, flags, payload, duration) records.
+    """
+    f = open(path, 'rb')
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if size < RECORD_HEADER.size:
+            raise IOError('%s is not a usb recording'%(path,))
+        mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            magic, version, record_size, start_t = RECORD_HEADER.unpack_from(mm)
+            if magic != RECORD_MAGIC or record_size != RECORD.size:
+                raise IOError('%s is not a usb recording'%(path,))
+            record_list = []
+            for offset in xrange(RECORD_HEADER.size, size - RECORD.size + 1, RECORD.size):
+                rec = RECORD.unpack_from(mm, offset)
+                if rec[0] == 0.0:
+                    break
+                record_list.append(rec)
+        finally:
+            mm.close()
+    finally:
+        f.close()
+    return start_t, record_list
+
+def round_trips(record_list):
+    """
+    Returns the list of (opcode, round trip time) of the exchanges in a
+    recording, from the start of each bulk write to the end of the bulk read
+    which returned its reply.
+    """
+    rtt_list = []
+    write_t = {}
+    for t, direction, opcode, attempt, flags, payload, duration in record_list:
+        if direction == OUT:
+            write_t[opcode] = t
+        elif not flags & TIMEOUT and opcode in write_t:
+            rtt_list.append((opcode, t + duration - write_t.pop(opcode)))
+    return rtt_list
+
+def replay(path, backend=None, timing=True):
+    """
+    Replays a recording. The bulk writes are sent, at their recorded times
+    relative to the first if timing is True, and a bulk read is made for
+    each recorded read with the recorded duration, plus REPLAY_MARGIN_T for
+    reads which returned data, as timeout. backend defaults to a simulator.Sim_usb whose latency and
+    jitter are the median and spread of the recorded round trip times and
+    whose drop rate is the fraction of recorded writes which were retries.
+    Returns a dictionary of the number of writes, reads, reply mismatches and
+    timeouts (recorded and replayed) and per opcode round trip statistics.
+    """
+    start_t, record_list = read_records(path)
+    if backend is None:
+        import simulator
+        latency, jitter = _latency_model([rtt for opcode, rtt in round_trips(record_list)])
+        write_list = [r for r in record_list if r[1] == OUT]
+        drop_rate = 0.0
+        if write_list:
+            drop_rate = len([r for r in write_list if r[3] > 0])/float(len(write_list))
+        backend = simulator.Sim_usb(latency=latency, jitter=jitter, drop_rate=drop_rate)
+    handle = _open_handle(backend)
+    replay_list = []
+    mismatch = {}
+    buf = bytearray(USB_BUFFER_SIZE)
+    try:
+        t0 = time.time()
+        if record_list:
+            rec_t0 = record_list[0][0]
+        for t, direction, opcode, attempt, flags, payload, duration in record_list:
+            if timing:
+                sleep_until(t0 + t - rec_t0)
+            send_t = time.time()
+            if direction == OUT:
+                backend.bulk_write(handle, USB_BULKOUT_EP_ADDRESS, payload, RETRY_MAX_TIMEOUT)
+                rep_flags, reply = 0, payload
+            else:
+                if flags & TIMEOUT:
+                    timeout = duration
+                else:
+                    timeout = duration + REPLAY_MARGIN_T
+                timeout = max(1, min(RETRY_MAX_TIMEOUT, int(math.ceil(1.0e3*timeout))))
+                try:
+                    backend.bulk_read(handle, USB_BULKIN_EP_ADDRESS, buf, timeout)
+                    rep_flags, reply = 0, str(buf)
+                except backend.USBNoDataAvailableError:
+                    rep_flags, reply = TIMEOUT, chr(0)*len(buf)
+                if rep_flags == 0 and flags == 0 and reply != payload:
+                    name = cmd_name(opcode)
+                    mismatch[name] = mismatch.get(name, 0) + 1
+            replay_list.append((send_t, direction, ord(reply[0]), attempt, rep_flags,
+                                reply, time.time() - send_t))
+    finally:
+        backend.close(handle)
+    return {
+        'writes': len([r for r in record_list if r[1] == OUT]),
+        'reads': len([r for r in record_list if r[1] == IN]),
+        'timeouts': len([r for r in record_list if r[1] == IN and r[4] & TIMEOUT]),
+        'replay_timeouts': len([r for r in replay_list if r[1] == IN and r[4] & TIMEOUT]),
+        'mismatches': mismatch,
+        'duration': _duration(record_list),
+        'replay_duration': _duration(replay_list),
+        'round_trip': _compare_rtt(round_trips(record_list), round_trips(replay_list)),
+        }
+
+def _latency_model(rtt_list):
+    # Median and interquartile based spread of round trip times
+    if not rtt_list:
+        return 0.0, 0.0
+    rtt_list = sorted(rtt_list)
+    n = len(rtt_list)
+    median = rtt_list[n//2]
+    spread = (rtt_list[(3*n)//4] - rtt_list[n//4])/1.349
+    return median, spread
+
+def _compare_rtt(rec_rtt, rep_rtt):
+    results = {}
+    for key, rtt_list in (('recorded', rec_rtt), ('replayed', rep_rtt)):
+        for opcode, rtt in rtt_list:
+            entry = results.setdefault(cmd_name(opcode), {})
+            n, total = entry.get(key, (0, 0.0))
+            entry[key] = (n + 1, total + rtt)
+    for entry in results.values():
+        for key in entry:
+            n, total = entry[key]
+            entry[key] = {'n': n, 'mean': total/n}
+    return results
+
+def _duration(record_list):
+    if not record_list:
+        return 0.0
+    t, direction, opcode, attempt, flags, payload, duration = record_list[-1]
+    return t + duration - record_list[0][0]
+
+def _open_handle(backend):
+    from sine_stimulus import _find_device_at
+    backend.init()
+    if not backend.get_busses():
+        backend.find_busses()
+        backend.find_devices()
+    bus, dev = _find_device_at(backend.get_busses())
+    if dev is None:
+        raise RuntimeError("Cannot find device.")
+    handle = backend.open(dev)
+    backend.set_configuration(handle, dev.config[0].bConfigurationValue)
+    backend.claim_interface(handle, 0)
+    return handle
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+#
+# render.py
+#
+# Renders the expected output of the sinewave stimulus generator, the pwm
+# duty cycle of each channel as a fraction of TOP, at a chosen sample rate
+# without scoping the hardware. The firmware steps through its sine table,
+# steps entries per cycle each held for div pwm periods (see freq_model),
+# so the rendered waveform of a channel is the staircase
+#
+#   count = offset + amp*sin(2*pi*(k/steps + phase/360)),  k = floor(n/div)
+#
+# n being the pwm period since the start, rounded to whole counts and
+# clipped to [0, TOP]. The run ends after max_cycle cycles of the lowest
+# non-zero frequency, after which the channels are rendered in their idle
+# state: their dc value in dc mode, otherwise their offset.
+#
+# Long runs are rendered as a generator of chunks of at most chunk samples
+# so that memory use does not grow with the length of the run, e.g.
+#
+#   state = device_state(dev)
+#   for t, duty in render(dev.top, sample_rate=1.0e4, **state):
+#       ...   # duty is a (len(t), 3) array
+#
+# Requires numpy.
+#
+# William Dickson
+# ---------------------------------------------------------------------------
+import numpy
+import freq_model
+from constants import DC_MODE_ON
+
+# Number of samples per chunk yielded by render
+RENDER_CHUNK = 65536
+
+# Number of channels
+RENDER_NUM_CHAN = 3
+
+
+def device_state(dev):
+    """
+    Reads the settings which determine the output from dev and returns them
+    as keyword arguments for render: sine_params, max_cycle, dc_mode and
+    dc_vals.
+    """
+    return {
+        'sine_params': [dev.get_sine_param(i) for i in range(RENDER_NUM_CHAN)],
+        'max_cycle': dev.get_max_cycle(),
+        'dc_mode': dev.get_dc_mode(),
+        'dc_vals': [dev.get_dc_val(i) for i in range(RENDER_NUM_CHAN)],
+        }
+
+def run_time(top, sine_params, max_cycle, model=None):
+    """
+    Returns the duration in seconds of a run with the given settings, using
+    the realized frequencies, or None if no channel has a non-zero
+    frequency.
+    """
+    if model is None:
+        model = freq_model.Freq_model(top)
+    amp, phase, offset, freq_chz = _counts(top, sine_params)
+    realized = model.realized_chz(freq_chz)
+    if not numpy.any(realized > 0):
+        return None
+    return max_cycle/float(realized[realized > 0].min())
+
+def render(top, sine_params, max_cycle, sample_rate, duration=None,
+           dc_mode=0, dc_vals=None, chunk=RENDER_CHUNK, model=None):
+    """
+    Yields (t, duty) chunks of the expected output, t being the array of
+    sample times in seconds from the start and duty the (len(t), 3) array
+    of duty cycles of the channels as fractions of TOP.
+
+    arguments:
+      top         = device TOP value
+      sine_params = list of (pwm_chan, amp, phase, offset, freq) tuples, as
+                    returned by get_sine_param, for channels 0, 1 and 2
+      max_cycle   = max number of cycles
+      sample_rate = samples per second
+      duration    = length rendered in seconds, defaults to the run time
+      dc_mode     = dc mode, DC_MODE_ON renders the dc values once the run
+                    has ended
+      dc_vals     = dc value of each channel as a fraction of TOP
+      model       = freq_model.Freq_model, defaults to the nominal model
+    """
+    if model is None:
+        model = freq_model.Freq_model(top)
+    amp, phase, offset, freq_chz = _counts(top, sine_params)
+    div, steps = model.divisors(freq_chz)
+    end_t = run_time(top, sine_params, max_cycle, model)
+    if duration is None:
+        duration = end_t
+    if duration is None:
+        raise ValueError('duration required when no channel has a non-zero frequency')
+    if dc_mode == DC_MODE_ON:
+        if dc_vals is None:
+            raise ValueError('dc_vals required in dc mode')
+        dc_counts = numpy.floor(numpy.asarray(dc_vals, dtype=float)*top + 0.5)
+        idle_duty = numpy.clip(dc_counts, 0, top)/float(top)
+    else:
+        idle_duty = numpy.clip(offset, 0, top)/float(top)
+    on = steps > 0
+    div = numpy.maximum(div, 1)
+    steps = numpy.maximum(steps, 1)
+    n = int(numpy.ceil(duration*sample_rate))
+    for start in xrange(0, n, chunk):
+        t = numpy.arange(start, min(n, start + chunk))/float(sample_rate)
+        # Table step of each channel at each sample
+        pwm_n = numpy.floor(t*model.pwm_freq).astype(numpy.int64)
+        k = (pwm_n[:,None]//div) % steps
+        angle = 2*numpy.pi*(k/steps.astype(float) + phase/360.0)
+        counts = offset + amp*numpy.sin(angle)
+        counts = numpy.where(on, counts, offset)
+        duty = numpy.clip(numpy.floor(counts + 0.5), 0, top)/float(top)
+        if end_t is not None:
+            duty[t >= end_t] = idle_duty
+        yield t, duty
+
+def render_all(*args, **kwargs):
+    """
+    Renders the whole output at once, taking the arguments of render.
+    Returns the arrays of sample times and duty cycles.
+    """
+    t_list = []
+    duty_list = []
+    for t, duty in render(*args, **kwargs):
+        t_list.append(t)
+        duty_list.append(duty)
+    if not t_list:
+        return numpy.zeros(0), numpy.zeros((0, RENDER_NUM_CHAN))
+    return numpy.concatenate(t_list), numpy.concatenate(duty_list)
+
+def _counts(top, sine_params):
+    # Arrays of the amplitude, phase, offset and frequency (cHz) in device
+    # units of channels 0, 1 and 2
+    params = numpy.zeros((RENDER_NUM_CHAN, 4))
+    for pwm_chan, amp, phase, offset, freq in sine_params:
+        params[int(pwm_chan)] = amp, phase, offset, freq
+    amp = numpy.floor(params[:,0]*top + 0.5)
+    phase = numpy.floor(params[:,1] + 0.5)
+    offset = numpy.floor(params[:,2]*top + 0.5)
+    freq_chz = numpy.floor(params[:,3]*100 + 0.5).astype(int)
+    return amp, phase, offset, freq_chz
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#
+# retry.py
+#
+# Retry policy for command/reply exchanges with the sinewave stimulus
+# generator. Bounds the number of attempts and the total time spent on an
+# exchange and adapts the bulk-in read timeout to the observed round trip
+# time using the smoothed round trip time and variance estimator used by
+# TCP (Jacobson/Karels). Only exchanges which succeed on their first
+# attempt update the estimate (Karn's rule), so the timeout backoff of an
+# exchange which needed retries is kept for the following exchanges until
+# one succeeds first time.
+#
+# William Dickson
+# ---------------------------------------------------------------------------
+from constants import (RETRY_MAX_ATTEMPTS, RETRY_DEADLINE, RETRY_MIN_TIMEOUT,
+                       RETRY_MAX_TIMEOUT, RETRY_INITIAL_TIMEOUT)
+
+# Estimator gains and variance multiplier
+RTT_ALPHA = 0.125
+RTT_BETA = 0.25
+RTT_K = 4.0
+
+# Largest carried over backoff exponent
+RETRY_MAX_BACKOFF = 6
+
+
+class Retry_policy:
+    """
+    Keyword arguments:
+
+      max_attempts    = max number of times a command is sent
+      deadline        = max total time in seconds spent on one exchange
+      adaptive        = if True the read timeout follows the round trip time
+      min_timeout     = smallest adaptive read timeout in ms
+      max_timeout     = largest read timeout in ms
+      initial_timeout = read timeout in ms before any round trip is measured
+                        or when adaptive is False
+    """
+
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, deadline=RETRY_DEADLINE,
+                 adaptive=True, min_timeout=RETRY_MIN_TIMEOUT,
+                 max_timeout=RETRY_MAX_TIMEOUT, initial_timeout=RETRY_INITIAL_TIMEOUT):
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.adaptive = adaptive
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.initial_timeout = initial_timeout
+        self.srtt = None
+        self.rttvar = None
+        self.backoff = 0
+        self.reset_counts()
+
+    def reset_counts(self):
+        self.exchange_count = 0
+        self.attempt_count = 0
+        self.retry_count = 0
+        self.timeout_count = 0
+        self.stale_count = 0
+        self.failure_count = 0
+        self.max_retries = 0
+        self.last_retries = 0
+
+    def read_timeout(self, attempt=0):
+        """
+        Returns the bulk-in read timeout in ms for the given attempt number
+        (0 for the first). The timeout is doubled for each retry and for each
+        step of carried over backoff.
+        """
+        if not self.adaptive or self.srtt is None:
+            timeout = self.initial_timeout
+        else:
+            timeout = 1.0e3*(self.srtt + RTT_K*self.rttvar)
+            timeout = max(self.min_timeout, timeout)
+        timeout = timeout*(2**(self.backoff + attempt))
+        return int(min(self.max_timeout, timeout))
+
+    def observe(self, rtt):
+        """
+        Updates the round trip time estimate with a measured round trip time
+        rtt in seconds.
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = 0.5*rtt
+        else:
+            self.rttvar = (1.0 - RTT_BETA)*self.rttvar + RTT_BETA*abs(self.srtt - rtt)
+            self.srtt = (1.0 - RTT_ALPHA)*self.srtt + RTT_ALPHA*rtt
+
+    def record(self, attempts, success):
+        """
+        Records the outcome of an exchange which took the given number of
+        attempts.
+        """
+        retries = attempts - 1
+        self.exchange_count += 1
+        self.attempt_count += attempts
+        self.retry_count += retries
+        self.last_retries = retries
+        self.max_retries = max(self.max_retries, retries)
+        if not success:
+            self.failure_count += 1
+        elif retries == 0:
+            self.backoff = 0
+        else:
+            self.backoff = min(self.backoff + retries, RETRY_MAX_BACKOFF)
+
+    def stats(self):
+        """
+        Returns a dictionary of the retry counters and the current round trip
+        time estimate in seconds.
+        """
+        return {
+            'exchanges': self.exchange_count,
+            'attempts': self.attempt_count,
+            'retries': self.retry_count,
+            'max_retries': self.max_retries,
+            'timeouts': self.timeout_count,
+            'stale': self.stale_count,
+            'failures': self.failure_count,
+            'srtt': self.srtt,
+            'rttvar': self.rttvar,
+            }
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+#
+# shadow.py
+#
+# Shadow copy of the at90usb sinewave stimulus generator's registers. Holds
+# the last acknowledged value of the sine parameters, max_cycle, dc mode, dc
+# values and TOP in device units so that Pwm_sine_device can skip writes
+# which would not change anything and answer getters without a usb round
+# trip.
+#
+# William Dickson
+# ---------------------------------------------------------------------------
+from constants import (USB_CMD_SET_SINE_PARAM, USB_CMD_SET_MAX_CYCLE,
+                       USB_CMD_GET_SINE_PARAM, USB_CMD_GET_MAX_CYCLE,
+                       USB_CMD_GET_TOP, USB_CMD_DC_MODE_ON,
+                       USB_CMD_DC_MODE_OFF, USB_CMD_SET_DC_VAL,
+                       USB_CMD_GET_DC_MODE, USB_CMD_GET_DC_VAL,
+                       DC_MODE_ON, DC_MODE_OFF)
+
+# Register keys
+SINE_PARAM = 'sine_param'
+MAX_CYCLE = 'max_cycle'
+DC_MODE = 'dc_mode'
+DC_VAL = 'dc_val'
+TOP = 'top'
+
+# Set commands: cmd_id -> function of the command fields returning the
+# (register key, register value) written by the command.
+SET_TABLE = {
+    USB_CMD_SET_SINE_PARAM: lambda args: ((SINE_PARAM, args[0]), tuple(args[1:])),
+    USB_CMD_SET_MAX_CYCLE: lambda args: ((MAX_CYCLE,), args[0]),
+    USB_CMD_SET_DC_VAL: lambda args: ((DC_VAL, args[0]), args[1]),
+    USB_CMD_DC_MODE_ON: lambda args: ((DC_MODE,), DC_MODE_ON),
+    USB_CMD_DC_MODE_OFF: lambda args: ((DC_MODE,), DC_MODE_OFF),
+}
+
+# Get commands: cmd_id -> (function of the command fields returning the
+# register key, function of the reply returning the register value,
+# function of the command fields and register value returning the reply).
+GET_TABLE = {
+    USB_CMD_GET_SINE_PARAM: (
+        lambda args: (SINE_PARAM, args[0]),
+        lambda reply: tuple(reply[2:]),
+        lambda args, val: (USB_CMD_GET_SINE_PARAM, args[0]) + val,
+        ),
+    USB_CMD_GET_MAX_CYCLE: (
+        lambda args: (MAX_CYCLE,),
+        lambda reply: reply[1],
+        lambda args, val: (USB_CMD_GET_MAX_CYCLE, val),
+        ),
+    USB_CMD_GET_DC_MODE: (
+        lambda args: (DC_MODE,),
+        lambda reply: reply[1],
+        lambda args, val: (USB_CMD_GET_DC_MODE, val),
+        ),
+    USB_CMD_GET_DC_VAL: (
+        lambda args: (DC_VAL, args[0]),
+        lambda reply: reply[2],
+        lambda args, val: (USB_CMD_GET_DC_VAL, args[0], val),
+        ),
+    USB_CMD_GET_TOP: (
+        lambda args: (TOP,),
+        lambda reply: reply[1],
+        lambda args, val: (USB_CMD_GET_TOP, val),
+        ),
+}
+
+# Register key -> (get cmd_id, command fields) used to read it back
+READ_TABLE = {
+    SINE_PARAM: lambda key: (USB_CMD_GET_SINE_PARAM, key[1]),
+    MAX_CYCLE: lambda key: (USB_CMD_GET_MAX_CYCLE,),
+    DC_MODE: lambda key: (USB_CMD_GET_DC_MODE,),
+    DC_VAL: lambda key: (USB_CMD_GET_DC_VAL, key[1]),
+    TOP: lambda key: (USB_CMD_GET_TOP,),
+}
+
+# Register key -> function of the key and register value returning the set
+# command (cmd_id, field, ...) which writes it
+WRITE_TABLE = {
+    SINE_PARAM: lambda key, val: (USB_CMD_SET_SINE_PARAM, key[1]) + val,
+    MAX_CYCLE: lambda key, val: (USB_CMD_SET_MAX_CYCLE, val),
+    DC_MODE: lambda key, val: (DC_MODE_CMD[val],),
+    DC_VAL: lambda key, val: (USB_CMD_SET_DC_VAL, key[1], val),
+}
+DC_MODE_CMD = {DC_MODE_ON: USB_CMD_DC_MODE_ON, DC_MODE_OFF: USB_CMD_DC_MODE_OFF}
+
+
+class Shadow_registers:
+
+    def __init__(self):
+        self.regs = {}
+        self.hit_count = 0
+        self.elide_count = 0
+
+    def is_current(self, cmd_id, args):
+        """
+        Returns True if set command cmd_id with fields args would not change
+        the device state.
+        """
+        try:
+            key, val = SET_TABLE[cmd_id](args)
+        except KeyError:
+            return False
+        if key in self.regs and self.regs[key] == val:
+            self.elide_count += 1
+            return True
+        return False
+
+    def lookup(self, cmd_id, args):
+        """
+        Returns the reply to get command cmd_id with fields args from the
+        shadow registers or None if the register value is not known.
+        """
+        try:
+            get_key, get_val, make_reply = GET_TABLE[cmd_id]
+        except KeyError:
+            return None
+        key = get_key(args)
+        if not key in self.regs:
+            return None
+        self.hit_count += 1
+        return make_reply(args, self.regs[key])
+
+    def update(self, cmd_id, args, reply):
+        """
+        Updates the shadow registers after command cmd_id with fields args
+        has been acknowledged with reply.
+        """
+        if cmd_id in SET_TABLE:
+            key, val = SET_TABLE[cmd_id](args)
+            self.regs[key] = val
+        elif cmd_id in GET_TABLE:
+            get_key, get_val, make_reply = GET_TABLE[cmd_id]
+            self.regs[get_key(args)] = get_val(reply)
+
+    def invalidate(self, key=None):
+        """
+        Forgets the value of register key or of all registers if key is None.
+        """
+        if key is None:
+            self.regs.clear()
+        elif key in self.regs:
+            del self.regs[key]
+
+    def read_commands(self):
+        """
+        Returns a list of (key, (cmd_id, field, ...)) pairs which read back
+        every known register from the device.
+        """
+        return [(key, READ_TABLE[key[0]](key)) for key in sorted(self.regs.keys())]
+
+    def write_commands(self, regs=None):
+        """
+        Returns the list of set commands (cmd_id, field, ...) which write
+        every known writable register, of regs (a copy of self.regs) if 
+        given, back to the device.
+        """
+        if regs is None:
+            regs = self.regs
+        return [WRITE_TABLE[key[0]](key, regs[key]) for key in sorted(regs.keys())
+                if key[0] in WRITE_TABLE]
@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+#
+# simulator.py
+#
+# In-process software stand-in for the at90usb sinewave stimulus generator.
+# Sim_usb provides the subset of the pylibusb interface used by
+# Pwm_sine_device so that the device class can be opened without any
+# hardware attached, e.g.
+#
+#   from sine_stimulus import Pwm_sine_device
+#   from sine_stimulus.simulator import Sim_usb
+#
+#   dev = Pwm_sine_device(backend=Sim_usb(latency=0.001, jitter=0.0005))
+#
+# The firmware model implements every USB_CMD_* opcode. A configurable
+# latency/jitter model delays the bulk-in replies and a fault model drops
+# replies so that the USBNoDataAvailableError path in _read_input can be
+# exercised.
+#
+# William Dickson
+# ---------------------------------------------------------------------------
+import random
+import threading
+import time
+import codec
+from clock import sleep_until
+from constants import (USB_VENDOR_ID, USB_PRODUCT_ID,
+                       USB_BULKOUT_EP_ADDRESS, USB_BULKIN_EP_ADDRESS,
+                       USB_BUFFER_SIZE, USB_CMD_START, USB_CMD_STOP,
+                       USB_CMD_SET_SINE_PARAM, USB_CMD_SET_MAX_CYCLE,
+                       USB_CMD_GET_STATUS, USB_CMD_GET_SINE_PARAM,
+                       USB_CMD_GET_MAX_CYCLE, USB_CMD_GET_TOP,
+                       USB_CMD_DFU_MODE, USB_CMD_DC_MODE_ON,
+                       USB_CMD_DC_MODE_OFF, USB_CMD_SET_DC_VAL,
+                       USB_CMD_GET_DC_MODE, USB_CMD_GET_DC_VAL,
+                       USB_CMD_DEBUG, USB_CMD_DUMMY, RUNNING, STOPPED,
+                       DC_MODE_OFF, DC_MODE_ON)
+
+# Simulated firmware constants
+SIM_DEFAULT_TOP = 800
+SIM_PWM_FREQ = 1.0e4
+SIM_TABLE_SIZE = 256
+SIM_NUM_CHAN = 3
+
+
+class USBNoDataAvailableError(Exception):
+    pass
+
+
+class Sim_firmware:
+    """
+    Model of the at90usb firmware. Handles a single 16 byte command packet
+    and returns the 16 byte reply packet or None for commands which do not
+    reply (dfu mode).
+    """
+
+    def __init__(self, top=SIM_DEFAULT_TOP, pwm_freq=SIM_PWM_FREQ):
+        self.top = top
+        self.pwm_freq = pwm_freq
+        self.max_cycle = 1
+        self.dc_mode = DC_MODE_OFF
+        self.dc_val = [0]*SIM_NUM_CHAN
+        self.sine_param = [(0,0,0,0) for i in range(SIM_NUM_CHAN)]
+        self.dfu_mode = False
+        self.start_t = None
+        self.handlers = {
+            USB_CMD_START: self._start,
+            USB_CMD_STOP: self._stop,
+            USB_CMD_SET_SINE_PARAM: self._set_sine_param,
+            USB_CMD_SET_MAX_CYCLE: self._set_max_cycle,
+            USB_CMD_GET_STATUS: self._get_status,
+            USB_CMD_GET_SINE_PARAM: self._get_sine_param,
+            USB_CMD_GET_MAX_CYCLE: self._get_max_cycle,
+            USB_CMD_GET_TOP: self._get_top,
+            USB_CMD_DFU_MODE: self._dfu_mode,
+            USB_CMD_DC_MODE_ON: self._dc_mode_on,
+            USB_CMD_DC_MODE_OFF: self._dc_mode_off,
+            USB_CMD_SET_DC_VAL: self._set_dc_val,
+            USB_CMD_GET_DC_MODE: self._get_dc_mode,
+            USB_CMD_GET_DC_VAL: self._get_dc_val,
+            USB_CMD_DEBUG: self._debug,
+            USB_CMD_DUMMY: self._dummy,
+            }
+
+    def handle(self, data, t=None):
+        """
+        Process command packet data (string) received at time t. Returns the
+        reply packet as a string or None.
+        """
+        if t is None:
+            t = time.time()
+        cmd_id = codec.CMD_ID.unpack_from(data)[0]
+        try:
+            handler = self.handlers[cmd_id]
+        except KeyError:
+            # Unknown commands are echoed back
+            return codec.CMD_ONLY.pack(cmd_id)
+        fields = handler(codec.decode_command(data)[1:], t)
+        if fields is None:
+            return None
+        return codec.REPLY_TABLE[cmd_id].pack(cmd_id, *fields)
+
+    def run_time(self):
+        """
+        Returns the duration of a run - max_cycle cycles of the lowest
+        non-zero frequency.
+        """
+        freq_list = [self.realized_freq(p[3]) for p in self.sine_param if p[3] > 0]
+        if not freq_list:
+            return 0.0
+        return self.max_cycle/min(freq_list)
+
+    def get_status(self, t=None):
+        if t is None:
+            t = time.time()
+        if self.start_t is None:
+            return STOPPED
+        if t - self.start_t >= self.run_time():
+            self.start_t = None
+            return STOPPED
+        return RUNNING
+
+    def freq_divisors(self, freq):
+        """
+        Returns the (pwm cycles per table step, table steps per cycle) pair
+        the firmware uses for the frequency freq given in cHz.
+        """
+        if freq <= 0:
+            return 0, 0
+        f = freq/100.0
+        steps = max(1, min(SIM_TABLE_SIZE, int(self.pwm_freq/f)))
+        div = max(1, int(round(self.pwm_freq/(f*steps))))
+        return div, steps
+
+    def realized_freq(self, freq):
+        """
+        Returns the output frequency in Hz produced for freq given in cHz.
+        """
+        div, steps = self.freq_divisors(freq)
+        if div == 0:
+            return 0.0
+        return self.pwm_freq/(div*steps)
+
+    # Command handlers ------------------------------------------------------
+    #
+    # Each handler takes the command fields and the time of receipt and 
+    # returns the reply fields or None if the command has no reply.
+
+    def _start(self, fields, t):
+        self.start_t = t
+        return ()
+
+    def _stop(self, fields, t):
+        self.start_t = None
+        return ()
+
+    def _set_sine_param(self, fields, t):
+        chan = fields[0]
+        if chan < SIM_NUM_CHAN:
+            self.sine_param[chan] = tuple(fields[1:])
+        return ()
+
+    def _set_max_cycle(self, fields, t):
+        self.max_cycle = fields[0]
+        return ()
+
+    def _get_status(self, fields, t):
+        return (self.get_status(t),)
+
+    def _get_sine_param(self, fields, t):
+        chan = fields[0]
+        if chan < SIM_NUM_CHAN:
+            return (chan,) + self.sine_param[chan]
+        return (chan, 0, 0, 0, 0)
+
+    def _get_max_cycle(self, fields, t):
+        return (self.max_cycle,)
+
+    def _get_top(self, fields, t):
+        return (self.top,)
+
+    def _dfu_mode(self, fields, t):
+        self.dfu_mode = True
+        return None
+
+    def _dc_mode_on(self, fields, t):
+        self.dc_mode = DC_MODE_ON
+        return ()
+
+    def _dc_mode_off(self, fields, t):
+        self.dc_mode = DC_MODE_OFF
+        return ()
+
+    def _set_dc_val(self, fields, t):
+        chan, val = fields
+        if chan < SIM_NUM_CHAN:
+            self.dc_val[chan] = val
+        return ()
+
+    def _get_dc_mode(self, fields, t):
+        return (self.dc_mode,)
+
+    def _get_dc_val(self, fields, t):
+        chan = fields[0]
+        if chan < SIM_NUM_CHAN:
+            return (chan, self.dc_val[chan])
+        return (chan, 0)
+
+    def _debug(self, fields, t):
+        # Channel 0 divisors, as used by examples/test_freqs.py:
+        # f_true = pwm_freq/(vals[0]*vals[3])
+        div, steps = self.freq_divisors(self.sine_param[0][3])
+        return (div, self.get_status(t), self.max_cycle, steps, self.top, self.dc_mode)
+
+    def _dummy(self, fields, t):
+        return ()
+
+
+class Sim_descriptor:
+    def __init__(self):
+        self.idVendor = USB_VENDOR_ID
+        self.idProduct = USB_PRODUCT_ID
+        self.bcdDevice = 0x0100
+        self.iSerialNumber = 3
+        self.bNumConfigurations = 1
+
+
+class Sim_config:
+    def __init__(self):
+        self.bConfigurationValue = 1
+
+
+class Sim_device:
+    def __init__(self, firmware, devnum, serial):
+        self.descriptor = Sim_descriptor()
+        self.config = [Sim_config()]
+        self.firmware = firmware
+        self.filename = '%03d'%(devnum,)
+        self.serial = serial
+        # Cold until the first bulk write after being plugged in
+        self.cold = True
+        self.detached = False
+
+
+class Sim_bus:
+    def __init__(self, dirname, devices):
+        self.dirname = dirname
+        self.devices = devices
+
+
+class Sim_handle:
+    def __init__(self, dev):
+        self.dev = dev
+        self.replies = []
+        self.configuration = None
+        self.interface = None
+        self.closed = False
+
+
+class Sim_usb:
+    """
+    Simulated usb backend for Pwm_sine_device implementing the pylibusb
+    functions used by the device class.
+
+    Keyword arguments:
+
+      latency       = mean round trip time in seconds of a command/reply
+      jitter        = standard deviation in seconds added to the latency
+      drop_rate     = probability in [0,1] that a bulk-in reply is lost
+      drop_first    = if True the first bulk write after the device is 
+                      plugged in is lost, as seen with the real device
+      enum_latency  = time in seconds taken to enumerate the devices and to
+                      set the configuration
+      top           = simulated pwm TOP value
+      num_devices   = number of simulated devices attached
+      seed          = random seed for the jitter and fault model
+    """
+
+    USBNoDataAvailableError = USBNoDataAvailableError
+
+    def __init__(self, latency=0.0, jitter=0.0, drop_rate=0.0, drop_first=False,
+                 enum_latency=0.0, top=SIM_DEFAULT_TOP, num_devices=1, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.drop_first = drop_first
+        self.enum_latency = enum_latency
+        self.top = top
+        self.rand = random.Random(seed)
+        self.devnum = 0
+        self.busses = [Sim_bus('001', [])]
+        for i in range(num_devices):
+            self.busses[0].devices.append(self._new_device(i))
+        self.found = False
+        self.lock = threading.Lock()
+        self.write_count = 0
+        self.read_count = 0
+        self.drop_count = 0
+        self.timeout_count = 0
+
+    def _new_device(self, index):
+        self.devnum += 1
+        serial = 'SIM%04d'%(index,)
+        return Sim_device(Sim_firmware(top=self.top), self.devnum, serial)
+
+    def get_firmware(self, index=0):
+        """
+        Returns the firmware model of the index-th simulated device.
+        """
+        return self.busses[0].devices[index].firmware
+
+    # The firmware model of the first device
+    firmware = property(get_firmware)
+
+    def replug(self, index=0):
+        """
+        Simulates unplugging and replugging the index-th device. Open 
+        handles to it become stale, its firmware state is reset and it is
+        re-enumerated with a new device number.
+        """
+        self.lock.acquire()
+        try:
+            devices = self.busses[0].devices
+            devices[index].detached = True
+            devices[index] = self._new_device(index)
+        finally:
+            self.lock.release()
+
+    # pylibusb interface ----------------------------------------------------
+
+    def init(self):
+        pass
+
+    def get_busses(self):
+        # Like libusb, nothing is known until the busses have been searched
+        if not self.found:
+            return []
+        return self.busses
+
+    def find_busses(self):
+        self.found = True
+
+    def find_devices(self):
+        sleep_until(time.time() + self.enum_latency)
+
+    def open(self, dev):
+        return Sim_handle(dev)
+
+    def set_configuration(self, handle, value):
+        sleep_until(time.time() + self.enum_latency)
+        handle.configuration = value
+
+    def claim_interface(self, handle, interface_nr):
+        handle.interface = interface_nr
+
+    def get_string_simple(self, handle, index):
+        _check_handle(handle)
+        if index == handle.dev.descriptor.iSerialNumber:
+            return handle.dev.serial
+        return ''
+
+    def close(self, handle):
+        handle.closed = True
+        handle.replies = []
+
+    def bulk_write(self, handle, ep, buf, timeout):
+        if ep != USB_BULKOUT_EP_ADDRESS:
+            raise IOError('bulk write to unknown endpoint 0x%02x'%(ep,))
+        _check_handle(handle)
+        data = _buffer_data(buf)
+        t = time.time()
+        self.lock.acquire()
+        try:
+            self.write_count += 1
+            cold = handle.dev.cold
+            handle.dev.cold = False
+            if cold and self.drop_first:
+                return len(data)
+            reply = handle.dev.firmware.handle(data, t)
+            if reply is None:
+                return len(data)
+            if self.rand.random() < self.drop_rate:
+                self.drop_count += 1
+                return len(data)
+            delay = self.latency
+            if self.jitter > 0:
+                delay += self.rand.gauss(0.0, self.jitter)
+            handle.replies.append((t + max(0.0, delay), reply))
+        finally:
+            self.lock.release()
+        return len(data)
+
+    def bulk_read(self, handle, ep, buf, timeout):
+        if ep != USB_BULKIN_EP_ADDRESS:
+            raise IOError('bulk read from unknown endpoint 0x%02x'%(ep,))
+        _check_handle(handle)
+        t = time.time()
+        deadline = t + 1.0e-3*timeout
+        self.lock.acquire()
+        try:
+            if handle.replies:
+                ready_t, reply = handle.replies[0]
+            else:
+                ready_t, reply = None, None
+            if ready_t is not None and ready_t <= deadline:
+                del handle.replies[0]
+        finally:
+            self.lock.release()
+        if ready_t is None or ready_t > deadline:
+            # No reply arrives before the timeout
+            sleep_until(deadline)
+            self.timeout_count += 1
+            raise USBNoDataAvailableError('no data available')
+        sleep_until(ready_t)
+        self.read_count += 1
+        buf[:USB_BUFFER_SIZE] = reply
+        return USB_BUFFER_SIZE
+
+
+def _check_handle(handle):
+    if handle.closed:
+        raise IOError('usb handle closed')
+    if handle.dev.detached:
+        raise IOError('no such device')
+
+
+def _buffer_data(buf):
+    """
+    Returns the contents of a transfer buffer (ctypes array, bytearray or
+    string) as a string.
+    """
+    if hasattr(buf, 'raw'):
+        return buf.raw
+    return str(buf)
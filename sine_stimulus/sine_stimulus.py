@@ -12,50 +12,26 @@
 #
 # William Dickson 
 # --------------------------------------------------------------------------- 
-import pylibusb as usb
 import ctypes
+import os
 import sys
 import time
-import optparse
+import json
+import codec
+from constants import *
+from shadow import Shadow_registers
+from open_cache import Open_cache, device_key, device_location
+from retry import Retry_policy
+from instrument import Instrumentation
 
 DEBUG = False
 
-# USB params
-USB_VENDOR_ID = 0x1781 
-USB_PRODUCT_ID = 0x0BB0
-USB_BULKOUT_EP_ADDRESS = 0x06
-USB_BULKIN_EP_ADDRESS = 0x82
-USB_BUFFER_SIZE = 16
-
-# USB Command ids
-USB_CMD_START = 0
-USB_CMD_STOP = 1
-USB_CMD_SET_SINE_PARAM = 2
-USB_CMD_SET_MAX_CYCLE = 3
-USB_CMD_GET_STATUS = 4
-USB_CMD_GET_SINE_PARAM = 5
-USB_CMD_GET_MAX_CYCLE = 6
-USB_CMD_GET_TOP = 7
-USB_CMD_DFU_MODE = 8
-
-USB_CMD_DC_MODE_ON = 9
-USB_CMD_DC_MODE_OFF = 10
-USB_CMD_SET_DC_VAL = 11
-USB_CMD_GET_DC_MODE = 12
-USB_CMD_GET_DC_VAL = 13
-USB_CMD_DEBUG = 254
-USB_CMD_DUMMY = 255
-
-# Constants
-RUNNING = 1
-STOPPED = 0
-WAIT_SLEEP_T = 0.1
-DC_MODE_OFF = 0
-DC_MODE_ON = 1
-
 # Command line defaults
 CMDLINE_DEFAULT_VERBOSE = False
 CMDLINE_DEFAULT_WAIT = False
+CMDLINE_DEFAULT_DIRECT = False
+CMDLINE_DEFAULT_FAST_OPEN = False
+CMDLINE_DEFAULT_STATS = False
 
 def debug(val):
     if DEBUG==True:
@@ -69,137 +45,341 @@ def debug_print(msg, comma=False):
             print msg
         sys.stdout.flush()
 
+class Link_error(IOError):
+    """
+    Raised when the usb link to the device fails: no reply within the retry
+    budget or a failed bulk transfer, e.g. on a closed or stale handle.
+    Other IOErrors (wrong reply, wait timeout) leave the link usable.
+    """
+    pass
+
 class Pwm_sine_device:
-    def __init__(self):
-        usb.init()
+    def __init__(self, backend=None, shadow=False, fast_open=False, cache_path=None,
+                 location=None, retry_policy=None, instrument=False, record=None):
+        open_t = time.time()
+
+        # Optional binary recording of every usb transfer to the file record
+        if record is not None:
+            import record as record_module
+            self.recorder = record_module.Recorder(record)
+        else:
+            self.recorder = None
+        self._attempt = 0
+
+        # Optional per command counters, latency histograms and trace hooks
+        if instrument:
+            self.instrument = Instrumentation()
+        else:
+            self.instrument = None
+
+        # Bounds and timeouts of command/reply exchanges
+        if retry_policy is None:
+            retry_policy = Retry_policy()
+        self.retry = retry_policy
+
+        # The usb backend defaults to pylibusb. Any object providing the same
+        # functions (e.g. simulator.Sim_usb) may be used in its place.
+        if backend is None:
+            backend = default_backend()
+        self.usb = backend
+
+        # Optional shadow copy of the device registers. When enabled, writes 
+        # which would not change the device state are skipped and getters are 
+        # answered from the shadow copy. 
+        if shadow:
+            self.shadow = Shadow_registers()
+        else:
+            self.shadow = None
+
+        # Optional fast open. The device's location and TOP value are cached 
+        # and, if the device has not been replugged since it was last opened,
+        # the set configuration and warm-up exchange are skipped.
+        if fast_open:
+            open_cache = Open_cache(cache_path)
+        else:
+            open_cache = None
+        self.usb.init()
         
         # Get usb busses
-        if not usb.get_busses():
-            usb.find_busses()            
-            usb.find_devices()
-        busses = usb.get_busses()
-
-        # Find device by IDs
-        found = False
-        for bus in busses:
-            for dev in bus.devices:
-                #print 'idVendor: 0x%04x idProduct: 0x%04x'%(dev.descriptor.idVendor,
-                #                                            dev.descriptor.idProduct)
-                if (dev.descriptor.idVendor == USB_VENDOR_ID and
-                    dev.descriptor.idProduct == USB_PRODUCT_ID):
-                    found = True
-                    break
-            if found:
-                break
-        if not found:
+        if not self.usb.get_busses():
+            self.usb.find_busses()            
+            self.usb.find_devices()
+        busses = self.usb.get_busses()
+
+        # Find device by IDs, at the given bus/device location if any
+        bus, dev = None, None
+        if location is not None:
+            bus, dev = _find_device_at(busses, [location])
+        else:
+            if open_cache is not None:
+                bus, dev = _find_device_at(busses, open_cache.locations())
+            if dev is None:
+                bus, dev = _find_device_at(busses)
+        if dev is None:
             raise RuntimeError("Cannot find device.")
+        self.location = device_location(bus, dev)
 
-        self.libusb_handle = usb.open(dev)
+        self.key = device_key(bus, dev)
+        if open_cache is not None:
+            cache_entry = open_cache.lookup(self.key)
+        else:
+            cache_entry = None
+        self.warm_open = cache_entry is not None
+
+        self._open_handle(dev, configure=not self.warm_open)
+        
+        # Transfer buffers. Packets are packed and unpacked in place in the
+        # bytearrays and the ctypes arrays, which share their memory, are
+        # passed to the usb backend.
+        self.output_data = bytearray(USB_BUFFER_SIZE)
+        self.input_data = bytearray(USB_BUFFER_SIZE)
+        self.output_buffer = (ctypes.c_char*USB_BUFFER_SIZE).from_buffer(self.output_data)
+        self.input_buffer = (ctypes.c_char*USB_BUFFER_SIZE).from_buffer(self.input_data)
+        
+        # Send dummy commmand - this is due to what appears to be a bug which makes first 
+        # bulk write not appear. The same thing happes to the bullkin so a send/receive 
+        # request is sent twice to initial a dummy bulkin. After this everything seems to 
+        # as it should.
+        if not self.warm_open:
+            for i in range(0,1):
+                codec.encode_into(self.output_data, USB_CMD_DUMMY)
+                self._send_and_receive(in_timeout=100)
+
+        # Get top value
+        if self.warm_open:
+            self.top = cache_entry['top']
+        else:
+            self.top = self._get_top()
+            if open_cache is not None:
+                open_cache.store(self.key, {'top': self.top})
+
+        # Time taken to open the device in seconds
+        self.open_time = time.time() - open_t
+
+        # Max number of commands sent ahead of their replies by configure
+        self.pipeline_depth = PIPELINE_DEPTH
+
+        # Host time of the last start, used to predict the end of a run
+        self.start_t = None
+
+        # Frequency quantization model, created when first needed
+        self.freq_model = None
+
+        # Stored calibration used to convert sine parameters, see
+        # load_calibration
+        self.calibration = None
+
+        # Round trip model relating device actions to the host clock, 
+        # created when first needed, see get_clock_model
+        self.clock_model = None
+
+
+    def _open_handle(self, dev, configure=True):
+        # Open dev, set its configuration if configure is True, claim the
+        # interface and read the serial number
+        self.libusb_handle = self.usb.open(dev)
         
         interface_nr = 0
-        if hasattr(usb,'get_driver_np'):
+        if hasattr(self.usb,'get_driver_np'):
             # non-portable libusb function available
-            name = usb.get_driver_np(self.libusb_handle,interface_nr)
+            name = self.usb.get_driver_np(self.libusb_handle,interface_nr)
             if name != '':
                 debug("attached to kernel driver '%s', detaching."%name )
-                usb.detach_kernel_driver_np(self.libusb_handle,interface_nr)
+                self.usb.detach_kernel_driver_np(self.libusb_handle,interface_nr)
 
 
         if dev.descriptor.bNumConfigurations > 1:
             debug("WARNING: more than one configuration, choosing first")
         
-        usb.set_configuration(self.libusb_handle, dev.config[0].bConfigurationValue)
-        usb.claim_interface(self.libusb_handle, interface_nr)
-        
-        self.output_buffer = ctypes.create_string_buffer(USB_BUFFER_SIZE)
-        self.input_buffer = ctypes.create_string_buffer(USB_BUFFER_SIZE)
-        for i in range(USB_BUFFER_SIZE):
-            self.output_buffer[i] = chr(0x00)
-            self.input_buffer[i] = chr(0x00)
-        
-        # Send dummy commmand - this is due to what appears to be a bug which makes first 
-        # bulk write not appear. The same thing happes to the bullkin so a send/receive 
-        # request is sent twice to initial a dummy bulkin. After this everything seems to 
-        # as it should.
-        for i in range(0,1):
-            self.output_buffer[0] = chr(USB_CMD_DUMMY%0x100)
-            self._send_and_receive(in_timeout=100)
-
-        # Get top value
+        if configure:
+            self.usb.set_configuration(self.libusb_handle, dev.config[0].bConfigurationValue)
+        self.usb.claim_interface(self.libusb_handle, interface_nr)
+
+        # Serial number, if the device and backend provide one
+        self.serial = None
+        serial_index = getattr(dev.descriptor,'iSerialNumber',0)
+        if serial_index and hasattr(self.usb,'get_string_simple'):
+            self.serial = self.usb.get_string_simple(self.libusb_handle,serial_index)
+
+    def reopen(self):
+        """
+        Re-enumerates the busses and reopens the device after it has been
+        replugged or has reset. A device with a serial number is only 
+        reopened if the same serial number is found, otherwise the device at
+        the previous location or else the first one found is used. The 
+        shadow registers are invalidated but the settings are not restored
+        (see monitor.Monitored_pwm_sine_device).
+        """
+        try:
+            self.usb.close(self.libusb_handle)
+        except IOError:
+            pass
+        serial = self.serial
+        self.usb.find_busses()
+        self.usb.find_devices()
+        dev_list = _find_devices(self.usb.get_busses())
+        # Try the device at the previous location first
+        dev_list.sort(key=lambda pair: device_location(*pair) != self.location)
+        for bus, dev in dev_list:
+            self._open_handle(dev)
+            if serial is None or self.serial == serial:
+                break
+            self.usb.close(self.libusb_handle)
+        else:
+            self.serial = serial
+            raise RuntimeError("Cannot find device.")
+        self.location = device_location(bus, dev)
+        self.key = device_key(bus, dev)
+        # Warm up exchange as on a cold open, see __init__
+        codec.encode_into(self.output_data, USB_CMD_DUMMY)
+        self._send_and_receive(in_timeout=100)
         self.top = self._get_top()
+        self.start_t = None
+        self.invalidate_shadow()
+
+    def start(self, timestamp=False):
+        """
+        Starts the output. With timestamp=True returns a dictionary of the
+        host times before the start write ('write_t') and after its 
+        acknowledgement ('ack_t') and the estimated host time at which the 
+        output started ('t'), see get_clock_model.
+        """
+        write_t = time.time()
+        self._command(USB_CMD_START)
+        stamp = self._timestamp(write_t, time.time())
+        # Host time at which the run is taken to have started
+        self.start_t = stamp['t']
+        if timestamp:
+            return stamp
+        return
 
+    def start_at(self, host_t):
+        """
+        Starts the output at host time host_t by writing the start command
+        early by the estimated latency of the clock model. Returns the 
+        timestamp dictionary of start with the target time ('target_t') 
+        added. The first call calibrates the clock model, which takes
+        CLOCK_CAL_COUNT exchanges, before the sleep; call get_clock_model
+        in advance when host_t is near.
+        """
+        import clock
+        latency = self.get_clock_model().latency()
+        clock.sleep_until(host_t - latency)
+        stamp = self.start(timestamp=True)
+        stamp['target_t'] = host_t
+        return stamp
+
+    def stop(self, timestamp=False):
+        """
+        Stops the output. With timestamp=True returns the timestamp 
+        dictionary of the stop command, as start does.
+        """
+        write_t = time.time()
+        self._command(USB_CMD_STOP)
+        stamp = self._timestamp(write_t, time.time())
+        if timestamp:
+            return stamp
+        return
+
+    def get_clock_model(self, calibrate=False):
+        """
+        Returns the device's round trip model (see clock), calibrating it
+        with dummy exchanges on first use or if calibrate is True. Once it
+        exists, start and stop use it to estimate when the device acted and
+        add their own round trips to it.
+        """
+        import clock
+        if self.clock_model is None:
+            self.clock_model = clock.Clock_model()
+            calibrate = True
+        if calibrate:
+            clock.calibrate(self, self.clock_model)
+        return self.clock_model
+
+    def _timestamp(self, write_t, ack_t):
+        # Timestamp dictionary of a command, the midpoint of the bracket is
+        # used as estimate until a clock model exists
+        if self.clock_model is None:
+            return {'write_t': write_t, 'ack_t': ack_t, 't': 0.5*(write_t + ack_t)}
+        return self.clock_model.timestamp(write_t, ack_t)
 
-    def start(self):
-        self.output_buffer[0] = chr(USB_CMD_START%0x100)
-        data = self._send_and_receive()
-        cmd_id = ord(data[0])
-        _check_cmd_id(USB_CMD_START, cmd_id)
+    def set_max_cycle(self,num):
+        num = self._max_cycle_value(num)
+        self._command(USB_CMD_SET_MAX_CYCLE, num)
         return
 
-    def stop(self):
-        self.output_buffer[0] = chr(USB_CMD_STOP%0x100)
-        data = self._send_and_receive()
-        cmd_id = ord(data[0])
-        _check_cmd_id(USB_CMD_STOP, cmd_id)
+    def configure(self, max_cycle=None, sine_params=None):
+        """
+        Sets max_cycle and the sinewave parameters of several channels. All
+        values are validated before anything is sent. The commands are then
+        written back-to-back, up to pipeline_depth at a time, and their 
+        acknowledgements collected afterwards.
+
+        arguments:
+          max_cycle   = max number of cycles or None to leave unchanged
+          sine_params = list of (pwm_chan, amp, phase, offset, freq) tuples
+        """
+        cmd_list = []
+        if max_cycle is not None:
+            cmd_list.append((USB_CMD_SET_MAX_CYCLE, self._max_cycle_value(max_cycle)))
+        if sine_params is not None:
+            for param in sine_params:
+                values = self._sine_param_values(*param)
+                cmd_list.append((USB_CMD_SET_SINE_PARAM,) + values)
+        self._set_commands(cmd_list)
         return
 
-    def set_max_cycle(self,num):
-        num = int(num)
-        if num <= 0:
-            raise ValueError('max_cycle must be > 0')
-        self.output_buffer[0] = chr(USB_CMD_SET_MAX_CYCLE%0x100)
-        self.output_buffer[1] = chr(num//0x100) 
-        self.output_buffer[2] = chr(num%0x100)
-        data = self._send_and_receive()
-        cmd_id = ord(data[0])
-        _check_cmd_id(USB_CMD_SET_MAX_CYCLE, cmd_id)
+    def _set_commands(self, cmd_list, packets=None):
+        """
+        Sends a list of (cmd_id, field, ...) set commands with _pipeline,
+        skipping those which the shadow registers show would not change the
+        device state. packets, if given, are the already encoded commands.
+        """
+        if self.shadow is not None:
+            keep = [i for i, c in enumerate(cmd_list) if not self.shadow.is_current(c[0], c[1:])]
+            cmd_list = [cmd_list[i] for i in keep]
+            if packets is not None:
+                packets = [packets[i] for i in keep]
+        try:
+            self._pipeline(cmd_list, packets)
+        except:
+            self.invalidate_shadow()
+            raise
+
+    def set_sine_params(self, param_list):
+        """
+        Sets the sinewave parameters for a list of (pwm_chan, amp, phase, 
+        offset, freq) tuples using a single pipelined exchange. 
+        """
+        self.configure(sine_params=param_list)
         return
 
     def get_dc_mode(self):
         # Request dc-mode from device
-        self.output_buffer[0] = chr(USB_CMD_GET_DC_MODE%0x100)
-        data = self._send_and_receive()
-        cmd_id = ord(data[0])
-        _check_cmd_id(USB_CMD_GET_DC_MODE, cmd_id)
-        if not ord(data[1]) in (0,1):
-            raise IOError('unknown dc mode received %d'%(ord(data[1]),))
-        return ord(data[1])
+        cmd_id, dc_mode = self._command(USB_CMD_GET_DC_MODE)
+        if not dc_mode in (0,1):
+            raise IOError('unknown dc mode received %d'%(dc_mode,))
+        return dc_mode
 
     def get_dc_val(self,pwm_chan):
         # Get dc value for pwm_chan from device
         pwm_chan = int(pwm_chan)
         if not pwm_chan in (0,1,2): 
             raise ValueError('pwm_num must be in [0,1,2]')
-        self.output_buffer[0] = chr(USB_CMD_GET_DC_VAL%0x100)
-        self.output_buffer[1] = chr(pwm_chan%0x100)
-        data = self._send_and_receive()
-        cmd_id = ord(data[0])
-        _check_cmd_id(USB_CMD_GET_DC_VAL, cmd_id)
-        val = ord(data[2])<<8
-        val += ord(data[3])
+        cmd_id, chan, val = self._command(USB_CMD_GET_DC_VAL, pwm_chan)
         val = float(val)/float(self.top)
         return val
 
     def get_debug_vals(self):
-        self.output_buffer[0] = chr(USB_CMD_DEBUG%0x100)
-        data = self._send_and_receive()
-        cmd_id = ord(data[0])
-        _check_cmd_id(USB_CMD_DEBUG, cmd_id)
-        val0 = ord(data[1])<<8
-        val0 += ord(data[2])
-        val1 = ord(data[3])<<8
-        val1 += ord(data[4])
-        val2 = ord(data[5])<<8
-        val2 += ord(data[6])
-        val3 = ord(data[7])<<8
-        val3 += ord(data[8])
-        val4 = ord(data[9])<<8
-        val4 += ord(data[10])
-        val5 = ord(data[11])<<8
-        val5 += ord(data[12])
-        return val0, val1, val2, val3, val4, val5
+        vals = self._command(USB_CMD_DEBUG)
+        return vals[1:]
         
     def set_dc_val(self,pwm_chan, val):
+        self._command(USB_CMD_SET_DC_VAL, *self._dc_val_values(pwm_chan, val))
+        return
+
+    def _dc_val_values(self, pwm_chan, val):
+        # Validate and convert dc value arguments to device units
         pwm_chan = int(pwm_chan)
         if not pwm_chan in (0,1,2): 
             raise ValueError('pwm_num must be in [0,1,2]')
@@ -207,14 +387,7 @@ class Pwm_sine_device:
         int_val = int(val*self.top)     
         if int_val < 0 or int_val > self.top:
             raise ValueError('value must be in range [0,1)')
-        self.output_buffer[0] = chr(USB_CMD_SET_DC_VAL%0x100)
-        self.output_buffer[1] = chr(pwm_chan%0x100)
-        self.output_buffer[2] = chr(int_val//0x100) 
-        self.output_buffer[3] = chr(int_val%0x100)
-        data = self._send_and_receive()
-        cmd_id = ord(data[0])
-        _check_cmd_id(USB_CMD_SET_DC_VAL, cmd_id)
-        return
+        return pwm_chan, int_val
 
     def dc_mode(self, val):
         if val.lower() == 'on':
@@ -224,24 +397,72 @@ class Pwm_sine_device:
             cmd_id = USB_CMD_DC_MODE_OFF
         else:
             raise ValueError, 'unknown dc mode value'
-        self.output_buffer[0] = chr(cmd_id%0x100)
-        data = self._send_and_receive()
-        cmd_id_ret = ord(data[0])
-        _check_cmd_id(cmd_id,cmd_id_ret)
+        self._command(cmd_id)
         return
 
-    def set_sine_param(self, pwm_chan, amp, phase, offset, freq):
-        pwn_chan = int(pwm_chan)
+    def set_sine_param(self, pwm_chan, amp, phase, offset, freq, snap=False):
+        """
+        Sets the sinewave parameters of channel pwm_chan. If snap is True the
+        frequency is replaced by the nearest frequency the device can realize
+        and that frequency in Hz is returned.
+        """
+        values = self._sine_param_values(pwm_chan, amp, phase, offset, freq)
+        realized = None
+        if snap:
+            freq_chz, realized = self.get_freq_model().nearest(freq)
+            values = values[:4] + (int(freq_chz),)
+            realized = float(realized)
+        self._command(USB_CMD_SET_SINE_PARAM, *values)
+        return realized
+
+    def get_freq_model(self, calibrate=False):
+        """
+        Returns the device's frequency quantization model (see freq_model),
+        creating it from TOP on first use. If calibrate is True the model is
+        refitted to debug values read from the device. Requires numpy.
+        """
+        import freq_model
+        if calibrate:
+            self.freq_model = freq_model.calibrate(self)
+        elif self.freq_model is None:
+            self.freq_model = freq_model.Freq_model(self.top)
+        return self.freq_model
+
+    def load_calibration(self, cal_dir=None):
+        """
+        Loads the device's stored calibration (see calibration), if any, and
+        uses it to convert the amplitude, offset and frequency of subsequent
+        set_sine_param calls. Returns the calibration or None. Requires numpy.
+        """
+        import calibration
+        self.calibration = calibration.load_calibration(self, cal_dir)
+        return self.calibration
+
+    def realized_freq(self, freq):
+        """
+        Returns the frequency in Hz the device produces when set to freq Hz,
+        from the calibration when one is loaded.
+        """
+        cal = self.calibration
+        if cal is not None:
+            return cal.realized_freq(cal.freq_chz(freq))
+        return float(self.get_freq_model().realized(freq))
+
+    def _sine_param_values(self, pwm_chan, amp, phase, offset, freq):
+        # Validate sine parameters and convert them to device units
+        pwm_chan = int(pwm_chan)
         if not pwm_chan in (0,1,2): 
             raise ValueError('pwm_num must be in [0,1,2]')
         # Convert amplitutde from float in [0,1] range to int in [0,TOP] range
         int_amp = int(amp*self.top)
         if int_amp < 0:
             raise ValueError('amp must be > 0')      
+        if int_amp > MAX_U16:
+            raise ValueError('amp must be <= %d counts'%(MAX_U16,))
         # Convert freq from float Hz to int cHz 
         int_freq = int(100*freq)
-        if int_freq < 0 or int_freq > 20000:
-            raise ValueError('freq must be in range [0,20000] cHz')
+        if int_freq < 0 or int_freq > MAX_FREQ_CHZ:
+            raise ValueError('freq must be in range [0,%d] cHz'%(MAX_FREQ_CHZ,))
         int_phase = int(phase)
         if int_phase < 0 or int_phase >= 360:
             raise ValueError('phase must be in range [0,360]')
@@ -249,28 +470,27 @@ class Pwm_sine_device:
         int_offset = int(offset*self.top)
         if int_offset < 0:
             raise ValueError('offset must be > 0')
-        self.output_buffer[0] = chr(USB_CMD_SET_SINE_PARAM%0x100)
-        self.output_buffer[1] = chr(pwm_chan%0x100)
-        self.output_buffer[2] = chr(int_amp//0x100) 
-        self.output_buffer[3] = chr(int_amp%0x100)
-        self.output_buffer[4] = chr(int_phase//0x100) 
-        self.output_buffer[5] = chr(int_phase%0x100)
-        self.output_buffer[6] = chr(int_offset//0x100) 
-        self.output_buffer[7] = chr(int_offset%0x100)
-        self.output_buffer[8] = chr(int_freq//0x100) 
-        self.output_buffer[9] = chr(int_freq%0x100)
-        data = self._send_and_receive()
-        cmd_id = ord(data[0])
-        _check_cmd_id(USB_CMD_SET_SINE_PARAM, cmd_id)
-        return
+        if int_offset > MAX_U16:
+            raise ValueError('offset must be <= %d counts'%(MAX_U16,))
+        cal = self.calibration
+        if cal is not None:
+            int_amp = cal.amp_count(int_amp)
+            int_offset = cal.offset_count(int_offset)
+            int_freq = cal.freq_chz(freq)
+        return pwm_chan, int_amp, int_phase, int_offset, int_freq
+
+    def _max_cycle_value(self, num):
+        num = int(num)
+        if num <= 0:
+            raise ValueError('max_cycle must be > 0')
+        if num > MAX_U16:
+            raise ValueError('max_cycle must be <= %d'%(MAX_U16,))
+        return num
 
     def get_status(self):
         # Request status from device
-        self.output_buffer[0] = chr(USB_CMD_GET_STATUS%0x100)
-        data = self._send_and_receive()
-        cmd_id = ord(data[0])
-        _check_cmd_id(USB_CMD_GET_STATUS, cmd_id)
-        return ord(data[1])
+        cmd_id, status = self._command(USB_CMD_GET_STATUS)
+        return status
             
 
     def get_sine_param(self, pwm_chan):
@@ -278,21 +498,8 @@ class Pwm_sine_device:
         if not pwm_chan in (0,1,2):
             raise ValueError('pwm_chan must be in (0,1,2)')
         # Request sine parameters from device
-        self.output_buffer[0] = chr(USB_CMD_GET_SINE_PARAM%0x100)
-        self.output_buffer[1] = chr(pwm_chan%0x100)
-        data = self._send_and_receive()
-        cmd_id = ord(data[0])
-        _check_cmd_id(USB_CMD_GET_SINE_PARAM, cmd_id)
-        pwm_chan = ord(data[1])
-        # Extract output data
-        amp = ord(data[2])<<8
-        amp += ord(data[3])
-        phase = ord(data[4])<<8
-        phase += ord(data[5])
-        offset = ord(data[6])<<8
-        offset += ord(data[7])
-        freq = ord(data[8])<<8
-        freq += ord(data[9])
+        cmd_id, pwm_chan, amp, phase, offset, freq = self._command(
+                USB_CMD_GET_SINE_PARAM, pwm_chan)
         # Convert output data
         amp = float(amp)/float(self.top)
         phase = float(phase)
@@ -302,70 +509,425 @@ class Pwm_sine_device:
         
     def get_max_cycle(self):
         # Request max_cycles from device
-        self.output_buffer[0] = chr(USB_CMD_GET_MAX_CYCLE%0x100)
-        data = self._send_and_receive()
-        cmd_id = ord(data[0])
-        _check_cmd_id(USB_CMD_GET_MAX_CYCLE, cmd_id)
-        max_cycle = ord(data[1])
-        max_cycle += ord(data[2])
+        cmd_id, max_cycle = self._command(USB_CMD_GET_MAX_CYCLE)
         return max_cycle
 
     def _get_top(self):
         # Request top from device
-        self.output_buffer[0] = chr(USB_CMD_GET_TOP%0x100)
-        data = self._send_and_receive()
-        cmd_id = ord(data[0])
-        _check_cmd_id(USB_CMD_GET_TOP, cmd_id)
-        top = ord(data[1])<<8
-        top += ord(data[2])
+        cmd_id, top = self._command(USB_CMD_GET_TOP)
         return top
 
-    def _send_and_receive(self,in_timeout=1000,out_timeout=9999):
-        # Send bulkout and and receive bulkin as a response
-        # Note, probably want to and a max count so this will 
-        # timeout if al lof the reads fail.  
-        done = False
-        while not done:
-            val = self._send_output(timeout=out_timeout)
-            data = self._read_input(timeout=in_timeout)
-            if data == None:
-                debug_print('usb SR: fail', comma=False) 
-                sys.stdout.flush()
+    def invalidate_shadow(self):
+        """
+        Forgets the shadow register values so that the next getter reads from
+        the device and the next setter is always sent.
+        """
+        if self.shadow is not None:
+            self.shadow.invalidate()
+
+    def verify_shadow(self):
+        """
+        Reads back every shadow register from the device and refreshes the 
+        shadow copy. Returns a list of the register keys whose device value 
+        differed from the shadow value.
+        """
+        if self.shadow is None:
+            return []
+        mismatch_list = []
+        for key, cmd in self.shadow.read_commands():
+            expected = self.shadow.lookup(cmd[0], cmd[1:])
+            reply = self._exchange(*cmd)
+            if reply != expected:
+                mismatch_list.append(key)
+            self.shadow.update(cmd[0], cmd[1:], reply)
+        return mismatch_list
+
+    def _command(self, cmd_id, *args):
+        """
+        Sends command cmd_id with the given fields to the device and returns
+        the decoded reply. Raises IOError if the reply is to a different 
+        command. Goes through the shadow registers when they are enabled.
+        """
+        if self.shadow is None:
+            return self._exchange(cmd_id, *args)
+        if self.shadow.is_current(cmd_id, args):
+            return (cmd_id,)
+        reply = self.shadow.lookup(cmd_id, args)
+        if reply is not None:
+            return reply
+        try:
+            reply = self._exchange(cmd_id, *args)
+        except:
+            # Device state is unknown after a failed exchange
+            self.shadow.invalidate()
+            raise
+        self.shadow.update(cmd_id, args, reply)
+        return reply
+
+    def _exchange(self, cmd_id, *args, **kwargs):
+        # Single command/reply exchange with the device, keyword arguments
+        # are passed to _send_and_receive
+        codec.encode_into(self.output_data, cmd_id, *args)
+        data = self._send_and_receive(**kwargs)
+        reply = codec.decode(cmd_id, data)
+        _check_cmd_id(cmd_id, reply[0])
+        return reply
+
+    def _receive_reply(self, cmd_id):
+        # Read and check the reply to a command which has already been sent
+        data = self._read_reply(cmd_id, self.retry.read_timeout())
+        if data is None:
+            raise Link_error('no reply received to command ID %d'%(cmd_id,))
+        reply = codec.decode(cmd_id, data)
+        _check_cmd_id(cmd_id, reply[0])
+        return reply
+
+    def _pipeline(self, cmd_list, packets=None):
+        """
+        Sends a list of (cmd_id, field, ...) commands pipeline_depth at a 
+        time, reading the replies only after each group has been written. 
+        If a reply is lost the commands in that group are resent one at a 
+        time, so only idempotent (set) commands should be pipelined. 
+        packets, if given, is the list of the encoded commands.
+        """
+        inst = self.instrument
+        depth = max(1, self.pipeline_depth)
+        for i in range(0, len(cmd_list), depth):
+            group = cmd_list[i:i+depth]
+            start_t = time.time()
+            write_list = []
+            for j, cmd in enumerate(group):
+                if packets is None:
+                    codec.encode_into(self.output_data, *cmd)
+                else:
+                    self.output_data[:] = packets[i+j]
+                send_t = time.time()
+                self._send_output()
+                if inst is not None:
+                    write_list.append(time.time() - send_t)
+            lost = False
+            # Write, read and total time and timeouts of each command,
+            # recorded once the group is done
+            rec_list = []
+            for j, cmd in enumerate(group):
+                read_t = time.time()
+                data = self._read_reply(cmd[0], self.retry.read_timeout())
+                if inst is not None:
+                    t = time.time()
+                    rec_list.append((write_list[j], t - read_t, t - start_t, int(data is None)))
+                if data is None:
+                    if DEBUG:
+                        debug_print('usb pipeline: fail', comma=False) 
+                    lost = True
+                    continue
+                reply = codec.decode(cmd[0], data)
+                _check_cmd_id(cmd[0], reply[0])
+                if self.shadow is not None:
+                    self.shadow.update(cmd[0], cmd[1:], reply)
+            if not lost:
+                for cmd, rec in zip(group, rec_list):
+                    inst.record(cmd[0], rec[0], rec[1], rec[2], timeouts=rec[3])
                 continue
+            # Resend the group one command at a time. The resends are timed
+            # here, as retries of the pipelined commands, so that each
+            # command is recorded once.
+            for j, cmd in enumerate(group):
+                resend_t = time.time()
+                attempts = self.retry.attempt_count
+                timeouts = self.retry.timeout_count
+                ok = False
+                try:
+                    self._exchange(*cmd, record=False)
+                    ok = True
+                finally:
+                    if inst is not None:
+                        t = time.time()
+                        write_t, read_t, total_t, lost_count = rec_list[j]
+                        inst.record(cmd[0], write_t, read_t, t - start_t,
+                                    1 + self.retry.attempt_count - attempts,
+                                    lost_count + self.retry.timeout_count - timeouts,
+                                    ok=ok, retry_t=t - resend_t)
+                if self.shadow is not None:
+                    self.shadow.update(cmd[0], cmd[1:], (cmd[0],))
+
+    def _send_and_receive(self,in_timeout=None,out_timeout=9999,record=True):
+        # Send bulkout and and receive bulkin as a response. The command is 
+        # resent when no reply arrives, up to the retry policy's maximum 
+        # number of attempts and deadline, after which a Link_error is raised.
+        # in_timeout (ms) overrides the policy's adaptive read timeout. 
+        # record=False leaves the exchange out of the instrumentation.
+        policy = self.retry
+        if record:
+            inst = self.instrument
+        else:
+            inst = None
+        cmd_id = self.output_data[0]
+        start_t = time.time()
+        deadline = start_t + policy.deadline
+        attempt = 0
+        data = None
+        if inst is not None:
+            write_t, read_t, stale = 0.0, 0.0, policy.stale_count
+            # End of the first attempt, from which retries are timed
+            first_t = start_t
+        while attempt < policy.max_attempts:
+            if attempt > 0 and time.time() >= deadline:
+                break
+            if in_timeout is None:
+                timeout = policy.read_timeout(attempt)
             else:
-                done = True
-                debug_print('usb SR cmd_id: %d'%(ord(data[0]),), comma=False) 
+                timeout = in_timeout
+            send_t = time.time()
+            self._attempt = attempt
+            val = self._send_output(timeout=out_timeout)
+            attempt += 1
+            if inst is not None:
+                t = time.time()
+                write_t += t - send_t
+            data = self._read_reply(cmd_id, timeout)
+            if inst is not None:
+                read_t += time.time() - t
+                if attempt == 1:
+                    first_t = time.time()
+            if data is not None:
+                break
+            policy.timeout_count += 1
+            if DEBUG:
+                debug_print('usb SR: fail', comma=False) 
+        self._attempt = 0
+        if data is None:
+            policy.record(attempt, False)
+            if inst is not None:
+                t = time.time()
+                inst.record(cmd_id, write_t, read_t, t - start_t, attempt, 
+                            attempt, policy.stale_count - stale, False, t - first_t)
+            msg = 'no reply to command ID %d after %d attempts'%(cmd_id, attempt)
+            raise Link_error, msg
+        if attempt == 1:
+            policy.observe(time.time() - send_t)
+        else:
+            # The reply to an earlier attempt may still arrive. The drain
+            # reads into the input buffer, so keep a copy of the reply.
+            data = bytearray(data)
+            self._drain()
+        policy.record(attempt, True)
+        if inst is not None:
+            t = time.time()
+            inst.record(cmd_id, write_t, read_t, t - start_t, attempt, 
+                        attempt - 1, policy.stale_count - stale, True, t - first_t)
+        if DEBUG:
+            debug_print('usb SR cmd_id: %d'%(data[0],), comma=False) 
         return data
+
+    def _read_reply(self, cmd_id, timeout):
+        # Read the reply to command cmd_id, discarding stale replies to 
+        # earlier commands. Returns None if it does not arrive within timeout
+        # ms.
+        end_t = time.time() + 1.0e-3*timeout
+        while True:
+            data = self._read_input(timeout=timeout)
+            if data is None or data[0] == cmd_id:
+                return data
+            self.retry.stale_count += 1
+            if DEBUG:
+                debug_print('usb SR stale cmd_id: %d'%(data[0],), comma=False) 
+            timeout = int(1.0e3*(end_t - time.time()))
+            if timeout < 1:
+                return None
+
+    def _drain(self):
+        # Discard any replies which are already on their way
+        while self._read_input(timeout=self.retry.min_timeout) is not None:
+            self.retry.stale_count += 1
     
     def _send_output(self,timeout=9999):
         buf = self.output_buffer # shorthand
-        val = usb.bulk_write(self.libusb_handle, USB_BULKOUT_EP_ADDRESS, buf, timeout)
+        rec = self.recorder
+        if rec is not None:
+            t = time.time()
+        try:
+            val = self.usb.bulk_write(self.libusb_handle, USB_BULKOUT_EP_ADDRESS, buf, timeout)
+        except IOError, e:
+            raise Link_error(str(e))
+        if rec is not None:
+            rec.write(t, self._attempt, self.output_data, time.time() - t)
         return val
 
     def _read_input(self, timeout=1000):
+        # Returns the input bytearray itself, not a copy, so the reply is only
+        # valid until the next read.
         buf = self.input_buffer
+        rec = self.recorder
+        if rec is not None:
+            t = time.time()
         try:
-            val = usb.bulk_read(self.libusb_handle, USB_BULKIN_EP_ADDRESS, buf, timeout)
-            #print 'read', [ord(b) for b in buf]
-            data = [x for x in buf]
-        except usb.USBNoDataAvailableError:
+            val = self.usb.bulk_read(self.libusb_handle, USB_BULKIN_EP_ADDRESS, buf, timeout)
+            data = self.input_data
+        except self.usb.USBNoDataAvailableError:
             data = None
+        except IOError, e:
+            raise Link_error(str(e))
+        if rec is not None:
+            rec.read(t, self.output_data[0], self._attempt, data, time.time() - t)
         return data
                 
     def close(self):
-        ret = usb.close(self.libusb_handle)
-
+        ret = self.usb.close(self.libusb_handle)
+        if self.recorder is not None:
+            self.recorder.close()
+
+
+    def wait(self, predict=False, timeout=None):
+        """
+        Waits until the device stops running. 
+
+        By default the status is polled every WAIT_SLEEP_T seconds. With 
+        predict=True the expected end of the run is computed from max_cycle, 
+        the lowest channel frequency and the time of the last start. The 
+        host sleeps until just before it and then polls every WAIT_POLL_T 
+        seconds. In this mode the difference between the observed and the
+        predicted end time in seconds is returned, or None if no prediction
+        could be made. 
+
+        If timeout (seconds) is given an IOError is raised if the device is
+        still running after that time.
+        """
+        t = time.time()
+        if timeout is None:
+            deadline = None
+        else:
+            deadline = t + timeout
+
+        end_t = None
+        if predict and self.start_t is not None:
+            run_t = self.expected_run_time()
+            if run_t is not None:
+                end_t = self.start_t + run_t
+                guard_t = WAIT_GUARD_T + WAIT_GUARD_FRAC*run_t
+                sleep_t = end_t - guard_t - time.time()
+                if deadline is not None:
+                    sleep_t = min(sleep_t, deadline - time.time())
+                if sleep_t > 0:
+                    time.sleep(sleep_t)
+        if end_t is None:
+            poll_t = WAIT_SLEEP_T
+        else:
+            poll_t = WAIT_POLL_T
 
-    def wait(self):
-        while self.get_status()==1:
-            time.sleep(WAIT_SLEEP_T)
-            pass
+        while True:
+            t0 = time.time()
+            status = self.get_status()
+            t1 = time.time()
+            if status != RUNNING:
+                break
+            if deadline is not None and t1 >= deadline:
+                raise IOError('timeout waiting for device to stop')
+            time.sleep(poll_t)
+
+        if end_t is None:
+            return None
+        return 0.5*(t0 + t1) - end_t
+
+    def expected_run_time(self):
+        """
+        Returns the expected duration in seconds of a run with the current
+        settings - max_cycle cycles of the lowest non-zero channel frequency
+        - or None if no channel has a non-zero frequency. The settings are
+        read from the device, or from the shadow registers when enabled. The
+        realized frequencies are used when a calibration is loaded or once a
+        frequency model has been created.
+        """
+        max_cycle = self.get_max_cycle()
+        freq_list = []
+        for i in range(0,3):
+            freq = self.get_sine_param(i)[4]
+            if self.calibration is not None:
+                freq = self.calibration.realized_freq(int(round(100*freq)))
+            elif self.freq_model is not None:
+                freq = float(self.freq_model.realized_chz(int(round(100*freq))))
+            if freq > 0:
+                freq_list.append(freq)
+        if not freq_list:
+            return None
+        return max_cycle/min(freq_list)
 
     def enter_dfu_mode(self):
-        self.output_buffer[0] = chr(USB_CMD_DFU_MODE%0x100)
+        codec.encode_into(self.output_data, USB_CMD_DFU_MODE)
         val = self._send_output()
+        self.invalidate_shadow()
         return
 
+# Pwm_sine_device methods forwarded unchanged by the wrapper classes (see
+# async_device and threaded_device)
+WRAPPED_METHODS = (
+    'start', 'stop', 'configure', 'get_status', 'get_sine_param',
+    'get_max_cycle', 'dc_mode', 'get_dc_mode', 'get_dc_val',
+    'get_debug_vals', 'expected_run_time', 'invalidate_shadow',
+    'verify_shadow', 'enter_dfu_mode',
+    )
+
+def default_backend():
+    """
+    Returns the pylibusb module. It is imported on first use so that 
+    importing sine_stimulus, and commands which do not access the device,
+    do not load the usb library.
+    """
+    import pylibusb
+    return pylibusb
+
+def find_device_locations(backend=None):
+    """
+    Returns the bus/device locations of all attached stimulus generators.
+    """
+    if backend is None:
+        backend = default_backend()
+    backend.init()
+    if not backend.get_busses():
+        backend.find_busses()
+        backend.find_devices()
+    busses = backend.get_busses()
+    return [device_location(bus, dev) for bus, dev in _find_devices(busses)]
+
+def forward_methods(cls, name_list=WRAPPED_METHODS):
+    """
+    Adds to the wrapper class cls a method for each Pwm_sine_device method
+    in name_list which returns self._call(name, *args, **kwargs).
+    """
+    def forward(name):
+        def method(self, *args, **kwargs):
+            return self._call(name, *args, **kwargs)
+        method.__name__ = name
+        method.__doc__ = getattr(Pwm_sine_device, name).__doc__
+        return method
+    for name in name_list:
+        setattr(cls, name, forward(name))
+    return cls
+
+def _find_devices(busses):
+    # Returns (bus, device) pairs for all stimulus generators on busses
+    dev_list = []
+    for bus in busses:
+        for dev in bus.devices:
+            #print 'idVendor: 0x%04x idProduct: 0x%04x'%(dev.descriptor.idVendor,
+            #                                            dev.descriptor.idProduct)
+            if (dev.descriptor.idVendor == USB_VENDOR_ID and
+                dev.descriptor.idProduct == USB_PRODUCT_ID):
+                dev_list.append((bus, dev))
+    return dev_list
+
+def _find_device_at(busses, location_list=None):
+    """
+    Returns the (bus, device) pair of the first stimulus generator found at 
+    one of the given bus/device locations, or anywhere if location_list is
+    None. Returns (None, None) if no device is found.
+    """
+    for bus, dev in _find_devices(busses):
+        if location_list is None:
+            return bus, dev
+        if device_location(bus, dev) in location_list:
+            return bus, dev
+    return None, None
+
 def _check_cmd_id(expected_id,received_id):
     if not expected_id == received_id:
         msg = "received incorrect command ID %d expected %d"%(received_id,expected_id)
@@ -396,6 +958,15 @@ Command Summary:
  dc-mode     - turns dc mode on or off
  dc-val      - sets idle state pwm value for a given channel. Requires 
                that dc-mode be set to 'on' to take 
+ stats       - prints per command usb statistics. Reports the daemon's 
+               totals when a daemon is running.
+ daemon      - runs a daemon which holds the device open and serves the
+               above commands. Commands are sent to the daemon when one
+               is running.
+ calibrate   - measures and stores the device's frequency calibration
+ run         - runs the trials of a protocol file on one open device
+ bench       - runs the host side benchmarks and prints the results as
+               json.
 """
 
 STATUS_HELP = """\
@@ -473,6 +1044,81 @@ arguments:
 
 """
 
+STATS_HELP = """\
+sine-stim stats [json]
+
+prints the number of exchanges, retries, timeouts and stale replies and the
+write, read and total exchange times in ms for each usb command. When a 
+daemon is running these are its totals since it started, otherwise they 
+cover opening the device. 
+
+arguments:
+  json = print the statistics, including histograms, as json 
+"""
+
+DAEMON_HELP = """\
+sine-stim daemon [stop]
+
+runs a daemon in the foreground which holds the device open and serves 
+sine-stim commands over a unix socket. While the daemon is running all 
+other sine-stim commands are sent to it, avoiding the cost of opening the
+device on every call. Use the --direct option to bypass the daemon. 
+
+The socket path is set by the SINE_STIM_SOCKET environment variable.
+
+arguments:
+  stop = stops the running daemon
+"""
+
+CALIBRATE_HELP = """\
+sine-stim calibrate
+
+reads the device's debug values at a few frequencies, fits the frequency 
+model to them and stores the realized frequency of every commanded 
+frequency as the device's calibration. Programs using the calibration 
+(Pwm_sine_device.load_calibration) then set the commanded frequency whose 
+realized frequency is nearest the one requested. The sine parameters of 
+channel 0 are restored afterwards. Calibrations are stored in the directory 
+given by the SINE_STIM_CAL_DIR environment variable or ~/.sine_stim_cal. 
+Requires numpy.
+"""
+
+RUN_HELP = """\
+sine-stim run protocol [log]
+
+runs the trials listed in a json protocol file over one open device. Each
+trial sets max-cycle and the sine parameters of the given channels, starts 
+the output and waits for it to complete. All trials are checked before the 
+first is started. Prints each trial's start time, dead time (the delay 
+between the end of the previous trial plus its pause and the start) and the
+mean and max dead time. The protocol format is
+
+  {"pause": 0.0, 
+   "trials": [{"max_cycle": 5, "sine_params": [[0, 0.5, 0, 0.5, 1.0]]},
+              {"max_cycle": 10, "sine_params": [[0, 0.5, 0, 0.5, 3.0]],
+               "pause": 2.0}]}
+
+where pause is the idle time in seconds before a trial starts.
+
+arguments:
+  protocol = protocol file
+  log      = write the trial log as json to this file
+"""
+
+BENCH_HELP = """\
+sine-stim bench [sim] [file]
+
+runs the benchmarks of packet encode/decode cost, round trip time of each 
+usb command, command throughput, device open time and trial setup time and
+prints the results, times in seconds, as json. The device is accessed 
+directly so the daemon must not be running. The device is left stopped with 
+its max-cycle, sine-param and dc-val settings unchanged. 
+
+arguments:
+  sim  = run against the simulator instead of the device
+  file = write the results to file instead of stdout
+"""
+
 HELP_HELP = """\
 sine-stim help [cmd]
 
@@ -492,6 +1138,11 @@ HELP_TABLE = {
     'dfu-mode' : DFU_MODE_HELP,
     'dc-mode' : DC_MODE_HELP,
     'dc-val' : DC_VAL_HELP, 
+    'stats' : STATS_HELP,
+    'daemon' : DAEMON_HELP,
+    'calibrate' : CALIBRATE_HELP,
+    'run' : RUN_HELP,
+    'bench' : BENCH_HELP,
     'help' : HELP_HELP
 }
 
@@ -499,6 +1150,7 @@ def sine_stim_main():
     """
     Main routine for sine stimulus commandline function. 
     """
+    import optparse
     parser = optparse.OptionParser(usage=SINE_STIM_USAGE_STR)
 
     parser.add_option('-v', '--verbose',
@@ -513,6 +1165,24 @@ def sine_stim_main():
                       help='return only after sinewave outscan complete',
                       default=CMDLINE_DEFAULT_WAIT)
     
+    parser.add_option('-f', '--fast-open',
+                      action='store_true',
+                      dest='fast_open',
+                      help='use cached device information to open the device',
+                      default=CMDLINE_DEFAULT_FAST_OPEN)
+
+    parser.add_option('-s', '--stats',
+                      action='store_true',
+                      dest='stats',
+                      help='print per command usb statistics after the command',
+                      default=CMDLINE_DEFAULT_STATS)
+
+    parser.add_option('-d', '--direct',
+                      action='store_true',
+                      dest='direct',
+                      help='access the device directly even if a daemon is running',
+                      default=CMDLINE_DEFAULT_DIRECT)
+    
     options, args = parser.parse_args()
     try:
         command = args[0].lower()
@@ -520,6 +1190,35 @@ def sine_stim_main():
         print 'E: no command argument'
         sys.exit(1)
 
+    if command=='daemon':
+        import stim_daemon
+        stim_daemon.daemon_main(options,args)
+        return
+
+    if command=='bench':
+        run_bench(options,args)
+        return
+
+    if command=='run':
+        # File arguments are relative to this process, not the daemon
+        args[1:] = [os.path.abspath(arg) for arg in args[1:]]
+
+    if command!='help' and not options.direct:
+        # Forward the command to the daemon if one is running
+        import stim_daemon
+        status = stim_daemon.forward_command(options,args)
+        if status is not None:
+            sys.exit(status)
+
+    run_command(options,args,parser.print_help)
+
+def run_command(options,args,print_help=None):
+    """
+    Runs the sine-stim command given by args. The device held by the daemon
+    is used if options has a device attribute.
+    """
+    command = args[0].lower()
+
     if command=='status':
         print_status(options)
 
@@ -543,12 +1242,40 @@ def sine_stim_main():
         set_dc_val(options,args)
     elif command=='debug':
         get_debug_vals(options)
-    elif command=='help':
-        help(options,args,parser.print_help)
+    elif command=='stats':
+        print_stats(options,args)
+    elif command=='calibrate':
+        calibrate(options,args)
+    elif command=='run':
+        run_trials(options,args)
+    elif command=='help' and print_help is not None:
+        help(options,args,print_help)
     else:
         print 'E: uknown command %s'%(command,)
         sys.exit(1)
 
+def open_device(options):
+    """
+    Returns the device held by the daemon when the command is run by the 
+    daemon, otherwise opens the device.
+    """
+    dev = getattr(options,'device',None)
+    if dev is None:
+        dev = Pwm_sine_device(fast_open=getattr(options,'fast_open',False),
+                              instrument=getattr(options,'stats',False))
+    return dev
+
+def close_device(options,dev):
+    """
+    Closes the device unless it is held open by the daemon. Prints the usb
+    statistics first if requested.
+    """
+    if getattr(options,'stats',False) and dev.instrument is not None:
+        print 
+        print dev.instrument.report()
+    if getattr(options,'device',None) is None:
+        dev.close()
+
 def help(options,args,print_help):
     v = options.verbose  
     if len(args) == 1:
@@ -562,11 +1289,131 @@ def help(options,args,print_help):
         print 'E: too many argument of command help'
 
 
+def print_stats(options,args):
+    if len(args) > 2 or (len(args) == 2 and args[1].lower() != 'json'):
+        print 'E: incorrect arguments for command %s'%(args[0].lower(),)
+        sys.exit(1)
+    # Statistics are always recorded when the device is opened directly. The
+    # report is printed here rather than by close_device.
+    stats = getattr(options,'stats',False)
+    options.stats = True
+    dev = open_device(options)
+    options.stats = False
+    if dev.instrument is None:
+        close_device(options,dev)
+        print 'E: usb statistics are not enabled'
+        sys.exit(1)
+    if len(args) == 2:
+        print json.dumps(dev.instrument.as_dict())
+    else:
+        print dev.instrument.report()
+    close_device(options,dev)
+    options.stats = stats
+    return
+
+def calibrate(options,args):
+    import calibration
+    v = options.verbose
+    if not len(args)==1:
+        print 'E: incorrect arguments for command %s'%(args[0].lower(),)
+        sys.exit(1)
+
+    # Open device
+    vprint('opening device ... ',v,comma=True)
+    dev = open_device(options)
+    vprint('done',v)
+
+    vprint('calibrating ... ',v,comma=True)
+    cal = calibration.calibrate(dev)
+    vprint('done',v)
+    print 'calibration stored in %s'%(cal.path,)
+
+    # Close device
+    vprint('closing device ... ', v, comma=True)
+    close_device(options,dev)
+    vprint('done',v)
+    return
+
+def run_trials(options,args):
+    import protocol
+    v = options.verbose
+    if not len(args) in (2,3):
+        print 'E: incorrect arguments for command %s'%(args[0].lower(),)
+        sys.exit(1)
+    try:
+        trial_list = protocol.load_protocol(args[1])
+    except (IOError, ValueError, KeyError, TypeError), e:
+        print 'E: unable to read protocol %s: %s'%(args[1], e)
+        sys.exit(1)
+
+    # Open device
+    vprint('opening device ... ',v,comma=True)
+    dev = open_device(options)
+    vprint('done',v)
+
+    try:
+        protocol.validate_protocol(dev, trial_list)
+    except ValueError, e:
+        close_device(options,dev)
+        print 'E: %s'%(e,)
+        sys.exit(1)
+
+    def print_trial(entry):
+        if entry['dead_t'] is None:
+            dead_str = '-'
+        else:
+            dead_str = '%.3f ms'%(1.0e3*entry['dead_t'],)
+        print 'trial %d: start %f, run %.3f s, dead time %s'%(entry['trial'], 
+                entry['start_t'], entry['end_t'] - entry['start_t'], dead_str)
+        sys.stdout.flush()
+
+    try:
+        log = protocol.run_protocol(dev, trial_list, print_trial)
+    finally:
+        close_device(options,dev)
+    stats = protocol.dead_time_stats(log)
+    print 'dead time: mean %.3f ms, max %.3f ms'%(1.0e3*stats['mean'], 1.0e3*stats['max'])
+
+    if len(args) == 3:
+        f = open(args[2],'w')
+        try:
+            json.dump({'trials': log, 'dead_time': stats}, f, indent=2)
+        finally:
+            f.close()
+        vprint('log written to %s'%(args[2],),v)
+    return
+
+def run_bench(options,args):
+    import bench
+    v = options.verbose
+    args = args[1:]
+    backend = None
+    target = 'device'
+    if args and args[0].lower() == 'sim':
+        import simulator
+        backend = simulator.Sim_usb()
+        target = 'sim'
+        args = args[1:]
+    if len(args) > 1:
+        print 'E: incorrect arguments for command bench'
+        sys.exit(1)
+    results = bench.run_benchmarks(backend=backend, target=target, verbose=v)
+    results_str = json.dumps(results, indent=2, sort_keys=True)
+    if args:
+        f = open(args[0],'w')
+        try:
+            f.write(results_str + '\n')
+        finally:
+            f.close()
+        vprint('results written to %s'%(args[0],),v)
+    else:
+        print results_str
+
 def get_debug_vals(options):
     v = options.verbose  
     # Open device
     vprint('opening device ... ',v,comma=True)
-    dev = Pwm_sine_device()
+    dev = open_device(options)
     vprint('done',v)
 
     # Set sine parameters
@@ -576,7 +1423,7 @@ def get_debug_vals(options):
 
     # Close device
     vprint('closing device ... ', v, comma=True)
-    dev.close()
+    close_device(options,dev)
     vprint('done',v)
 
     print 'debug vals:', vals
@@ -594,7 +1441,7 @@ def set_dc_val(options,args):
 
     # Open device
     vprint('opening device ... ',v,comma=True)
-    dev = Pwm_sine_device()
+    dev = open_device(options)
     vprint('done',v)
 
     # Set sine parameters
@@ -604,7 +1451,7 @@ def set_dc_val(options,args):
 
     # Close device
     vprint('closing device ... ', v, comma=True)
-    dev.close()
+    close_device(options,dev)
     vprint('done',v)
     return
 
@@ -624,7 +1471,7 @@ def set_dc_mode(options,args):
 
     # Open device
     vprint('opening device ... ',v,comma=True)
-    dev = Pwm_sine_device()
+    dev = open_device(options)
     vprint('done',v)
 
     # Set sine parameters
@@ -634,7 +1481,7 @@ def set_dc_mode(options,args):
 
     # Close device
     vprint('closing device ... ', v, comma=True)
-    dev.close()
+    close_device(options,dev)
     vprint('done',v)
     return
 
@@ -642,7 +1489,7 @@ def dfu_mode(options):
     v = options.verbose  
     # Open device
     vprint('opening device ... ',v,comma=True)
-    dev = Pwm_sine_device()
+    dev = open_device(options)
     vprint('done',v)
 
     # Set sine parameters
@@ -652,7 +1499,7 @@ def dfu_mode(options):
            
     # Close device
     vprint('closing device ... ', v, comma=True)
-    dev.close()
+    close_device(options,dev)
     vprint('done',v)
     return
 
@@ -660,7 +1507,7 @@ def stop_output(options):
     v = options.verbose  
     # Open device
     vprint('opening device ... ',v,comma=True)
-    dev = Pwm_sine_device()
+    dev = open_device(options)
     vprint('done',v)
 
     # Set sine parameters
@@ -670,7 +1517,7 @@ def stop_output(options):
            
     # Close device
     vprint('closing device ... ', v, comma=True)
-    dev.close()
+    close_device(options,dev)
     vprint('done',v)
     return
 
@@ -679,7 +1526,7 @@ def start_output(options):
     wait = options.wait
     # Open device
     vprint('opening device ... ',v,comma=True)
-    dev = Pwm_sine_device()
+    dev = open_device(options)
     vprint('done',v)
 
     # Set sine parameters
@@ -689,12 +1536,12 @@ def start_output(options):
     
     if wait==True:
         vprint('waiting for completion ... ',v, comma=True)
-        dev.wait()
+        dev.wait(predict=True)
         vprint('done',v)
         
     # Close device
     vprint('closing device ... ', v, comma=True)
-    dev.close()
+    close_device(options,dev)
     vprint('done',v)
     return
 
@@ -707,7 +1554,7 @@ def set_max_cycle(options,args):
     
     # Open device
     vprint('opening device ... ',v,comma=True)
-    dev = Pwm_sine_device()
+    dev = open_device(options)
     vprint('done',v)
 
     # Set sine parameters
@@ -717,7 +1564,7 @@ def set_max_cycle(options,args):
 
     # Close device
     vprint('closing device ... ', v, comma=True)
-    dev.close()
+    close_device(options,dev)
     vprint('done',v)
     return
 
@@ -736,7 +1583,7 @@ def set_sine_param(options,args):
 
     # Open device
     vprint('opening device ... ',v,comma=True)
-    dev = Pwm_sine_device()
+    dev = open_device(options)
     vprint('done',v)
 
     # Set sine parameters
@@ -746,7 +1593,7 @@ def set_sine_param(options,args):
 
     # Close device
     vprint('closing device ... ', v, comma=True)
-    dev.close()
+    close_device(options,dev)
     vprint('done',v)
     return
 
@@ -755,7 +1602,7 @@ def print_status(options):
     
     # Open device
     vprint('opening device ... ',v,comma=True)
-    dev = Pwm_sine_device()
+    dev = open_device(options)
     vprint('done',v)
     
     # Get run status
@@ -793,7 +1640,7 @@ def print_status(options):
 
     # Close device
     vprint('closing device ... ', v, comma=True)
-    dev.close()
+    close_device(options,dev)
     vprint('done',v)
 
     # Display values
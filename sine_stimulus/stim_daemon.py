@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+#
+# stim_daemon.py
+#
+# Local daemon for the sine-stim command line utility. The daemon holds the
+# sinewave stimulus generator open and serves sine-stim commands over a unix
+# socket so that each command invocation does not have to enumerate the usb
+# busses, claim the interface and perform the warm-up exchange. When no
+# daemon is running sine-stim falls back to accessing the device directly.
+#
+# Requests and replies are single lines of json. A request is
+#
+#   {"command": "run", "args": [...], "verbose": false, "wait": false,
+#    "stats": false}
+#
+# or {"command": "stop"}. The reply is {"status": n, "output": "..."} where
+# status is the command's exit status and output is what it printed.
+#
+# William Dickson
+# ---------------------------------------------------------------------------
+import os
+import sys
+import json
+import socket
+import optparse
+import StringIO
+from sine_stimulus import Pwm_sine_device, run_command, vprint
+
+SOCKET_ENV = 'SINE_STIM_SOCKET'
+SOCKET_PATH = '/tmp/sine-stim-%d.sock'
+SOCKET_BACKLOG = 5
+RECV_SIZE = 4096
+
+def socket_path():
+    """
+    Returns the path of the daemon's unix socket.
+    """
+    try:
+        return os.environ[SOCKET_ENV]
+    except KeyError:
+        return SOCKET_PATH%(os.getuid(),)
+
+
+class Sine_stim_daemon:
+
+    def __init__(self, path=None, backend=None):
+        if path is None:
+            path = socket_path()
+        self.path = path
+        self.dev = Pwm_sine_device(backend=backend, instrument=True)
+        if os.path.exists(self.path):
+            # Left over from a daemon which did not exit cleanly
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0600)
+        self.sock.listen(SOCKET_BACKLOG)
+        self.running = False
+
+    def serve_forever(self):
+        """
+        Serves requests, one connection at a time, until a stop request is
+        received. A bad request, or a client which goes away, only ends its
+        own connection.
+        """
+        self.running = True
+        while self.running:
+            conn, addr = self.sock.accept()
+            try:
+                try:
+                    self.handle(conn)
+                except Exception, e:
+                    _send_error(conn, e)
+            finally:
+                conn.close()
+
+    def handle(self, conn):
+        request = _recv_msg(conn)
+        if request is None:
+            return
+        if request['command'] == 'stop':
+            self.running = False
+            reply = {'status': 0, 'output': 'daemon stopped\n'}
+        elif request['command'] == 'run':
+            status, output = self.run(request)
+            reply = {'status': status, 'output': output}
+        else:
+            msg = 'E: unknown daemon request %s\n'%(request['command'],)
+            reply = {'status': 1, 'output': msg}
+        _send_msg(conn, reply)
+
+    def run(self, request):
+        """
+        Runs a sine-stim command on the open device. Returns the exit status
+        and the output of the command.
+        """
+        options = optparse.Values({
+            'verbose': request.get('verbose',False),
+            'wait': request.get('wait',False),
+            'stats': request.get('stats',False),
+            'direct': True,
+            'device': self.dev,
+            })
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        status = 0
+        try:
+            try:
+                run_command(options, request['args'])
+            except SystemExit, e:
+                status = e.code
+                if status is None:
+                    status = 0
+            except Exception, e:
+                print 'E: %s'%(e,)
+                status = 1
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        return status, output
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.dev.close()
+
+
+def forward_command(options, args):
+    """
+    Sends a sine-stim command to the daemon and prints its output. Returns
+    the command's exit status or None if no daemon is running.
+    """
+    request = {
+        'command': 'run',
+        'args': args,
+        'verbose': options.verbose,
+        'wait': options.wait,
+        'stats': options.stats,
+        }
+    reply = _request(request)
+    if reply is None:
+        return None
+    sys.stdout.write(reply['output'])
+    sys.stdout.flush()
+    return reply['status']
+
+def daemon_main(options, args):
+    """
+    Runs the daemon in the foreground or, given the stop argument, stops
+    the running daemon.
+    """
+    v = options.verbose
+    if len(args) == 2 and args[1].lower() == 'stop':
+        reply = _request({'command': 'stop'})
+        if reply is None:
+            print 'E: no daemon running'
+            sys.exit(1)
+        sys.stdout.write(reply['output'])
+        return
+    if not len(args) == 1:
+        print 'E: incorrect arguments for command %s'%(args[0].lower(),)
+        sys.exit(1)
+    sock = _connect()
+    if sock is not None:
+        sock.close()
+        print 'E: daemon already running'
+        sys.exit(1)
+
+    vprint('opening device ... ',v,comma=True)
+    daemon = Sine_stim_daemon()
+    vprint('done',v)
+    vprint('serving on %s'%(daemon.path,),v)
+    try:
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    finally:
+        daemon.close()
+
+def _request(request):
+    # Send request to the daemon and return its reply, None if no daemon
+    sock = _connect()
+    if sock is None:
+        return None
+    try:
+        _send_msg(sock, request)
+        reply = _recv_msg(sock)
+    finally:
+        sock.close()
+    if reply is None:
+        raise IOError('no reply from daemon')
+    return reply
+
+def _connect():
+    # Connect to the daemon's socket, None if no daemon is listening
+    path = socket_path()
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+def _send_msg(sock, msg):
+    sock.sendall(json.dumps(msg) + '\n')
+
+def _send_error(sock, e):
+    # Reply with an error status if the client is still listening
+    msg = {'status': 1, 'output': 'E: %s\n'%(e,), 'error': str(e)}
+    try:
+        _send_msg(sock, msg)
+    except socket.error:
+        pass
+
+def _recv_msg(sock):
+    data = ''
+    while not data.endswith('\n'):
+        chunk = sock.recv(RECV_SIZE)
+        if not chunk:
+            break
+        data += chunk
+    if not data:
+        return None
+    return json.loads(data)
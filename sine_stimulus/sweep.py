@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#
+# sweep.py
+#
+# Deadline scheduled sine parameter updates for swept-sine and stepped
+# amplitude protocols. A Sweep takes a schedule of (t, pwm_chan, amp, phase,
+# offset, freq) updates, validates and encodes every update in advance and
+# then sends each one at the absolute time start_t + t, so that a late
+# update does not delay the ones after it, e.g.
+#
+#   schedule = freq_sweep(0, 0.5, 0, 0.5, [1.0, 2.0, 5.0, 10.0], 2.0)
+#   sweep = Sweep(dev, schedule)
+#   dev.start()
+#   sweep.run()
+#   print sweep.stats()
+#
+# The time until each deadline is slept except for the last spin_t seconds
+# which are spent polling the clock (see clock.sleep_until).
+#
+# William Dickson
+# ---------------------------------------------------------------------------
+import math
+import time
+import codec
+from clock import sleep_until, CLOCK_SPIN_T
+from sine_stimulus import USB_CMD_SET_SINE_PARAM, _check_cmd_id
+
+
+class Sweep:
+    """
+    Arguments:
+
+      dev      = Pwm_sine_device
+      schedule = list of (t, pwm_chan, amp, phase, offset, freq) updates, t
+                 in seconds from the start of the sweep
+
+    Keyword arguments:
+
+      spin_t   = time in seconds before each deadline spent polling
+    """
+
+    def __init__(self, dev, schedule, spin_t=CLOCK_SPIN_T):
+        self.dev = dev
+        self.spin_t = spin_t
+        schedule = sorted(schedule, key=lambda update: update[0])
+        self.times = [float(update[0]) for update in schedule]
+        # Raises ValueError for any invalid update before anything is sent
+        self.values = [dev._sine_param_values(*update[1:]) for update in schedule]
+        self.packets = [codec.encode(USB_CMD_SET_SINE_PARAM, *values)
+                        for values in self.values]
+        # (deadline, write_t, ack_t) of each update sent by the last run
+        self.log = []
+
+    def __len__(self):
+        return len(self.times)
+
+    def duration(self):
+        if not self.times:
+            return 0.0
+        return self.times[-1]
+
+    def run(self, start_t=None):
+        """
+        Sends the updates at start_t + t, start_t defaulting to the current
+        time. Returns the list of (deadline, write_t, ack_t) host times of
+        the updates.
+        """
+        dev = self.dev
+        if start_t is None:
+            start_t = time.time()
+        self.log = []
+        for t, values, packet in zip(self.times, self.values, self.packets):
+            deadline = start_t + t
+            sleep_until(deadline, self.spin_t)
+            dev.output_data[:] = packet
+            write_t = time.time()
+            data = dev._send_and_receive()
+            ack_t = time.time()
+            reply = codec.decode(USB_CMD_SET_SINE_PARAM, data)
+            _check_cmd_id(USB_CMD_SET_SINE_PARAM, reply[0])
+            if dev.shadow is not None:
+                dev.shadow.update(USB_CMD_SET_SINE_PARAM, values, reply)
+            self.log.append((deadline, write_t, ack_t))
+        return self.log
+
+    def lateness(self):
+        """
+        Returns the list of times in seconds by which each update of the last
+        run was written after its deadline.
+        """
+        return [write_t - deadline for deadline, write_t, ack_t in self.log]
+
+    def stats(self):
+        """
+        Returns the number, mean, standard deviation, 99th percentile and
+        maximum of the update lateness and the mean update round trip time
+        of the last run, in seconds.
+        """
+        late_list = sorted(self.lateness())
+        n = len(late_list)
+        if n == 0:
+            return {'n': 0, 'mean': 0.0, 'std': 0.0, 'p99': 0.0, 'max': 0.0,
+                    'round_trip': 0.0}
+        mean = sum(late_list)/n
+        var = sum([(x - mean)**2 for x in late_list])/n
+        round_trip = sum([ack_t - write_t for deadline, write_t, ack_t in self.log])/n
+        return {
+            'n': n,
+            'mean': mean,
+            'std': math.sqrt(var),
+            'p99': late_list[min(n - 1, int(0.99*n))],
+            'max': late_list[-1],
+            'round_trip': round_trip,
+            }
+
+
+def freq_sweep(pwm_chan, amp, phase, offset, freq_list, dt, t0=0.0):
+    """
+    Returns a schedule which steps channel pwm_chan through the frequencies
+    in freq_list, dt seconds apart.
+    """
+    return [(t0 + i*dt, pwm_chan, amp, phase, offset, freq)
+            for i, freq in enumerate(freq_list)]
+
+def amp_sweep(pwm_chan, amp_list, phase, offset, freq, dt, t0=0.0):
+    """
+    Returns a schedule which steps channel pwm_chan through the amplitudes
+    in amp_list, dt seconds apart.
+    """
+    return [(t0 + i*dt, pwm_chan, amp, phase, offset, freq)
+            for i, amp in enumerate(amp_list)]
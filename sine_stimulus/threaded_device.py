@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+#
+# threaded_device.py
+#
+# Thread safe access to the at90usb sinewave stimulus generator. A
+# Threaded_pwm_sine_device owns a Pwm_sine_device and a worker thread which
+# performs all of its usb I/O. Calls from any thread are put on a command
+# queue and return a concurrent.futures.Future holding the result, e.g.
+#
+#   dev = Threaded_pwm_sine_device()
+#   status = dev.get_status().result()          # from a gui thread
+#   dev.set_sine_param(0, 0.5, 0, 0.5, 2.0)     # from a control thread
+#
+# so that callers only ever wait for their own command. Set commands
+# (set_sine_param, set_max_cycle, set_dc_val) are validated in the calling
+# thread, where they raise ValueError, and set commands queued back to back
+# are sent to the device together as one pipelined exchange.
+#
+# Requires concurrent.futures (the futures backport on python 2).
+#
+# William Dickson
+# ---------------------------------------------------------------------------
+import Queue
+import threading
+import time
+from concurrent.futures import Future
+from sine_stimulus import (Pwm_sine_device, forward_methods, WRAPPED_METHODS,
+                           USB_CMD_SET_MAX_CYCLE, USB_CMD_SET_SINE_PARAM,
+                           USB_CMD_SET_DC_VAL, RUNNING, WAIT_SLEEP_T)
+
+# Max number of queued set commands sent as one pipelined exchange
+THREADED_MAX_BATCH = 16
+
+# Queue item kinds
+CALL = 0
+SET = 1
+CLOSE = 2
+
+
+class Threaded_pwm_sine_device:
+    """
+    Keyword arguments:
+
+      dev     = an open Pwm_sine_device to take over, otherwise the device is
+                opened with the remaining keyword arguments (see
+                Pwm_sine_device)
+    """
+
+    def __init__(self, dev=None, **kwargs):
+        if dev is None:
+            dev = Pwm_sine_device(**kwargs)
+        self.dev = dev
+        self.top = dev.top
+        self.queue = Queue.Queue()
+        # Number of pipelined exchanges and of the set commands sent in them
+        self.batch_count = 0
+        self.batch_cmd_count = 0
+        # Guards closed, so that no command is queued behind the close
+        self.lock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, func, *args):
+        """
+        Queues func(dev, *args) to be called on the worker thread with the
+        Pwm_sine_device. Returns a future holding its result.
+        """
+        return self._put(CALL, (func, args))
+
+    def close(self):
+        """
+        Closes the device once the commands already queued have been sent
+        and waits for the worker thread to finish.
+        """
+        future = Future()
+        self.lock.acquire()
+        try:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put((CLOSE, future, None))
+        finally:
+            self.lock.release()
+        future.result()
+        self.thread.join()
+
+    # Set commands ----------------------------------------------------------
+
+    def set_sine_param(self, pwm_chan, amp, phase, offset, freq):
+        values = self.dev._sine_param_values(pwm_chan, amp, phase, offset, freq)
+        return self._put(SET, (USB_CMD_SET_SINE_PARAM,) + values)
+
+    def set_max_cycle(self, num):
+        return self._put(SET, (USB_CMD_SET_MAX_CYCLE, self.dev._max_cycle_value(num)))
+
+    def set_dc_val(self, pwm_chan, val):
+        return self._put(SET, (USB_CMD_SET_DC_VAL,) + self.dev._dc_val_values(pwm_chan, val))
+
+    # Other commands --------------------------------------------------------
+
+    def wait(self, poll_t=WAIT_SLEEP_T, timeout=None):
+        """
+        Blocks the calling thread, not the worker, until the device stops
+        running by polling the status every poll_t seconds. Raises IOError if
+        it is still running after timeout seconds.
+        """
+        t0 = time.time()
+        while self.get_status().result() == RUNNING:
+            if timeout is not None and time.time() - t0 > timeout:
+                raise IOError('timeout waiting for device to stop')
+            time.sleep(poll_t)
+
+    # Worker ----------------------------------------------------------------
+
+    def _call(self, name, *args, **kwargs):
+        # Queue the named Pwm_sine_device method
+        return self._put(CALL, (lambda dev, *args: getattr(dev, name)(*args, **kwargs), args))
+
+    def _put(self, kind, payload):
+        future = Future()
+        self.lock.acquire()
+        try:
+            if self.closed:
+                raise RuntimeError('device closed')
+            self.queue.put((kind, future, payload))
+        finally:
+            self.lock.release()
+        return future
+
+    def _run(self):
+        pending = None
+        while True:
+            if pending is None:
+                item = self.queue.get()
+            else:
+                item, pending = pending, None
+            kind, future, payload = item
+            if kind == CLOSE:
+                self._run_batch([item], lambda: self.dev.close())
+                return
+            if kind == CALL:
+                func, args = payload
+                self._run_batch([item], lambda: func(self.dev, *args))
+                continue
+            # Gather the set commands queued behind this one
+            batch = [item]
+            while len(batch) < THREADED_MAX_BATCH:
+                try:
+                    item = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if item[0] != SET:
+                    pending = item
+                    break
+                batch.append(item)
+            cmd_list = [payload for kind, future, payload in batch]
+            self.batch_count += 1
+            self.batch_cmd_count += len(cmd_list)
+            self._run_batch(batch, lambda: self.dev._set_commands(cmd_list))
+
+    def _run_batch(self, batch, func):
+        # Call func and pass its result, or exception, to the batch's futures
+        future_list = [future for future in [item[1] for item in batch]
+                       if future.set_running_or_notify_cancel()]
+        try:
+            result = func()
+        except Exception, e:
+            for future in future_list:
+                future.set_exception(e)
+        else:
+            for future in future_list:
+                future.set_result(result)
+
+
+# The remaining methods queue the Pwm_sine_device method of the same name
+forward_methods(Threaded_pwm_sine_device, WRAPPED_METHODS)